@@ -1,35 +1,135 @@
+import base64
+import gzip
 import json
 import logging
 import os
+import re
+import time
+import uuid
 
 import boto3
 from botocore.exceptions import ClientError
 
+from local_runtime import LocalRuntime
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-sm_runtime = boto3.client("sagemaker-runtime")
+# A model server to call instead of the endpoint, e.g. http://127.0.0.1:8080 for the container run
+# locally (see local_runtime.py)
+SAGEMAKER_RUNTIME_URL = os.environ.get("SAGEMAKER_RUNTIME_URL")
+if SAGEMAKER_RUNTIME_URL:
+    sm_runtime = LocalRuntime(SAGEMAKER_RUNTIME_URL)
+else:
+    sm_runtime = boto3.client("sagemaker-runtime")
+
+# Payloads of at least this many bytes are sent gzipped to the endpoint, which is asked for gzipped
+# predictions too, 0 to send them as they are. Off by default: data capture then records the
+# compressed bodies, which Model Monitor can't read. API Gateway compresses for the clients
+# (MinimumCompressionSize), this is the hop from the Lambda to the endpoint
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 0))
+
+
+def with_attribute(custom_attributes, key, value):
+    """Custom attributes with key=value added, the container reads them as its headers."""
+    pair = "{}={}".format(key, value)
+    return "{};{}".format(custom_attributes, pair) if custom_attributes else pair
+
+
+def response_attributes(custom_attributes):
+    """The custom attributes the endpoint set in its response, by lowercase key."""
+    attributes = {}
+    for pair in (custom_attributes or "").replace(",", ";").split(";"):
+        key, _, value = pair.partition("=")
+        if key.strip():
+            attributes[key.strip().lower()] = value.strip()
+    return attributes
+
+
+def server_timing(attributes):
+    """The stages the model server timed in ms, from its server-timing=stage:ms|... attribute."""
+    timings = {}
+    for span in attributes.get("server-timing", "").split("|"):
+        stage, _, ms = span.partition(":")
+        try:
+            timings[stage] = float(ms)
+        except ValueError:
+            continue
+    return timings
+
+
+def trace_id(event, context):
+    """The trace id of the request: the X-Trace-Id of the client, else the request id of API
+    Gateway, else that of the Lambda invocation. Kept to 64 characters that fit a header."""
+    headers = event.get("headers") or {}
+    given = (
+        headers.get("X-Trace-Id")
+        or headers.get("x-trace-id")
+        or (event.get("requestContext") or {}).get("requestId")
+        or getattr(context, "aws_request_id", None)
+        or ""
+    )
+    return re.sub(r"[^A-Za-z0-9._:-]", "", given)[:64] or uuid.uuid4().hex
+
+
+def log_trace(trace, started, invoked, responded, timings, status):
+    """One JSON line per request, found with the span log of the model server by its trace id.
+    runtime_ms less the server's total is the time spent in SageMaker and on the network."""
+    now = time.perf_counter()
+    line = {
+        "trace_id": trace,
+        "status": status,
+        "lambda_ms": round((now - started) * 1000, 3),
+        "prepare_ms": round((invoked - started) * 1000, 3),
+    }
+    if responded is not None:
+        line["runtime_ms"] = round((responded - invoked) * 1000, 3)
+        if "total" in timings:
+            # The queue is the wait in nginx, before the worker got the request
+            server_ms = timings["total"] + timings.get("queue", 0.0)
+            line["server_ms"] = round(server_ms, 3)
+            line["overhead_ms"] = round(line["runtime_ms"] - server_ms, 3)
+        line["server_spans_ms"] = timings
+    logger.info(json.dumps(line))
 
 
 def lambda_handler(event, context):
+    started = time.perf_counter()
     logger.debug("event %s", json.dumps(event))
     endpoint_name = os.environ["ENDPOINT_NAME"]
-    logger.info("api for endpoint %s", endpoint_name)
+    trace = trace_id(event, context)
+    logger.info("api for endpoint %s trace %s", endpoint_name, trace)
 
     # Get posted body and content type
     content_type = event["headers"].get("Content-Type", "text/csv")
     custom_attributes = event["headers"].get("X-Amzn-SageMaker-Custom-Attributes", "")
-    if content_type.startswith("text/csv"):
+    accept = event["headers"].get("Accept", "application/json")
+    if content_type.startswith(("text/csv", "application/json", "application/jsonlines")):
+        # Forwarded as is, the endpoint parses it
         payload = event["body"]
-    elif content_type.startswith("application/json"):
-        payload = json.loads(event["body"])
+        if event.get("isBase64Encoded"):
+            payload = base64.b64decode(payload)
     else:
         message = "bad content type: {}".format(content_type)
-        logger.error()
-        return {"statusCode": 500, "message": message}
+        logger.error(message)
+        return {"statusCode": 415, "headers": {"X-Trace-Id": trace}, "message": message}
 
     logger.info("content type: %s size: %d", content_type, len(payload))
+    if COMPRESS_MIN_BYTES:
+        # SageMaker doesn't forward Content-Encoding, the container reads the custom attributes
+        custom_attributes = with_attribute(custom_attributes, "accept-encoding", "gzip")
+        if len(payload) >= COMPRESS_MIN_BYTES:
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            payload = gzip.compress(payload, compresslevel=1)
+            custom_attributes = with_attribute(custom_attributes, "content-encoding", "gzip")
+            logger.info("compressed size: %d", len(payload))
+    # The model server logs its spans under the same trace id
+    custom_attributes = with_attribute(custom_attributes, "trace-id", trace)
 
+    invoked = time.perf_counter()
+    responded = None
+    timings = {}
     try:
         # Invoke the endpoint with full multi-line payload
         response = sm_runtime.invoke_endpoint(
@@ -37,19 +137,35 @@ def lambda_handler(event, context):
             Body=payload,
             ContentType=content_type,
             CustomAttributes=custom_attributes,
-            Accept="application/json",
+            Accept=accept,
         )
-        # Return predictions as JSON dictionary instead of CSV text
-        predictions = response["Body"].read().decode("utf-8")
+        # Predictions in the content type the endpoint negotiated from Accept
+        predictions = response["Body"].read()
+        responded = time.perf_counter()
+        attributes = response_attributes(response.get("CustomAttributes"))
+        timings = server_timing(attributes)
+        if attributes.get("content-encoding", "identity").lower() == "gzip":
+            predictions = gzip.decompress(predictions)
+        predictions = predictions.decode("utf-8")
+        log_trace(trace, started, invoked, responded, timings, 200)
         return {
             "statusCode": 200,
             "headers": {
-                "Content-Type": content_type,
+                "Content-Type": response["ContentType"],
                 "X-SageMaker-Endpoint": endpoint_name,
+                "X-Trace-Id": trace,
+                "Server-Timing": ", ".join(
+                    "{};dur={}".format(stage, ms) for stage, ms in timings.items()
+                ),
             },
             "body": predictions,
         }
     except ClientError as e:
         logger.error("Unexpected sagemaker error: {}".format(e.response["Error"]["Message"]))
         logger.error(e)
-        return {"statusCode": 500, "message": "Unexpected sagemaker error"}
+        log_trace(trace, started, invoked, responded, timings, 500)
+        return {
+            "statusCode": 500,
+            "headers": {"X-Trace-Id": trace},
+            "message": "Unexpected sagemaker error",
+        }
@@ -0,0 +1,89 @@
+"""
+A stand-in for the SageMaker runtime client that calls a model server over HTTP, to run the API
+Lambda against the container started locally (serve, or gunicorn with predictor:app):
+
+    SAGEMAKER_RUNTIME_URL=http://127.0.0.1:8080 python local_runtime.py --data ../data/test.csv
+
+prints the response of lambda_handler, while both sides log their spans under one trace id.
+"""
+import argparse
+import io
+import json
+import os
+import urllib.error
+import urllib.request
+
+from botocore.exceptions import ClientError
+
+
+class LocalRuntime:
+    """The invoke_endpoint of boto3's sagemaker-runtime client, for a model server at url."""
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def invoke_endpoint(
+        self,
+        EndpointName,
+        Body,
+        ContentType="text/csv",
+        Accept="application/json",
+        CustomAttributes="",
+    ):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        headers = {"Content-Type": ContentType, "Accept": Accept}
+        if CustomAttributes:
+            # Like the endpoint, which forwards the custom attributes and not Content-Encoding
+            headers["X-Amzn-SageMaker-Custom-Attributes"] = CustomAttributes
+        request = urllib.request.Request(
+            self.url + "/invocations", data=Body, headers=headers, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read()
+                return {
+                    "Body": io.BytesIO(body),
+                    "ContentType": response.headers.get("Content-Type"),
+                    "CustomAttributes": response.headers.get("X-Amzn-SageMaker-Custom-Attributes"),
+                    "InvokedProductionVariant": "local",
+                }
+        except urllib.error.HTTPError as e:
+            # As the endpoint reports the errors of the container
+            message = 'Received client error ({}) from model with message "{}"'.format(
+                e.code, e.read().decode("utf-8", "replace").strip()
+            )
+            error = {"Error": {"Code": "ModelError", "Message": message}}
+            raise ClientError(error, "InvokeEndpoint")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API Lambda against a local model server")
+    parser.add_argument("--url", default=os.environ.get("SAGEMAKER_RUNTIME_URL"))
+    parser.add_argument("--data", required=True, help="CSV payload")
+    parser.add_argument("--rows", type=int, default=0, help="first rows only, 0 for all")
+    parser.add_argument("--content-type", default="text/csv")
+    parser.add_argument("--accept", default="application/json")
+    parser.add_argument("--trace-id", help="X-Trace-Id of the client, else one is generated")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("--url or SAGEMAKER_RUNTIME_URL is required")
+
+    os.environ["SAGEMAKER_RUNTIME_URL"] = args.url
+    os.environ.setdefault("ENDPOINT_NAME", "local")
+    import app  # creates its runtime client from the environment
+
+    with open(args.data) as f:
+        body = f.read()
+    if args.rows:
+        body = "".join(body.splitlines(keepends=True)[: args.rows])
+    headers = {"Content-Type": args.content_type, "Accept": args.accept}
+    if args.trace_id:
+        headers["X-Trace-Id"] = args.trace_id
+    event = {"headers": headers, "body": body, "requestContext": {}}
+    print(json.dumps(app.lambda_handler(event, None), indent=2))
+
+
+if __name__ == "__main__":
+    main()
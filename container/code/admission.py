@@ -0,0 +1,68 @@
+import threading
+import time
+import urllib.request
+
+import metrics
+from utils import *
+
+
+class AdmissionControl:
+    """
+    Sheds the invocations a worker can't serve in time, before any work is done for them.
+
+    An invocation is turned away when it waited longer than max_queue_ms between nginx and the
+    worker (nginx sets X-Request-Start), as its client has likely given up already, or when the
+    worker already handles max_in_flight invocations, which only happens with threaded workers.
+    A limit of 0 disables the check. The limit of the whole instance is nginx's limit_conn on
+    /invocations (off unless MODEL_SERVER_MAX_CONCURRENCY is set, see serve), which answers 429
+    without reaching a worker.
+    """
+
+    def __init__(self, max_in_flight: int = 0, max_queue_ms: float = 0, retry_after: int = 1):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue_ms / 1000
+        self.retry_after = retry_after  # seconds, sent to the clients turned away
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def admit(self, request_start: str = None):
+        """Take a place for the invocation, or return why it's turned away."""
+        waited = queue_seconds(request_start)
+        if waited is not None:
+            metrics.observe("queue", waited)
+            if self.max_queue and waited > self.max_queue:
+                metrics.observe_shed("queue_time")
+                return "queue_time"
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                metrics.observe_shed("worker_limit")
+                return "worker_limit"
+            self.in_flight += 1
+        return None
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def queue_seconds(request_start: str):
+    """Time since nginx received the request, from its X-Request-Start header ("t=<seconds>")."""
+    if not request_start:
+        return None
+    started = request_start[2:] if request_start.startswith("t=") else request_start
+    try:
+        return max(time.time() - float(started), 0.0)
+    except ValueError:
+        return None
+
+
+def nginx_active_requests(url: str):
+    """Requests nginx is handling, from its stub_status page, None if it can't be read."""
+    try:
+        with urllib.request.urlopen(url, timeout=0.5) as response:
+            status = response.read().decode("ascii")
+    except OSError:
+        return None
+    # "Reading: 0 Writing: 3 Waiting: 1", writing counts the requests read and not answered
+    fields = status.split()
+    return int(fields[fields.index("Writing:") + 1]) if "Writing:" in fields else None
@@ -0,0 +1,197 @@
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from schema import load_sample, load_schema
+from utils import *
+
+# Environment variables that size the thread pools of OpenMP (LightGBM) and the BLAS libraries
+# behind NumPy. They are read when the libraries load, so they must be set before the workers
+# import anything.
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def available_cores() -> list:
+    """The cores this process may run on, which respects the container's cpuset."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def thread_env(n_threads: int) -> dict:
+    return {name: str(n_threads) for name in THREAD_ENV_VARS}
+
+
+def plan_budget(n_cores: int, workers: int = None, intra_op: int = None, threaded=False) -> dict:
+    """
+    Split the cores between worker processes and the threads of each, so that
+    workers x inference threads x intra-op threads <= cores.
+
+    Intra-op threads are the OpenMP/BLAS threads of one model call. By default every worker gets
+    one core for one single-threaded call at a time: that has the best throughput under load,
+    and the calibration (see calibrate) tells whether fewer workers with more threads each give a
+    better tail latency. In the threaded mode the cores left to a worker go to its inference
+    threads instead (see executor.py).
+    """
+    if intra_op is None:
+        intra_op = max(n_cores // workers, 1) if workers and not threaded else 1
+    if workers is None:
+        workers = max(n_cores // intra_op, 1)
+    if workers * intra_op > n_cores and intra_op > 1:
+        budget = max(n_cores // workers, 1)
+        logger.warning(
+            f"{workers} workers x {intra_op} intra-op threads oversubscribe {n_cores} cores, "
+            f"using {budget} intra-op threads"
+        )
+        intra_op = budget
+    if workers > n_cores:
+        logger.warning(f"{workers} workers oversubscribe {n_cores} cores")
+    inference_threads = max(n_cores // (workers * intra_op), 1) if threaded else 1
+    return {
+        "workers": workers,
+        "intra_op_threads": intra_op,
+        "inference_threads": inference_threads,
+    }
+
+
+def worker_cores(slot: int, n_workers: int, cores: list) -> list:
+    """The cores of the worker in the given slot when pinning, a contiguous share of them."""
+    per_worker = max(len(cores) // n_workers, 1)
+    start = (slot * per_worker) % len(cores)
+    return cores[start : start + per_worker]
+
+
+def candidate_splits(n_cores: int) -> list:
+    """The (workers, intra-op threads) splits that use all the cores."""
+    return [
+        (n_cores // threads, threads) for threads in range(1, n_cores + 1) if n_cores % threads == 0
+    ]
+
+
+def calibrate(backend_name, model_dir, rows, seconds=3.0, cores=None, tolerance=0.9) -> dict:
+    """
+    Run the model under full load for each split of the cores and pick the one for this instance.
+
+    Each candidate starts as many fresh processes as workers, each limited to its intra-op threads
+    the way serve limits the workers, and every process scores the rows back to back for the
+    given time. The split with the lowest p99 latency among those within tolerance of the best
+    throughput wins.
+    """
+    cores = cores or available_cores()
+    results = []
+    for workers, intra_op in candidate_splits(len(cores)):
+        result = measure_split(backend_name, model_dir, rows, workers, intra_op, seconds)
+        logger.info(
+            f"Calibration: {workers} workers x {intra_op} threads: "
+            f"{result['rows_per_second']:.0f} rows/s, p50 {result['p50_ms']:.2f}ms, "
+            f"p99 {result['p99_ms']:.2f}ms"
+        )
+        results.append(result)
+
+    best_throughput = max(result["rows_per_second"] for result in results)
+    eligible = [r for r in results if r["rows_per_second"] >= tolerance * best_throughput]
+    best = min(eligible, key=lambda result: result["p99_ms"])
+    logger.info(f"Calibration: {best['workers']} workers x {best['intra_op_threads']} threads")
+    return {"best": best, "results": results}
+
+
+def measure_split(backend_name, model_dir, rows, workers, intra_op, seconds) -> dict:
+    # Fresh interpreters, so that the thread pools are sized from the environment set here
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    saved = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update(thread_env(intra_op))
+    try:
+        start = context.Barrier(workers)
+        processes = [
+            context.Process(
+                target=_measure,
+                args=(backend_name, str(model_dir), rows, intra_op, seconds, start, queue),
+            )
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        latencies = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    latencies = np.concatenate(latencies)
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return {
+        "workers": workers,
+        "intra_op_threads": intra_op,
+        "rows_per_second": len(latencies) * len(rows) / seconds,
+        "p50_ms": float(p50),
+        "p99_ms": float(p99),
+    }
+
+
+def _measure(backend_name, model_dir, rows, intra_op, seconds, start, queue):
+    from backends import load_backend
+
+    backend = load_backend(backend_name, Path(model_dir), n_threads=intra_op)
+    backend.predict(rows)  # warm up
+    start.wait()
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        began = time.perf_counter()
+        backend.predict(rows)
+        latencies.append(time.perf_counter() - began)
+    queue.put(np.array(latencies))
+
+
+def calibration_rows(model_dir, n_rows=100, n_columns=None) -> np.ndarray:
+    """Rows of the sample saved by train, or synthetic rows of the training schema for models
+    trained before it was kept: the scoring time of a tree ensemble depends little on the values.
+
+    Models trained before the schema was kept get synthetic rows of n_columns, the width of the
+    loaded model (see Backend.n_inputs), and None when that isn't known either: the callers then
+    skip what they measure or check with the rows."""
+    sample = load_sample(model_dir)
+    if sample is not None:
+        return sample[np.arange(n_rows) % len(sample)]
+    schema = load_schema(model_dir)
+    if schema is not None:
+        n_columns, dtype = schema["n_columns"], schema["dtype"]
+    elif n_columns is not None:
+        dtype = np.float32
+    else:
+        return None
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((n_rows, n_columns)).astype(dtype)
+
+
+def load_calibration(path: Path):
+    """The split saved by a previous calibration on the same number of cores, if any."""
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if saved.get("n_cores") != len(available_cores()):
+        return None
+    return saved["best"]
+
+
+def save_calibration(calibration: dict, path: Path):
+    with open(path, "w") as f:
+        json.dump({"n_cores": len(available_cores()), **calibration}, f, indent=2)
@@ -0,0 +1,372 @@
+import hashlib
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from forest import TreeEnsemble
+from fused import FusedPreprocessor
+from metrics import timed
+from schema import load_schema
+from utils import *
+
+
+class Backend:
+    """
+    An inference runtime for the trained model. load() reads the artifacts that train wrote to the
+    model directory, predict() takes a 2D array of raw features (one row per record, in training
+    column order) and returns one label per row.
+    """
+
+    name = None
+
+    def __init__(self, fused: bool = True, n_threads: int = None):
+        self.fused = fused
+        self.n_threads = n_threads  # Threads of one model call, None for the library default
+        self.version = None  # Identifies the artifacts, set by load_backend (see model_version)
+        self.n_inputs = None  # Raw features per row when the artifacts tell, set by load()
+
+    def load(self, model_dir: Path):
+        raise NotImplementedError
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    @property
+    def classes(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def share(self, directory: Path):
+        """Move large arrays to memory-mapped files that forked workers keep sharing."""
+
+    def fused_preprocessors(self) -> list:
+        """The fused preprocessors the model scores through (see fused.py)."""
+        return []
+
+    def fused_preprocessor(self, n_features: int):
+        """The fused preprocessor of rows of n_features raw features, None if the model has none."""
+        return None
+
+    def predict_features(self, Z: np.ndarray) -> np.ndarray:
+        """Labels of rows already transformed by fused_preprocessor()."""
+        raise NotImplementedError
+
+
+class PycaretBackend(Backend):
+    """The pycaret pipeline saved by train, optionally scored through the fused preprocessing."""
+
+    name = "pycaret"
+
+    def __init__(self, fused: bool = True, n_threads: int = None):
+        super().__init__(fused, n_threads)
+        self.pipeline = None
+        self.preprocessors = {}  # Fused preprocessing per input width, None if it can't be fused
+        self.with_config = True  # Load the pycaret configuration, global to the process
+
+    def load(self, model_dir: Path):
+        from pycaret.regression import load_config, load_model
+
+        if self.with_config:
+            logger.info(f"Pycaret load_config")
+            load_config((Path(model_dir) / "final-config").as_posix())
+
+        logger.info(f"Pycaret load_model")
+        self.pipeline = load_model((Path(model_dir) / "final-model").as_posix())
+        if self.n_threads is not None:
+            set_lightgbm_threads(self.estimator, self.n_threads)
+
+        schema = load_schema(model_dir)
+        n_features = schema["n_columns"] if schema else _training_width(self.pipeline)
+        self.n_inputs = n_features
+        if self.fused and n_features is not None:
+            self.get_preprocessor(n_features)
+
+    @property
+    def estimator(self):
+        return self.pipeline.steps[-1][1]
+
+    def get_preprocessor(self, n_features: int):
+        """Get the fused preprocessing for inputs of the given width, folding it on first use."""
+        if n_features not in self.preprocessors:
+            try:
+                preprocessor = FusedPreprocessor.from_pipeline(self.pipeline, n_features).intern()
+            except Exception as e:
+                logger.warning(f"Fused preprocessing disabled, falling back to predict_model: {e}")
+                preprocessor = None
+            self.preprocessors[n_features] = preprocessor
+        return self.preprocessors[n_features]
+
+    def share(self, directory: Path):
+        for preprocessor in self.fused_preprocessors():
+            preprocessor.share(directory)
+
+    def fused_preprocessors(self) -> list:
+        return [p for p in self.preprocessors.values() if p is not None]
+
+    def fused_preprocessor(self, n_features: int):
+        return self.get_preprocessor(n_features) if self.fused else None
+
+    def predict_features(self, Z: np.ndarray) -> np.ndarray:
+        with timed("predict"):
+            return self.estimator.predict(Z)
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        preprocessor = self.fused_preprocessor(X.shape[1])
+        if preprocessor is not None:
+            with timed("preprocess"):
+                Xt = preprocessor.transform(X)
+            return self.predict_features(Xt)
+
+        from pycaret.regression import predict_model
+
+        with timed("predict"):
+            pred_df = predict_model(self.pipeline, data=pd.DataFrame(X))
+        return pred_df["Label"].to_numpy()
+
+    @property
+    def classes(self):
+        return self.estimator.classes_
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        if self.fused:
+            preprocessor = self.get_preprocessor(X.shape[1])
+            if preprocessor is not None:
+                with timed("preprocess"):
+                    Xt = preprocessor.transform(X)
+                with timed("predict"):
+                    return self.estimator.predict_proba(Xt)
+        with timed("predict"):
+            return self.pipeline.predict_proba(pd.DataFrame(X))
+
+
+class ForestBackend(PycaretBackend):
+    """The fused preprocessing followed by the ensemble exported to arrays (see forest.py)."""
+
+    name = "forest"
+
+    def __init__(self, fused: bool = True, n_threads: int = None):
+        super().__init__(True, n_threads)  # the forest always scores the fused features
+        self.forest = None
+
+    def load(self, model_dir: Path):
+        super().load(model_dir)
+        estimator = self.estimator
+        self.forest = TreeEnsemble.from_booster(estimator.booster_, estimator.classes_)
+        logger.info(f"Forest engine: {self.forest.n_trees} trees, depth {self.forest.depth}")
+
+    def share(self, directory: Path):
+        super().share(directory)
+        self.forest.share(directory)
+
+    def predict_features(self, Z: np.ndarray) -> np.ndarray:
+        with timed("predict"):
+            return self.forest.predict(Z)
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        preprocessor = self.get_preprocessor(X.shape[1])
+        if preprocessor is None:
+            raise ValueError("The forest backend needs a pipeline that can be fused")
+        with timed("preprocess"):
+            Xt = preprocessor.transform(X)
+        return self.predict_features(Xt)
+
+    @property
+    def classes(self):
+        return self.forest.classes
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        preprocessor = self.get_preprocessor(X.shape[1])
+        if preprocessor is None:
+            raise ValueError("The forest backend needs a pipeline that can be fused")
+        with timed("preprocess"):
+            Xt = preprocessor.transform(X)
+        with timed("predict"):
+            return self.forest.predict_proba(Xt)
+
+
+class SlimBackend(Backend):
+    """The serving artifact written by train (see slim.py), loaded without importing pycaret."""
+
+    name = "slim"
+
+    def __init__(self, fused: bool = True, n_threads: int = None):
+        super().__init__(True, n_threads)  # the artifact only holds the fused preprocessing
+        self.preprocessor = None
+        self.booster = None
+        self._classes = None
+
+    def load(self, model_dir: Path):
+        import lightgbm
+
+        from slim import SLIM_DIR, load_manifest
+
+        directory = Path(model_dir) / SLIM_DIR
+        logger.info(f"Load the serving artifact: {directory}")
+        manifest = load_manifest(model_dir)
+        self.preprocessor = FusedPreprocessor.load(directory / manifest["preprocessing"]).intern()
+        self.booster = lightgbm.Booster(model_file=(directory / manifest["booster"]).as_posix())
+        self._classes = np.asarray(manifest["classes"])
+        self.n_inputs = self.preprocessor.n_inputs
+
+    @property
+    def classes(self):
+        return self._classes
+
+    def share(self, directory: Path):
+        self.preprocessor.share(directory)
+
+    def fused_preprocessors(self) -> list:
+        return [self.preprocessor]
+
+    def fused_preprocessor(self, n_features: int):
+        return self.preprocessor if n_features == self.preprocessor.n_inputs else None
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        if X.shape[1] != self.preprocessor.n_inputs:
+            raise ValueError(f"Expected {self.preprocessor.n_inputs} features, got {X.shape[1]}")
+        with timed("preprocess"):
+            Xt = self.preprocessor.transform(X)
+        return self._predict_proba_features(Xt)
+
+    def _predict_proba_features(self, Z: np.ndarray) -> np.ndarray:
+        kwargs = {} if self.n_threads is None else {"num_threads": self.n_threads}
+        with timed("predict"):
+            proba = self.booster.predict(Z, **kwargs)
+        if proba.ndim == 1:  # binary objective, probability of the positive class
+            return np.column_stack([1.0 - proba, proba])
+        return proba
+
+    def predict_features(self, Z: np.ndarray) -> np.ndarray:
+        return self._classes[self._predict_proba_features(Z).argmax(axis=1)]
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        # As LGBMClassifier.predict: the class with the highest probability
+        return self._classes[self.predict_proba(X).argmax(axis=1)]
+
+
+class OnnxBackend(Backend):
+    """The final-model.onnx graph exported by train, run with ONNX Runtime."""
+
+    name = "onnx"
+
+    def __init__(self, fused: bool = True, n_threads: int = None):
+        super().__init__(True, n_threads)  # the preprocessing is folded into the graph by train
+        self.session = None
+
+    def load(self, model_dir: Path):
+        import onnxruntime
+
+        model_path = self.model_path = Path(model_dir) / "final-model.onnx"
+        logger.info(f"ONNX Runtime load: {model_path}")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.n_threads is not None:
+            options.intra_op_num_threads = self.n_threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            model_path.as_posix(), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.label_name = self.session.get_outputs()[0].name
+        self.probabilities_name = self.session.get_outputs()[1].name
+        width = self.session.get_inputs()[0].shape[-1]
+        self.n_inputs = width if isinstance(width, int) else None  # unless the graph is dynamic
+        self._classes = None
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        with timed("predict"):
+            return self.session.run([self.label_name], {self.input_name: X})[0]
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        with timed("predict"):
+            return self.session.run([self.probabilities_name], {self.input_name: X})[0]
+
+    @property
+    def classes(self):
+        if self._classes is None:
+            self._classes = _onnx_classes(self.model_path)
+        return self._classes
+
+
+BACKENDS = {
+    backend.name: backend for backend in (PycaretBackend, ForestBackend, SlimBackend, OnnxBackend)
+}
+
+
+def load_backend(
+    name: str, model_dir: Path, fused: bool = True, n_threads: int = None, named: bool = False
+) -> Backend:
+    """Load the model of model_dir with the named backend.
+
+    pycaret keeps the configuration of one model per process, which load_config overwrites: the
+    models selected by name (named=True), served next to the default model, leave it to the
+    default one. They can't be served by the pycaret backend, whose predict_model reads it."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, choose from {sorted(BACKENDS)}")
+    if named and name == PycaretBackend.name:
+        raise ValueError("Models selected by name need the forest, slim or onnx backend")
+    backend = BACKENDS[name](fused=fused, n_threads=n_threads)
+    if named and isinstance(backend, PycaretBackend):
+        backend.with_config = False
+    backend.load(model_dir)
+    backend.version = model_version(model_dir)
+    return backend
+
+
+def model_version(model_dir: Path) -> str:
+    """A short digest of the names, sizes and modification times of the model artifacts.
+
+    Those are the files of model_dir and of its slim artifacts (see slim.py). The other
+    subdirectories are left out: with the default settings they're the models selected by name,
+    which would otherwise change the version of the default model (see ServeConfig.MODELS_DIR)."""
+    from slim import SLIM_DIR
+
+    model_dir = Path(model_dir)
+    files = model_dir.iterdir() if model_dir.is_dir() else ()
+    paths = itertools.chain(files, (model_dir / SLIM_DIR).rglob("*"))
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        if path.is_file():
+            stat = path.stat()
+            digest.update(
+                f"{path.relative_to(model_dir)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+            )
+    return digest.hexdigest()[:12]
+
+
+def set_lightgbm_threads(estimator, n_threads: int):
+    """Limit the OpenMP threads LightGBM uses to predict, it defaults to all the cores."""
+    if hasattr(estimator, "booster_"):
+        estimator.set_params(n_jobs=n_threads)  # passed to predict by LightGBM >= 4
+        # Earlier versions predict with the training parameters, which pycaret sets to n_jobs=-1
+        params = estimator.booster_.params
+        for alias in ("n_jobs", "nthread", "nthreads", "num_thread"):
+            params.pop(alias, None)
+        params["num_threads"] = n_threads
+
+
+def _training_width(pipeline):
+    """Number of raw features the pipeline was trained on, if pycaret recorded it."""
+    columns = getattr(pipeline.steps[0][1], "final_training_columns", None)
+    return None if columns is None else len(columns)
+
+
+def _onnx_classes(model_path: Path) -> np.ndarray:
+    """Class labels of the classifier node, in the order of the "probabilities" output."""
+    import onnx
+    from onnx import helper
+
+    for node in onnx.load(model_path.as_posix()).graph.node:
+        for attribute in node.attribute:
+            if attribute.name in ("classlabels_int64s", "classlabels_strings"):
+                labels = helper.get_attribute_value(attribute)
+                if attribute.name == "classlabels_strings":
+                    labels = [label.decode("utf-8") for label in labels]
+                return np.asarray(labels)
+    raise ValueError(f"No class labels found in {model_path}")
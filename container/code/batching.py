@@ -0,0 +1,108 @@
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from utils import *
+
+
+class _Job:
+    __slots__ = ("rows", "traces", "paused", "enqueued", "done", "result", "error")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.traces = metrics.current_traces()  # of the invocation waiting for it
+        self.paused = metrics.thread_paused()  # submitted by the warm-up, not an invocation
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching of concurrent requests.
+
+    Request threads submit their rows and wait; one scoring thread per worker collects the rows
+    queued within max_wait_ms of the oldest one, up to max_batch_rows, scores them with a single
+    predict call and scatters the results back. A request larger than max_batch_rows is scored
+    on its own. This pays off with threaded gunicorn workers (serve uses gthread when batching is
+    enabled), where several requests are in flight in the same process.
+    """
+
+    def __init__(self, predict, max_batch_rows=256, max_wait_ms=2.0):
+        self.predict = predict
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.pid = None  # the scoring thread doesn't survive a fork, restart it in the worker
+        self.lock = threading.Lock()
+
+    def submit(self, rows: np.ndarray) -> np.ndarray:
+        """Score rows as part of the next batch, blocking until the result is ready."""
+        self._ensure_started()
+        job = _Job(rows)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                threading.Thread(target=self._run, name="micro-batcher", daemon=True).start()
+                self.pid = os.getpid()
+
+    def _run(self):
+        carry = None
+        while True:
+            job = carry if carry is not None else self.queue.get()
+            carry = None
+            jobs, n_rows = [job], len(job.rows)
+            deadline = job.enqueued + self.max_wait
+            while n_rows < self.max_batch_rows:
+                try:
+                    job = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if n_rows + len(job.rows) > self.max_batch_rows:
+                    carry = job
+                    break
+                jobs.append(job)
+                n_rows += len(job.rows)
+            self._score(jobs)
+
+    def _score(self, jobs):
+        started = time.perf_counter()
+        # Requests of different widths can't be stacked; each width is scored on its own
+        by_width = {}
+        for job in jobs:
+            by_width.setdefault(job.rows.shape[1:], []).append(job)
+        for group in by_width.values():
+            try:
+                rows = np.concatenate([job.rows for job in group]) if len(group) > 1 else None
+                # The batch is timed for each invocation in it, not for the warm-up alone
+                if all(job.paused for job in group):
+                    recording = metrics.paused()
+                else:
+                    recording = metrics.traced(*(trace for job in group for trace in job.traces))
+                with recording:
+                    predictions = self.predict(group[0].rows if rows is None else rows)
+                offsets = np.cumsum([len(job.rows) for job in group])[:-1]
+                for job, result in zip(group, np.split(predictions, offsets)):
+                    job.result = result
+            except Exception as e:
+                for job in group:
+                    job.error = e
+
+        waits = [started - job.enqueued for job in jobs if not job.paused]
+        if waits:
+            metrics.observe_batch(sum(len(job.rows) for job in jobs), waits)  # on /metrics
+        for job in jobs:
+            job.done.set()
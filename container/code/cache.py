@@ -0,0 +1,201 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+from shared import open_shared_table, unlink_unmapped
+from utils import *
+
+# Record of the shared table. check ties the other fields together, so that a record torn by two
+# workers writing the same slot at once reads as a miss instead of a wrong prediction.
+RECORD = np.dtype([("key", "<u8"), ("value", "<i8"), ("expires", "<f8"), ("check", "<u8")])
+CHECK_SALT = np.uint64(0x9E3779B97F4A7C15)
+
+
+def row_hashes(X: np.ndarray, seed: int) -> np.ndarray:
+    """A 64-bit hash of the bytes of each row, computed for the whole batch at once.
+
+    The row is read as 32-bit words and hashed by two multilinear hashes with random 64-bit
+    multipliers (Lemire and Kaser, "Strongly universal string hashing is fast"), keeping the top
+    32 bits of each: rows that differ collide with a probability of about 2^-64. The seed should
+    identify the model version, the dtype and the row width."""
+    X = np.ascontiguousarray(X)
+    if X.ndim != 2:
+        raise ValueError(f"Expected a 2D array of rows, got shape {X.shape}")
+    raw = X.view(np.uint8).reshape(len(X), -1)
+    if raw.shape[1] % 4:
+        raw = np.pad(raw, ((0, 0), (0, -raw.shape[1] % 4)))
+    words = raw.view(np.uint32).astype(np.uint64)
+    multipliers, offsets = _multipliers(words.shape[1], seed)
+    sums = words @ multipliers + offsets  # wraps around modulo 2^64
+    return (sums[:, 0] >> np.uint64(32)) << np.uint64(32) | (sums[:, 1] >> np.uint64(32))
+
+
+_MULTIPLIERS = {}
+
+
+def _multipliers(n_words, seed):
+    if (n_words, seed) not in _MULTIPLIERS:
+        rng = np.random.default_rng(seed)
+        multipliers = rng.integers(0, 2**64, size=(n_words, 2), dtype=np.uint64, endpoint=False)
+        offsets = rng.integers(0, 2**64, size=2, dtype=np.uint64, endpoint=False)
+        _MULTIPLIERS[(n_words, seed)] = multipliers, offsets
+    return _MULTIPLIERS[(n_words, seed)]
+
+
+class LruStore:
+    """Per-process store with least-recently-used eviction and a time to live."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, expires)
+        self.lock = threading.Lock()
+
+    def get(self, keys: np.ndarray):
+        found = np.zeros(len(keys), dtype=bool)
+        values = np.zeros(len(keys), dtype=np.int64)
+        now = time.monotonic()
+        with self.lock:
+            for i, key in enumerate(keys.tolist()):
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                found[i], values[i] = True, entry[0]
+        return found, values
+
+    def put(self, keys: np.ndarray, values: np.ndarray):
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            for key, value in zip(keys.tolist(), values.tolist()):
+                self.entries[key] = (value, expires)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SharedStore:
+    """
+    Direct-mapped table in a memory-mapped file, shared by all the workers of the instance.
+
+    Each key has one slot, so a new entry replaces whatever was in its slot (the most recently
+    written entry wins) and lookups and inserts are vectorized. Workers write without locking,
+    a record torn by concurrent writes fails its check and reads as a miss.
+    """
+
+    def __init__(self, path: Path, max_entries: int, ttl: float):
+        self.ttl = ttl
+        size = 1 << max(int(max_entries) - 1, 1).bit_length()  # power of 2, slot = key & mask
+        self.mask = np.uint64(size - 1)
+        self.table = open_shared_table(path, RECORD, (size,))
+
+    def get(self, keys: np.ndarray):
+        records = self.table[keys & self.mask]
+        found = (
+            (records["key"] == keys)
+            & (records["check"] == _check(records["key"], records["value"], records["expires"]))
+            & (records["expires"] >= time.time())
+        )
+        return found, records["value"]
+
+    def put(self, keys: np.ndarray, values: np.ndarray):
+        records = np.empty(len(keys), dtype=RECORD)
+        records["key"], records["value"] = keys, values
+        records["expires"] = time.time() + self.ttl
+        records["check"] = _check(records["key"], records["value"], records["expires"])
+        self.table[keys & self.mask] = records
+
+
+def _check(keys, values, expires):
+    return keys ^ values.view(np.uint64) ^ expires.view(np.uint64) ^ CHECK_SALT
+
+
+class PredictionCache:
+    """
+    Cache of the label predicted for each row, keyed by a hash of the row's bytes.
+
+    The hash is seeded with the model version, so a new model never sees the entries of the
+    previous one. Rows repeated within a batch are scored once. Labels are stored as indices into
+    the model's classes, which keeps the values fixed-size for the shared table.
+    """
+
+    def __init__(self, store, version: str, classes, log_every: int = 1000):
+        self.store = store
+        self.version = version
+        self.classes = np.asarray(classes)
+        self.sorter = np.argsort(self.classes)
+        self.log_every = log_every
+        self.hits = 0  # rows found in the cache
+        self.duplicates = 0  # rows missing from the cache but repeated within their batch
+        self.misses = 0  # rows scored
+        self.calls = 0
+
+    @classmethod
+    def create(cls, kind: str, version: str, classes, max_entries: int, ttl: float, directory):
+        if kind == "local":
+            store = LruStore(max_entries, ttl)
+        elif kind == "shared":
+            path = Path(directory) / f"prediction-cache-{version}.npy"
+            # The tables of the previous versions, once the workers still serving them are done
+            unlink_unmapped(p for p in Path(directory).glob("prediction-cache-*.npy") if p != path)
+            store = SharedStore(path, max_entries, ttl)
+        else:
+            raise ValueError(f"Unknown prediction cache {kind}, choose from local, shared")
+        logger.info(f"Prediction cache: {kind}, {max_entries} entries, {ttl:g}s TTL")
+        return cls(store, version, classes)
+
+    def predict(self, X: np.ndarray, score) -> np.ndarray:
+        """Labels for the rows of X, calling score only for the distinct rows not in the cache."""
+        seed = hash_bytes(f"{self.version}/{X.dtype.str}/{X.shape[1]}".encode("utf-8"))
+        keys = row_hashes(X, seed)
+        found, indices = self.store.get(keys)
+        missing = np.flatnonzero(~found)
+        n_scored = 0
+        if missing.size:
+            unique_keys, first, inverse = np.unique(
+                keys[missing], return_index=True, return_inverse=True
+            )
+            scored = self.class_indices(score(X[missing[first]]))
+            self.store.put(unique_keys, scored)
+            indices[missing] = scored[inverse]
+            n_scored = len(unique_keys)
+
+        hits, duplicates = len(X) - missing.size, missing.size - n_scored
+        self.hits += hits
+        self.duplicates += duplicates
+        self.misses += n_scored
+        metrics.observe_cache(hits, duplicates, n_scored)  # of all the workers, on /metrics
+        self.calls += 1
+        if self.calls % self.log_every == 0:
+            logger.info(f"Prediction cache: {self.stats()}")
+        return self.classes[indices]
+
+    def class_indices(self, labels: np.ndarray) -> np.ndarray:
+        positions = np.searchsorted(self.classes, labels, sorter=self.sorter)
+        indices = self.sorter[np.minimum(positions, len(self.classes) - 1)]
+        if not np.array_equal(self.classes[indices], labels):
+            raise ValueError("The model predicted labels that are not among its classes")
+        return indices.astype(np.int64)
+
+    def stats(self) -> dict:
+        total = self.hits + self.duplicates + self.misses
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "duplicates": self.duplicates,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+def hash_bytes(data: bytes) -> int:
+    """A stable 64-bit integer for a seed, unlike hash() which differs per process."""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+from utils import *
+
+LATENCY_BOUNDS_MS = [0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+class Challenger:
+    """
+    A second model scoring the batches of the primary one off the response path.
+
+    The primary model answers the request, then hands the parsed rows and its labels to a
+    thread of this worker that scores them with the challenger and counts the rows both models
+    label the same. Client latency only includes the primary model. When the challenger falls
+    behind, batches beyond max_pending are skipped rather than queued. If both models score
+    through the same fused preprocessing, the primary model hands over the rows it transformed,
+    which the challenger scores as they are (see ScoringService.score_with_features).
+
+    The statistics since the worker started are appended to a JSON lines file of the worker
+    every log_every batches, and returned by stats().
+    """
+
+    def __init__(self, model, name: str, directory: Path, max_pending=8, log_every=1000):
+        self.model = model
+        self.name = name
+        self.directory = Path(directory)
+        self.path = None  # of the worker, see _ensure_started
+        self.max_pending = max_pending
+        self.log_every = log_every
+        self.pool = None
+        self.pid = None  # the thread doesn't survive a fork, start a new pool in the worker
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.batches = 0
+        self.rows = 0
+        self.agreed = 0
+        self.skipped = 0  # batches not scored because the challenger was behind
+        self.errors = 0
+        self.primary_ms = metrics.Histogram(LATENCY_BOUNDS_MS)
+        self.challenger_ms = metrics.Histogram(LATENCY_BOUNDS_MS)
+
+    def submit(
+        self,
+        rows: np.ndarray,
+        labels: np.ndarray,
+        primary_seconds: float,
+        features: np.ndarray = None,
+    ):
+        """Queue the rows scored by the primary model for the challenger, without waiting.
+
+        features are the rows through the fused preprocessing of both models, if they share it,
+        which the challenger then doesn't apply again."""
+        pool = self._ensure_started()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.skipped += 1
+                return
+            self.pending += 1
+        pool.submit(self._compare, rows, labels, primary_seconds, features)
+
+    def _ensure_started(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pool = ThreadPoolExecutor(
+                        1, thread_name_prefix="challenger", initializer=metrics.pause_thread
+                    )
+                    self.pending = 0
+                    self.path = self.directory / f"challenger-{self.name}-{os.getpid()}.jsonl"
+                    self.pid = os.getpid()
+        return self.pool
+
+    def _compare(self, rows, labels, primary_seconds, features):
+        try:
+            started = time.perf_counter()
+            if features is not None:
+                predicted = self.model.predict_features(features)
+            else:
+                predicted = self.model.predict(rows)
+            seconds = time.perf_counter() - started
+            agreed = int(np.count_nonzero(np.asarray(predicted) == np.asarray(labels)))
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+                self.pending -= 1
+            if self.errors == 1:
+                logger.warning(f"Challenger {self.name} failed: {e!r}")
+            return
+
+        with self.lock:
+            self.pending -= 1
+            self.batches += 1
+            self.rows += len(rows)
+            self.agreed += agreed
+            self.primary_ms.observe(primary_seconds * 1000)
+            self.challenger_ms.observe(seconds * 1000)
+            log = self.batches % self.log_every == 0
+        if log:
+            self.write_stats()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "challenger": self.name,
+                "version": self.model.version,
+                "time": time.time(),
+                "batches": self.batches,
+                "rows": self.rows,
+                "agreement": self.agreed / self.rows if self.rows else None,
+                "skipped": self.skipped,
+                "errors": self.errors,
+                "primary_ms": _histogram_stats(self.primary_ms),
+                "challenger_ms": _histogram_stats(self.challenger_ms),
+            }
+
+    def write_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"Challenger {self.name}: agreement {stats['agreement']} on {stats['rows']} rows, "
+            f"latency (ms) {self.challenger_ms.summary()}"
+        )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(stats) + "\n")
+
+
+def _histogram_stats(histogram: metrics.Histogram) -> dict:
+    return {
+        "count": histogram.count,
+        "mean": histogram.sum / max(histogram.count, 1),
+        "buckets": dict(
+            zip([f"{b:g}" for b in histogram.bounds] + ["+Inf"], histogram.counts.tolist())
+        ),
+    }
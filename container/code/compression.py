@@ -0,0 +1,101 @@
+import gzip
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-Encoding of request and response bodies. This module only depends on the standard
+# library (plus zstandard for zstd), like content_types.py, for clients to use it too.
+
+GZIP = "gzip"
+ZSTD = "zstd"
+IDENTITY = "identity"
+ENCODINGS = (GZIP, ZSTD) if zstandard is not None else (GZIP,)
+
+# Fast levels: a payload is compressed once, on the request path, and CSV compresses well anyway
+LEVELS = {GZIP: 1, ZSTD: 3}
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def compressor(encoding: str):
+    """An object with compress(data) and flush(), for compressing a body chunk by chunk."""
+    if encoding == GZIP:
+        return zlib.compressobj(LEVELS[GZIP], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=LEVELS[ZSTD]).compressobj()
+    raise UnsupportedEncoding(f"Unsupported content encoding: {encoding}")
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == IDENTITY:
+        return data
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+
+def decompressing_reader(stream, encoding: str, max_size: int):
+    """A file-like object reading the decompressed body from stream, at most max_size bytes of it,
+    so that a small compressed body can't take the memory of the worker."""
+    if encoding == IDENTITY:
+        return stream
+    if encoding == GZIP:
+        reader = gzip.GzipFile(fileobj=stream, mode="rb")
+    elif encoding == ZSTD and zstandard is not None:
+        # read_across_frames for bodies compressed chunk by chunk into several frames
+        reader = zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    else:
+        raise UnsupportedEncoding(f"Unsupported content encoding: {encoding}")
+    return LimitedReader(reader, max_size)
+
+
+def decompress(data: bytes, encoding: str, max_size: int) -> bytes:
+    if encoding == IDENTITY:
+        return data
+    return decompressing_reader(io.BytesIO(data), encoding, max_size).read()
+
+
+class LimitedReader:
+    """read(n) of a file-like object, raising PayloadTooLarge past max_size bytes."""
+
+    def __init__(self, reader, max_size: int, chunk_bytes: int = 1 << 20):
+        self.reader = reader
+        self.max_size = max_size
+        self.chunk_bytes = chunk_bytes
+        self.size = 0
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            chunks = []
+            while chunk := self.read(self.chunk_bytes):
+                chunks.append(chunk)
+            return b"".join(chunks)
+        try:
+            chunk = self.reader.read(min(n, self.max_size + 1 - self.size))
+        except (OSError, EOFError, zlib.error) as e:
+            raise ValueError(f"Malformed compressed body: {e}") from None
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise ValueError(f"Malformed compressed body: {e}") from None
+            raise
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise PayloadTooLarge(f"The body decompresses to more than {self.max_size} bytes")
+        return chunk
+
+
+def content_encoding(header: str) -> str:
+    """The encoding of a body from its Content-Encoding header, one encoding at most."""
+    encoding = (header or IDENTITY).strip().lower()
+    if "," in encoding:
+        raise UnsupportedEncoding(f"Unsupported content encoding: {encoding}")
+    return encoding
@@ -0,0 +1,263 @@
+import io
+import json
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# This module only depends on numpy (plus pyarrow for Arrow, and csv_parser.py for reading CSV),
+# so that clients can use the same serialize/deserialize pair as the container to build requests
+# and read responses.
+
+CSV = "text/csv"
+JSON = "application/json"
+JSONLINES = "application/jsonlines"
+NPY = "application/x-npy"
+ARROW = "application/vnd.apache.arrow.stream"
+
+
+class UnsupportedContentType(ValueError):
+    pass
+
+
+def serialize(array: np.ndarray, content_type: str, probabilities: np.ndarray = None) -> bytes:
+    """Encode a 1D array of predictions (optionally with their class probabilities, one row per
+    prediction) or a 2D array of feature rows."""
+    if content_type not in SERIALIZERS:
+        raise UnsupportedContentType(f"Unsupported content type: {content_type}")
+    if probabilities is not None:
+        probabilities = np.asarray(probabilities)
+    return SERIALIZERS[content_type](np.asarray(array), probabilities)
+
+
+def deserialize(data: bytes, content_type: str) -> np.ndarray:
+    """Decode a payload produced by serialize, reading it zero-copy where the format allows.
+    For predictions this returns the labels only."""
+    if content_type not in DESERIALIZERS:
+        raise UnsupportedContentType(f"Unsupported content type: {content_type}")
+    return DESERIALIZERS[content_type](data)
+
+
+def parse_custom_attributes(header: str) -> dict:
+    """Key/value pairs from X-Amzn-SageMaker-Custom-Attributes, e.g. "probabilities=true"."""
+    attributes = {}
+    for pair in (header or "").replace(",", ";").split(";"):
+        key, _, value = pair.partition("=")
+        if key.strip():
+            attributes[key.strip().lower()] = value.strip()
+    return attributes
+
+
+def format_custom_attributes(attributes: dict) -> str:
+    """The X-Amzn-SageMaker-Custom-Attributes value of key/value pairs, e.g. of a response."""
+    return ";".join(f"{key}={value}" for key, value in attributes.items())
+
+
+def negotiate(accept: str, supported, default: str):
+    """Pick the response content type from an Accept header, None if nothing acceptable."""
+    if not accept:
+        return default
+    candidates = []
+    for position, entry in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, media_type.lower()))
+    for _, _, media_type in sorted(candidates):
+        if media_type in supported:
+            return media_type
+        if media_type in ("*/*", "*"):
+            return default
+        if media_type.endswith("/*"):
+            for content_type in supported:
+                if content_type.startswith(media_type[:-1]):
+                    return content_type
+    return None
+
+
+# The text formats are rendered with one %-format call over all cells: each cell is formatted by
+# NumPy's astype(str) and a row template is repeated once per row, so there is no Python-level
+# loop over rows and no DataFrame round trip.
+
+
+def _format_rows(cells: np.ndarray, row_template: str) -> str:
+    return (row_template * len(cells)) % tuple(cells.ravel().tolist())
+
+
+def _number_cells(array: np.ndarray, missing: str) -> np.ndarray:
+    cells = array.astype(str)
+    if array.dtype.kind == "f":
+        cells[np.isnan(array)] = missing
+    return cells
+
+
+def _label_cells(labels: np.ndarray, quote) -> np.ndarray:
+    if labels.dtype.kind in "iuf":
+        return labels.astype(str)
+    return np.array([quote(str(label)) for label in labels])  # class names
+
+
+def _prediction_cells(labels, probabilities, quote):
+    cells = _label_cells(labels, quote)[:, None]
+    if probabilities is not None:
+        cells = np.hstack([cells, probabilities.astype(str)])
+    return cells
+
+
+def _serialize_csv(array, probabilities):
+    if array.ndim == 2:  # feature rows, NaN is written as an empty field
+        cells = _number_cells(array, missing="")
+    else:
+        cells = _prediction_cells(array, probabilities, quote=str)
+    return _format_rows(cells, ",".join(["%s"] * cells.shape[1]) + "\n").encode("utf-8")
+
+
+def _deserialize_csv(data):
+    from csv_parser import CsvParser
+
+    first_line = bytes(data[: data.find(b"\n")] if b"\n" in data else data)
+    values = CsvParser(first_line.count(b",") + 1, dtype=np.float64).parse(data)
+    return values[:, 0] if values.shape[1] == 1 else values
+
+
+def _serialize_json(array, probabilities):
+    if array.ndim == 2:
+        cells = _number_cells(array, missing="null")
+        rows = _format_rows(cells, "[" + ",".join(["%s"] * cells.shape[1]) + "],")
+        return ('{"instances":[' + rows[:-1] + "]}").encode("utf-8")
+    body = '{"predictions":[' + ",".join(_label_cells(array, json.dumps)) + "]"
+    if probabilities is not None:
+        template = "[" + ",".join(["%s"] * probabilities.shape[1]) + "],"
+        body += ',"probabilities":[' + _format_rows(probabilities.astype(str), template)[:-1] + "]"
+    return (body + "}").encode("utf-8")
+
+
+def _deserialize_json(data):
+    payload = json.loads(data)
+    if isinstance(payload, dict):
+        if "predictions" in payload:
+            return np.array(payload["predictions"])
+        if "features" in payload:  # a single row
+            return _json_rows([payload["features"]])
+        payload = payload.get("instances")
+    return _json_rows(payload)
+
+
+def _serialize_jsonlines(array, probabilities):
+    if array.ndim == 2:
+        cells = _number_cells(array, missing="null")
+        return _format_rows(cells, "[" + ",".join(["%s"] * cells.shape[1]) + "]\n").encode()
+    cells = _prediction_cells(array, probabilities, quote=json.dumps)
+    template = '{"label":%s'
+    if probabilities is not None:
+        template += ',"probabilities":[' + ",".join(["%s"] * probabilities.shape[1]) + "]"
+    return _format_rows(cells, template + "}\n").encode("utf-8")
+
+
+def _deserialize_jsonlines(data):
+    lines = [line for line in bytes(data).split(b"\n") if line.strip()]
+    # One json.loads for the whole payload instead of one per line
+    records = json.loads(b"[" + b",".join(lines) + b"]")
+    if records and isinstance(records[0], dict) and "label" in records[0]:
+        return np.array([record["label"] for record in records])
+    return _json_rows(records)
+
+
+def _json_rows(rows):
+    """Rows given as lists of numbers (null for missing values) or {"features": [...]} objects."""
+    if not isinstance(rows, list):
+        raise ValueError('Expected a list of rows, {"instances": [...]} or {"features": [...]}')
+    if rows and isinstance(rows[0], dict):
+        rows = [row.get("features") for row in rows]
+    try:
+        return np.array(rows, dtype=np.float64)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Rows must be lists of numbers of the same length: {e}")
+
+
+def _serialize_npy(array, probabilities):
+    if probabilities is not None:
+        # A structured array with one (label, probabilities) record per prediction
+        dtype = [
+            ("label", array.dtype),
+            ("probabilities", probabilities.dtype, probabilities.shape[1:]),
+        ]
+        records = np.empty(len(array), dtype=dtype)
+        records["label"], records["probabilities"] = array, probabilities
+        array = records
+    out = io.BytesIO()
+    np.save(out, array, allow_pickle=False)
+    return out.getvalue()
+
+
+def _deserialize_npy(data):
+    f = io.BytesIO(data)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    else:
+        return np.load(f, allow_pickle=False)
+    if dtype.hasobject:
+        raise ValueError("NPY payloads with object arrays are not accepted")
+    count = int(np.prod(shape))
+    # A read-only view on the request body, no copy
+    array = np.frombuffer(data, dtype=dtype, count=count, offset=f.tell())
+    array = array.reshape(shape, order="F" if fortran_order else "C")
+    return array["label"] if array.dtype.names and "label" in array.dtype.names else array
+
+
+def _serialize_arrow(array, probabilities):
+    if array.ndim == 1:
+        columns = {"predictions": pa.array(array)}
+        if probabilities is not None:
+            values = pa.array(np.ascontiguousarray(probabilities).ravel())
+            columns["probabilities"] = pa.FixedSizeListArray.from_arrays(
+                values, probabilities.shape[1]
+            )
+        table = pa.table(columns)
+    else:
+        table = pa.table({str(i): pa.array(array[:, i]) for i in range(array.shape[1])})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _deserialize_arrow(data):
+    table = pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+    if "predictions" in table.column_names:
+        return table.column("predictions").to_numpy()
+    # Each column is a zero-copy view where it is a single chunk without nulls, the columns are
+    # then stacked once into the row-major model input
+    columns = [column.to_numpy() for column in table.columns]
+    if len(columns) == 1:
+        return columns[0]
+    return np.column_stack(columns)
+
+
+SERIALIZERS = {
+    CSV: _serialize_csv,
+    JSON: _serialize_json,
+    JSONLINES: _serialize_jsonlines,
+    NPY: _serialize_npy,
+}
+DESERIALIZERS = {
+    CSV: _deserialize_csv,
+    JSON: _deserialize_json,
+    JSONLINES: _deserialize_jsonlines,
+    NPY: _deserialize_npy,
+}
+if pa is not None:
+    SERIALIZERS[ARROW] = _serialize_arrow
+    DESERIALIZERS[ARROW] = _deserialize_arrow
@@ -0,0 +1,157 @@
+import io
+import re
+
+import numpy as np
+import pandas as pd
+
+from utils import *
+
+COMMA, NEWLINE = ord(","), ord("\n")
+# Zero-width position of an empty field: not preceded and not followed by anything but a comma
+EMPTY_FIELD = re.compile(rb"(?<![^,])(?![^,])")
+
+
+class CsvParseError(ValueError):
+    """A malformed payload, located as precisely as possible (1-based row and column)."""
+
+    def __init__(self, message, row=None, column=None):
+        location = []
+        if row is not None:
+            location.append(f"row {row}")
+        if column is not None:
+            location.append(f"column {column}")
+        super().__init__(f"{', '.join(location)}: {message}" if location else message)
+        self.row = row
+        self.column = column
+
+
+class CsvParser:
+    """
+    Parser for headerless CSV payloads with a fixed numeric schema.
+
+    It works on the request bytes directly: the row and column counts are validated with
+    vectorized scans over a zero-copy uint8 view, then the values go straight into one float32
+    array of the final shape. Small payloads, the common case, are parsed by NumPy's C number
+    parser in one pass; from large_rows rows on pandas' C tokenizer is faster, and it is given
+    the bytes and the schema dtype so that there is no decoding to str and no type inference.
+    """
+
+    large_rows = 128
+
+    def __init__(self, n_columns: int, dtype=np.float32):
+        self.n_columns = n_columns
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_schema(cls, schema: dict):
+        return cls(schema["n_columns"], schema["dtype"])
+
+    def parse(self, data: bytes, large: bool = None) -> np.ndarray:
+        """Parse a payload into an array of shape (rows, n_columns).
+
+        large forces the choice of the pandas path (True) or the NumPy path (False), by default it
+        is taken from the row count. The two may round a value differently in the last bit."""
+        body = bytes(data).rstrip(b"\r\n")
+        if b"\r" in body:
+            body = body.replace(b"\r\n", b"\n")
+        if not body:
+            raise CsvParseError("empty payload")
+
+        n_rows = self.validate(body)
+        if large or (large is None and n_rows >= self.large_rows):
+            return self.parse_large(body, n_rows)
+
+        flat = body.replace(b"\n", b",")
+        if b",," in flat or flat.startswith(b",") or flat.endswith(b","):
+            flat = EMPTY_FIELD.sub(b"nan", flat)  # missing values, imputed by the model
+
+        try:
+            values = np.fromstring(flat, dtype=self.dtype, sep=",")
+        except ValueError:
+            values = None
+        if values is None or values.size != n_rows * self.n_columns:
+            raise self.locate_error(flat)
+        return values.reshape(n_rows, self.n_columns)
+
+    def parse_stream(self, stream, block_rows: int, chunk_bytes: int = 1 << 20):
+        """Parse a payload read from a file-like object, yielding arrays of block_rows rows.
+
+        At most one block and one chunk of the payload are held at a time. The blocks of a
+        payload of more than one block all go through the same path as the whole payload would
+        in parse(), so that their values are identical to parsing it at once."""
+        block_rows = max(block_rows, self.large_rows)
+        buffer, blocks = b"", 0
+        while True:
+            chunk = stream.read(chunk_bytes)
+            buffer += chunk
+            newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == NEWLINE)
+            while len(newlines) >= block_rows:
+                end = int(newlines[block_rows - 1])
+                try:
+                    yield self.parse(buffer[:end], large=True)
+                except CsvParseError as e:
+                    raise _shift_row(e, blocks * block_rows)
+                buffer, newlines = buffer[end + 1 :], newlines[block_rows:] - (end + 1)
+                blocks += 1
+            if not chunk:
+                break
+        if buffer.strip() or blocks == 0:
+            try:
+                yield self.parse(buffer, large=True if blocks else None)
+            except CsvParseError as e:
+                raise _shift_row(e, blocks * block_rows)
+
+    def parse_large(self, body: bytes, n_rows: int) -> np.ndarray:
+        try:
+            df = pd.read_csv(
+                io.BytesIO(body), header=None, dtype=self.dtype, engine="c", skip_blank_lines=False
+            )
+        except ValueError:
+            raise self.locate_error(body.replace(b"\n", b","))
+        values = df.to_numpy()
+        if values.shape != (n_rows, self.n_columns):
+            raise CsvParseError(f"expected {n_rows} rows of {self.n_columns} columns")
+        return values
+
+    def validate(self, body: bytes) -> int:
+        """Check that every row has n_columns fields, return the number of rows."""
+        buf = np.frombuffer(body, dtype=np.uint8)
+        is_newline = buf == NEWLINE
+        n_rows = int(np.count_nonzero(is_newline)) + 1
+        # In a well-formed payload every n_columns-th separator is a newline
+        separators = np.flatnonzero(is_newline | (buf == COMMA))
+        row_ends = buf[separators[self.n_columns - 1 :: self.n_columns]]
+        if len(separators) == n_rows * self.n_columns - 1 and (row_ends == NEWLINE).all():
+            return n_rows
+
+        newlines = np.flatnonzero(is_newline)
+        commas = np.flatnonzero(buf == COMMA)
+        per_row = np.bincount(np.searchsorted(newlines, commas), minlength=n_rows)
+        bad = np.flatnonzero(per_row != self.n_columns - 1)
+        row = int(bad[0])
+        raise CsvParseError(
+            f"expected {self.n_columns} columns, got {per_row[row] + 1}"
+            + (f" ({len(bad)} malformed rows)" if len(bad) > 1 else ""),
+            row=row + 1,
+        )
+
+    def locate_error(self, flat: bytes) -> CsvParseError:
+        """Slow path, only taken for invalid payloads: find the first field that isn't a number."""
+        for index, token in enumerate(flat.split(b",")):
+            try:
+                np.array(token.strip() or b"nan").astype(self.dtype)
+                float(token)
+            except ValueError:
+                row, column = divmod(index, self.n_columns)
+                return CsvParseError(
+                    f"not a number: {token[:32]!r}", row=row + 1, column=column + 1
+                )
+        return CsvParseError("could not parse payload")
+
+
+def _shift_row(error: CsvParseError, offset: int) -> CsvParseError:
+    """Locate an error found in a block relative to the whole payload."""
+    if error.row is None or offset == 0:
+        return error
+    message = str(error).split(": ", 1)[-1]
+    return CsvParseError(message, row=error.row + offset, column=error.column)
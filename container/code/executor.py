@@ -0,0 +1,48 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from utils import *
+
+
+class InferenceExecutor:
+    """
+    A bounded pool of inference threads, shared by the request threads of a worker.
+
+    In the threaded server mode a worker has many request threads, which mostly wait on network
+    I/O and parse payloads. Running the model on all of them at once would oversubscribe the
+    cores, so they hand the scoring to this pool, sized to the cores given to the worker, and wait
+    for the result. NumPy and LightGBM release the GIL, so the pool threads run in parallel.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(int(max_workers), 1)
+        self.pool = None
+        self.pid = None  # the pool threads don't survive a fork, start a new pool in the worker
+        self.lock = threading.Lock()
+        self.in_flight = 0  # calls submitted and not finished, queued ones included
+
+    def run(self, fn, *args):
+        """Call fn(*args) on an inference thread, blocking until it returns."""
+        pool = self._ensure_started()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            # The stages the pool thread times go to the invocation of the calling thread, and
+            # nowhere for the warm-up
+            traces, paused = metrics.current_traces(), metrics.thread_paused()
+            return pool.submit(metrics.call_traced, traces, paused, fn, *args).result()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _ensure_started(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="inference")
+                    self.pid = os.getpid()
+                    self.in_flight = 0
+                    logger.info(f"Inference executor: {self.max_workers} threads")
+        return self.pool
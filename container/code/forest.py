@@ -0,0 +1,220 @@
+import math
+
+import numpy as np
+
+from shared import share_array
+from utils import *
+
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+MISSING_TYPES = {"None": MISSING_NONE, "Zero": MISSING_ZERO, "NaN": MISSING_NAN}
+ZERO_THRESHOLD = 1e-35  # LightGBM's kZeroThreshold
+ARRAYS = (
+    "feature",
+    "threshold",
+    "left",
+    "right",
+    "value",
+    "default_left",
+    "missing_type",
+    "roots",
+    "is_leaf",
+)
+
+
+class TreeEnsemble:
+    """
+    A LightGBM ensemble exported to flat NumPy arrays and evaluated a whole batch at a time.
+
+    All trees share one node table (feature, threshold, left/right child, leaf value). Every
+    (row, tree) pair of a batch is advanced one level per step with vectorized gathers, and pairs
+    that reached a leaf (leaves point to themselves) drop out of the next step.
+    """
+
+    block_rows = 2048  # rows evaluated together, bounds the (rows x trees) temporaries
+
+    def __init__(
+        self,
+        feature,
+        threshold,
+        left,
+        right,
+        value,
+        default_left,
+        missing_type,
+        roots,
+        depth,
+        n_features,
+        n_outputs,
+        classes,
+        sigmoid=1.0,
+        average_output=False,
+    ):
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+        self.left = np.ascontiguousarray(left, dtype=np.intp)
+        self.right = np.ascontiguousarray(right, dtype=np.intp)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.default_left = np.ascontiguousarray(default_left, dtype=bool)
+        self.missing_type = np.ascontiguousarray(missing_type, dtype=np.uint8)
+        self.roots = np.ascontiguousarray(roots, dtype=np.intp)
+        self.depth = int(depth)
+        self.n_features = int(n_features)
+        self.n_outputs = int(n_outputs)
+        self.classes = np.asarray(classes)
+        self.sigmoid = float(sigmoid)
+        self.average_output = bool(average_output)
+        self.is_leaf = self.left == np.arange(len(self.left))
+        self.has_zero_missing = bool((self.missing_type == MISSING_ZERO).any())
+
+    @classmethod
+    def from_booster(cls, booster, classes):
+        """Export a trained lightgbm.Booster (e.g. LGBMClassifier().booster_)."""
+        return cls.from_dump(booster.dump_model(), classes)
+
+    @classmethod
+    def from_dump(cls, dump: dict, classes):
+        """Build the node table from the JSON produced by Booster.dump_model()."""
+        columns = {
+            "feature": [],
+            "threshold": [],
+            "left": [],
+            "right": [],
+            "value": [],
+            "default_left": [],
+            "missing_type": [],
+        }
+        roots, depth = [], 0
+
+        for tree in dump["tree_info"]:
+            if tree.get("is_linear"):
+                raise ValueError("Linear trees are not supported")
+            roots.append(len(columns["feature"]))
+            stack = [(tree["tree_structure"], len(columns["feature"]), 0)]
+            _append_node(columns)
+            while stack:
+                node, index, level = stack.pop()
+                depth = max(depth, level)
+                if "leaf_value" in node:
+                    columns["left"][index] = columns["right"][index] = index
+                    columns["value"][index] = node["leaf_value"]
+                    continue
+                if node["decision_type"] != "<=":
+                    raise ValueError(f"Unsupported split: {node['decision_type']}")
+                columns["feature"][index] = node["split_feature"]
+                columns["threshold"][index] = node["threshold"]
+                columns["default_left"][index] = node["default_left"]
+                columns["missing_type"][index] = MISSING_TYPES[node["missing_type"]]
+                for side in ("left", "right"):
+                    child = len(columns["feature"])
+                    _append_node(columns)
+                    columns[side][index] = child
+                    stack.append((node[f"{side}_child"], child, level + 1))
+
+        objective = dump.get("objective", "")
+        sigmoid = 1.0
+        for token in objective.split():
+            if token.startswith("sigmoid:"):
+                sigmoid = float(token.split(":")[1])
+
+        return cls(
+            roots=roots,
+            depth=depth,
+            n_features=dump["max_feature_idx"] + 1,
+            n_outputs=dump["num_tree_per_iteration"],
+            classes=classes,
+            sigmoid=sigmoid,
+            average_output=dump.get("average_output", False),
+            **columns,
+        )
+
+    def share(self, directory):
+        """Move the node table to memory-mapped files shared by all workers (see shared.py)."""
+        for name in ARRAYS:
+            setattr(self, name, share_array(getattr(self, name), directory))
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def raw_score(self, X: np.ndarray) -> np.ndarray:
+        """Sum of leaf values per output, shape (n_rows, n_outputs)."""
+        X = np.ascontiguousarray(X)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got shape {X.shape}")
+        scores = np.empty((X.shape[0], self.n_outputs), dtype=np.float64)
+        for start in range(0, X.shape[0], self.block_rows):
+            block = X[start : start + self.block_rows]
+            scores[start : start + len(block)] = self._raw_score_block(block)
+        if self.average_output:
+            scores /= self.n_trees // self.n_outputs
+        return scores
+
+    def _raw_score_block(self, X):
+        n_rows = X.shape[0]
+        flat = X.ravel()
+        check_missing = self.has_zero_missing or bool(np.isnan(flat).any())
+
+        # One entry per (row, tree) pair; only pairs still on an internal node are advanced
+        node = np.tile(self.roots, n_rows)
+        offsets = np.repeat(np.arange(n_rows) * self.n_features, self.n_trees)
+        active = np.flatnonzero(~self.is_leaf.take(node))
+        while active.size:
+            current = node.take(active)
+            x = flat.take(offsets.take(active) + self.feature.take(current))
+            threshold = self.threshold.take(current)
+            if check_missing:
+                go_left = self._decide_missing(current, x, threshold)
+            else:
+                go_left = x <= threshold
+            current = np.where(go_left, self.left.take(current), self.right.take(current))
+            node[active] = current
+            active = active[~self.is_leaf.take(current)]
+
+        # Summed tree after tree like LightGBM, as sum() would add them pairwise
+        values = self.value.take(node).reshape(n_rows, -1, self.n_outputs)
+        return np.cumsum(values, axis=1)[:, -1]
+
+    def _decide_missing(self, node, x, threshold):
+        """LightGBM's NumericalDecision, including its missing value handling."""
+        missing_type = self.missing_type.take(node)
+        nan = np.isnan(x)
+        x = np.where(nan & (missing_type != MISSING_NAN), 0.0, x)
+        missing = ((missing_type == MISSING_ZERO) & (np.abs(x) <= ZERO_THRESHOLD)) | (
+            (missing_type == MISSING_NAN) & nan
+        )
+        return np.where(missing, self.default_left.take(node), x <= threshold)
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        raw = self.raw_score(X)
+        if self.n_outputs == 1:
+            positive = 1.0 / (1.0 + _exp(-self.sigmoid * raw[:, 0]))
+            return np.column_stack([1.0 - positive, positive])
+        # LightGBM's Softmax, summed class after class in the same order
+        proba = _exp(raw - raw.max(axis=1, keepdims=True))
+        total = proba[:, 0].copy()
+        for k in range(1, self.n_outputs):
+            total += proba[:, k]
+        proba /= total[:, None]
+        return proba
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        raw = self.raw_score(X)
+        if self.n_outputs == 1:
+            return self.classes[(raw[:, 0] > 0).astype(np.intp)]
+        return self.classes[raw.argmax(axis=1)]
+
+
+def _append_node(columns):
+    columns["feature"].append(0)
+    columns["threshold"].append(0.0)
+    columns["left"].append(0)
+    columns["right"].append(0)
+    columns["value"].append(0.0)
+    columns["default_left"].append(False)
+    columns["missing_type"].append(MISSING_NONE)
+
+
+def _exp(x: np.ndarray) -> np.ndarray:
+    """exp with the C library, as LightGBM computes it. The vectorized exp of NumPy may differ from
+    it in the last bit, which the probabilities would then do too."""
+    return np.fromiter(map(math.exp, x.ravel()), np.float64, x.size).reshape(x.shape)
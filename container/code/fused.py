@@ -0,0 +1,133 @@
+import hashlib
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from shared import share_array
+from utils import *
+
+
+class FusedPreprocessor:
+    """
+    The pycaret preprocessing chain folded into one column selection plus one affine transform.
+
+    With numeric_imputation="mean", normalize_method="zscore", tree-based feature selection,
+    multicollinearity removal and linear PCA, every stage is either a column selection or an
+    affine map. Composed, they reduce to
+        Z = impute(X[:, selected]) @ weight + bias
+    which is applied with a single matmul on contiguous float32 arrays.
+    """
+
+    # Preprocessors loaded in this process by content, see intern
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, n_inputs, selected, impute, weight, bias):
+        self.n_inputs = int(n_inputs)
+        self.selected = np.ascontiguousarray(selected, dtype=np.intp)
+        self.impute = np.ascontiguousarray(impute, dtype=np.float32)
+        self.weight = np.ascontiguousarray(weight, dtype=np.float32)
+        self.bias = np.ascontiguousarray(bias, dtype=np.float32)
+
+    @classmethod
+    def from_pipeline(cls, pipeline, n_features: int, rtol: float = 1e-4):
+        """Fold the transformer steps of a fitted pycaret pipeline.
+
+        The chain is probed with the zero row, the unit rows and rows holding a single NaN, which
+        is enough to recover the bias, the fused matrix and the imputation vector. The result is
+        then checked against the pipeline on random rows; a ValueError is raised when the chain
+        turns out not to be affine (e.g. categorical features were one-hot encoded)."""
+        steps = pipeline[:-1]
+
+        probe = np.zeros((2 * n_features + 1, n_features), dtype=np.float64)
+        probe[1 : n_features + 1] = np.eye(n_features)
+        probe[n_features + 1 :][np.diag_indices(n_features)] = np.nan
+        out = _transform(steps, probe)
+
+        bias = out[0]
+        weight = out[1 : n_features + 1] - bias
+        imputed = out[n_features + 1 :] - bias
+
+        scale = max(np.abs(weight).max(), 1.0)
+        selected = np.flatnonzero(np.abs(weight).max(axis=1) > scale * 1e-12)
+        weight = weight[selected]
+        norm = np.einsum("ij,ij->i", weight, weight)
+        impute = np.einsum("ij,ij->i", imputed[selected], weight) / norm
+
+        fused = cls(n_features, selected, impute, weight, bias)
+        fused.verify(steps, rtol=rtol)
+        logger.info(
+            f"Fused preprocessing: {n_features} inputs, {len(selected)} selected, "
+            f"{fused.weight.shape[1]} outputs"
+        )
+        return fused
+
+    def verify(self, steps, n_rows: int = 64, rtol: float = 1e-4, seed: int = 17):
+        """Compare the fused transform with the pipeline steps on random rows with missing values."""
+        rng = np.random.default_rng(seed)
+        scale = np.ones(self.n_inputs)
+        scale[self.selected] = np.maximum(np.abs(self.impute), 1.0)
+        X = rng.normal(size=(n_rows, self.n_inputs)) * scale
+        X[rng.random(X.shape) < 0.05] = np.nan
+
+        expected = _transform(steps, X)
+        actual = self.transform(X)
+        error = np.abs(actual - expected).max() / max(np.abs(expected).max(), 1.0)
+        if not error <= rtol:
+            raise ValueError(
+                f"Fused preprocessing deviates from the pipeline: {error:.3g} > {rtol}"
+            )
+        return error
+
+    def save(self, path):
+        """Write the arrays to an .npz file, which load() reads without pycaret."""
+        np.savez(
+            path,
+            n_inputs=self.n_inputs,
+            selected=self.selected,
+            impute=self.impute,
+            weight=self.weight,
+            bias=self.bias,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def intern(self):
+        """The preprocessor with the same arrays already loaded in this process, else this one.
+
+        Models that share their preprocessing (variants of one pipeline, segments trained on the
+        same features) then hold a single copy of it."""
+        digest = hashlib.sha1(str(self.n_inputs).encode())
+        for name in ("selected", "impute", "weight", "bias"):
+            array = getattr(self, name)
+            digest.update(f"{name}:{array.shape};".encode())
+            digest.update(array.tobytes())
+        return FusedPreprocessor._interned.setdefault(digest.hexdigest(), self)
+
+    def share(self, directory):
+        """Move the arrays to memory-mapped files shared by all workers (see shared.py)."""
+        for name in ("selected", "impute", "weight", "bias"):
+            setattr(self, name, share_array(getattr(self, name), directory))
+
+    def transform(self, X: np.ndarray) -> np.ndarray:
+        """Apply imputation, scaling, selection and projection to a 2D array of raw features."""
+        X = np.asarray(X, dtype=np.float32)[:, self.selected]
+        missing = np.isnan(X)
+        if missing.any():
+            np.copyto(X, np.broadcast_to(self.impute, X.shape), where=missing)
+        if len(X) == 1:
+            # NumPy multiplies a single row with a matrix-vector product, which rounds its sums
+            # differently from the matrix product of a batch: a row scores the same in any batch
+            Z = (np.concatenate([X, X]) @ self.weight)[:1]
+        else:
+            Z = X @ self.weight
+        Z += self.bias
+        return Z
+
+
+def _transform(steps, X: np.ndarray) -> np.ndarray:
+    out = steps.transform(pd.DataFrame(X))
+    return np.asarray(out, dtype=np.float64)
@@ -0,0 +1,47 @@
+# gunicorn server hooks, loaded by serve with -c. The settings themselves are passed by serve on
+# the command line.
+
+import os
+
+from autotune import available_cores, worker_cores
+
+pin_workers = os.environ.get("MODEL_SERVER_PIN_WORKERS", "false").lower() == "true"
+
+
+def pre_fork(server, worker):
+    """In the master: give the new worker the lowest core slot that no live worker holds, so that
+    a worker restarted after a crash or a timeout takes over the cores of the one it replaces."""
+    if pin_workers:
+        used = {getattr(w, "core_slot", None) for w in server.WORKERS.values()}
+        free = [slot for slot in range(server.num_workers) if slot not in used]
+        worker.core_slot = free[0] if free else len(used) % server.num_workers
+
+
+def post_fork(server, worker):
+    """In the worker: pin it to its share of the cores, before it loads or runs the model."""
+    if pin_workers:
+        cores = worker_cores(worker.core_slot, server.num_workers, available_cores())
+        os.sched_setaffinity(0, cores)
+        server.log.info(f"Worker {worker.pid} pinned to cores {cores}")
+
+
+def post_worker_init(worker):
+    """In the worker, once the app is loaded: start loading and warming up the model, /ping
+    answers 503 until it's done (see ScoringService.warm_up), and start watching for reloads."""
+    import predictor
+
+    predictor.ScoringService.get_recycler()  # as the worker starts, see Recycler.warm
+    if predictor.ServeConfig.WARMUP:
+        predictor.ScoringService.start_warm_up()
+    predictor.ScoringService.start_reload_watch()
+
+
+def post_request(worker, req, environ, resp):
+    """In the worker, after each request: stop the worker once the request is answered if it grew
+    past its memory limit or answered its requests, for gunicorn to start a fresh one (see
+    recycling.py). Requests accepted already are answered first. Only invocations count towards
+    the requests of a worker, not the health checks or the /metrics scrapes."""
+    import predictor
+
+    if predictor.ScoringService.recycle_reason(req.path == "/invocations") is not None:
+        worker.alive = False
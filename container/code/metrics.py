@@ -0,0 +1,504 @@
+import bisect
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from shared import open_shared_table
+from utils import *
+
+# Stages of an invocation. preprocess and predict split the model call where the backend runs the
+# preprocessing on its own (the fused preprocessing), otherwise predict is the whole call.
+# request is the whole invocation, from the handler being called to the response being sent.
+# queue is the wait before it, from nginx receiving the request (see admission.queue_seconds).
+STAGES = ("queue", "read", "parse", "preprocess", "predict", "serialize", "request")
+STAGE_INDEX = {stage: i for i, stage in enumerate(STAGES)}
+SECONDS_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BOUNDS = (1, 10, 100, 1000, 10000, 100000)
+# Rows per micro-batch and the wait of its invocations for it, see batching.MicroBatcher
+BATCH_ROWS_BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+BATCH_WAIT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)
+MAX_WORKERS = 256
+# Why invocations are turned away by a worker, see admission.AdmissionControl
+SHED_REASONS = ("queue_time", "worker_limit")
+# Why workers are replaced, see recycling.Recycler
+RECYCLE_REASONS = ("memory", "requests")
+# Rows looked up in the prediction cache, see cache.PredictionCache
+CACHE_RESULTS = ("hit", "duplicate", "miss")
+
+# Slot of one worker in the shared table, bucket i of a histogram counts the observations
+# <= bounds[i] and the last one the rest
+SLOT = np.dtype(
+    [
+        ("pid", "<i8"),
+        ("in_flight", "<i8"),
+        ("seconds", "<u8", (len(STAGES), len(SECONDS_BOUNDS) + 1)),
+        ("seconds_sum", "<f8", (len(STAGES),)),
+        ("rows", "<u8", (len(ROWS_BOUNDS) + 1,)),
+        ("rows_sum", "<f8"),
+        ("version", "<u8"),  # of the worker's default model, see set_version
+        ("reloads", "<u8", (2,)),  # succeeded, failed
+        ("reload_seconds", "<f8"),
+        ("shed", "<u8", (len(SHED_REASONS),)),
+        ("memory", "<u8", (2,)),  # resident and anonymous bytes, after the last request
+        ("recycles", "<u8", (len(RECYCLE_REASONS),)),
+        ("batch_rows", "<u8", (len(BATCH_ROWS_BOUNDS) + 1,)),
+        ("batch_rows_sum", "<f8"),
+        ("batch_wait", "<u8", (len(BATCH_WAIT_BOUNDS) + 1,)),
+        ("batch_wait_sum", "<f8"),
+        ("cache", "<u8", (len(CACHE_RESULTS),)),
+    ]
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Recorder:
+    """
+    Writes the observations of this worker to its slot of a table shared by the workers.
+
+    A worker is the only writer of its slot, so the workers never wait on each other and /metrics
+    sums the slots when it's scraped. The lock only orders the threads of a worker (threaded mode,
+    micro-batching) and costs next to nothing uncontended. The slot of a worker that exited is
+    taken over by the next one to start, counts included, so the counters never go back.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.table = open_shared_table(self.path, SLOT, (MAX_WORKERS,))
+        self.pid = os.getpid()
+        self.index = self._claim()
+        self.lock = threading.Lock()
+        # Views of the slot's fields, indexing them is much cheaper than going through the records
+        slot = np.asarray(self.table[self.index : self.index + 1])  # not a memmap, faster
+        self.seconds = slot["seconds"][0]
+        self.seconds_sum = slot["seconds_sum"][0]
+        self.rows = slot["rows"][0]
+        self.rows_sum = slot["rows_sum"]
+        self.in_flight = slot["in_flight"]
+        self.version = slot["version"]
+        self.reloads = slot["reloads"][0]
+        self.reload_seconds = slot["reload_seconds"]
+        self.shed = slot["shed"][0]
+        self.memory = slot["memory"][0]
+        self.recycles = slot["recycles"][0]
+        self.batch_rows = slot["batch_rows"][0]
+        self.batch_rows_sum = slot["batch_rows_sum"]
+        self.batch_wait = slot["batch_wait"][0]
+        self.batch_wait_sum = slot["batch_wait_sum"]
+        self.cache = slot["cache"][0]
+        self.version[0] = _version
+
+    def _claim(self) -> int:
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # held only while claiming a slot
+            pids = self.table["pid"]
+            for index, pid in enumerate(pids.tolist()):
+                if pid == 0 or not process_alive(pid):
+                    pids[index] = self.pid
+                    self.table["in_flight"][index] = 0
+                    self.table["memory"][index] = 0
+                    return index
+        raise RuntimeError(f"All the {MAX_WORKERS} slots of {self.path} are taken")
+
+    def observe(self, stage: str, seconds: float):
+        i = STAGE_INDEX[stage]
+        bucket = bisect.bisect_left(SECONDS_BOUNDS, seconds)
+        with self.lock:
+            self.seconds[i, bucket] += 1
+            self.seconds_sum[i] += seconds
+
+    def observe_rows(self, n_rows: int):
+        bucket = bisect.bisect_left(ROWS_BOUNDS, n_rows)
+        with self.lock:
+            self.rows[bucket] += 1
+            self.rows_sum[0] += n_rows
+
+    def add_in_flight(self, n: int):
+        with self.lock:
+            self.in_flight[0] += n
+
+    def observe_reload(self, seconds: float, succeeded: bool):
+        with self.lock:
+            self.reloads[0 if succeeded else 1] += 1
+            self.reload_seconds[0] += seconds
+
+    def observe_shed(self, reason: str):
+        with self.lock:
+            self.shed[SHED_REASONS.index(reason)] += 1
+
+    def observe_memory(self, resident: int, anonymous: int):
+        self.memory[0], self.memory[1] = resident, anonymous
+
+    def observe_recycle(self, reason: str):
+        with self.lock:
+            self.recycles[RECYCLE_REASONS.index(reason)] += 1
+
+    def observe_batch(self, n_rows: int, waits):
+        bucket = bisect.bisect_left(BATCH_ROWS_BOUNDS, n_rows)
+        with self.lock:
+            self.batch_rows[bucket] += 1
+            self.batch_rows_sum[0] += n_rows
+            for seconds in waits:
+                self.batch_wait[bisect.bisect_left(BATCH_WAIT_BOUNDS, seconds)] += 1
+                self.batch_wait_sum[0] += seconds
+
+    def observe_cache(self, hits: int, duplicates: int, misses: int):
+        with self.lock:
+            self.cache[0] += hits
+            self.cache[1] += duplicates
+            self.cache[2] += misses
+
+
+class Trace:
+    """The stages of one invocation, timed by whichever thread runs them (see traced), for its
+    Server-Timing header and its span log. The stages of a streamed payload add up its blocks."""
+
+    __slots__ = ("trace_id", "started", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.started = time.perf_counter()
+        self.spans = {}  # seconds per stage
+
+    def add(self, stage: str, seconds: float):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def timings(self) -> dict:
+        """The spans so far in ms, total being the time since the worker got the invocation, which
+        the queue comes before."""
+        timings = {
+            stage: round(self.spans[stage] * 1000, 3)
+            for stage in STAGES
+            if stage in self.spans and stage != "request"
+        }
+        timings["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return timings
+
+
+class Request:
+    """The timing of one invocation, finished once its response is sent. Nothing is recorded
+    without a recorder, when metrics are disabled."""
+
+    __slots__ = ("recorder", "started", "rows", "trace")
+
+    def __init__(self, recorder: Recorder = None, trace: Trace = None):
+        self.recorder = recorder
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.trace = trace
+        if recorder is not None:
+            recorder.add_in_flight(1)
+
+    def finish(self):
+        seconds = time.perf_counter() - self.started
+        if self.trace is not None:
+            self.trace.add("request", seconds)
+        if self.recorder is None:
+            return
+        self.recorder.observe("request", seconds)
+        self.recorder.observe_rows(self.rows)
+        self.recorder.add_in_flight(-1)
+
+
+class Histogram:
+    """Counts of observations per bucket, bucket i holding values <= bounds[i] (last one: +Inf),
+    for the statistics a worker keeps to itself rather than in the shared table."""
+
+    def __init__(self, bounds):
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.counts = np.zeros(len(bounds) + 1, dtype=np.int64)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def summary(self):
+        labels = [f"<={b:g}" for b in self.bounds] + ["+Inf"]
+        buckets = " ".join(f"{l}:{c}" for l, c in zip(labels, self.counts) if c)
+        mean = self.sum / max(self.count, 1)
+        return f"count={self.count} mean={mean:.3g} {buckets}"
+
+
+_recorder = None
+_thread = threading.local()
+_working = {}  # thread id -> its traces, while it has some (see traced)
+_version = 0
+
+
+def start(directory: Path) -> Recorder:
+    """Get the recorder of this worker, claiming its slot on first use.
+
+    The table is named after the gunicorn master, the parent of the workers, so that every
+    server starts from zero. Until a worker calls this, its observations are dropped, which keeps
+    the warm-up out of the histograms."""
+    global _recorder
+    if _recorder is None or _recorder.pid != os.getpid():
+        directory = Path(directory)
+        path = directory / f"metrics-{os.getppid()}.npy"
+        for stale in directory.glob("metrics-*.npy"):
+            pid = stale.stem.split("-")[1]
+            if stale != path and pid.isdigit() and not process_alive(int(pid)):
+                stale.unlink(missing_ok=True)
+        _recorder = Recorder(path)
+        logger.info(f"Metrics of worker {os.getpid()}: slot {_recorder.index} of {path}")
+    return _recorder
+
+
+def observe(stage: str, seconds: float):
+    """Record the duration of a stage, if this worker records metrics, and add it to the traces
+    of the calling thread."""
+    if getattr(_thread, "paused", False):
+        return
+    for trace in getattr(_thread, "traces", ()):
+        trace.add(stage, seconds)
+    recorder = _recorder
+    if recorder is None or recorder.pid != os.getpid():
+        return
+    recorder.observe(stage, seconds)
+
+
+@contextmanager
+def traced(*traces: Trace):
+    """Add the stages the calling thread times to traces, the invocation it works for or, for a
+    thread scoring for other threads, theirs (see current_traces)."""
+    previous = getattr(_thread, "traces", ())
+    _thread.traces = previous + traces
+    ident = threading.get_ident()
+    _working[ident] = _thread.traces
+    try:
+        yield
+    finally:
+        _thread.traces = previous
+        if previous:
+            _working[ident] = previous
+        else:
+            _working.pop(ident, None)
+
+
+def working_threads(trace: Trace) -> list:
+    """The ids of the threads timing stages for trace, read from any thread (see profiler.py)."""
+    return [ident for ident, traces in list(_working.items()) if trace in traces]
+
+
+def current_traces() -> tuple:
+    """The traces of the calling thread, for the thread it hands work to (see traced)."""
+    return getattr(_thread, "traces", ())
+
+
+def call_traced(traces: tuple, was_paused: bool, fn, *args):
+    """Call fn for a thread with traces, which may be paused (see thread_paused)."""
+    with paused() if was_paused else traced(*traces):
+        return fn(*args)
+
+
+def thread_paused() -> bool:
+    """Whether the calling thread records the stages it times, see pause_thread."""
+    return getattr(_thread, "paused", False)
+
+
+def pause_thread():
+    """Stop recording the stages timed by the calling thread, which works for no invocation."""
+    _thread.paused = True
+
+
+@contextmanager
+def paused():
+    """Don't record the stages timed by the calling thread while it does work of its own."""
+    was_paused = getattr(_thread, "paused", False)
+    _thread.paused = True
+    try:
+        yield
+    finally:
+        _thread.paused = was_paused
+
+
+def set_version(version: str):
+    """Record the version of the default model this worker serves (see backends.model_version)."""
+    global _version
+    _version = int(version, 16) if version else 0
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.version[0] = _version
+
+
+def observe_reload(seconds: float, succeeded: bool):
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.observe_reload(seconds, succeeded)
+
+
+def observe_shed(reason: str):
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.observe_shed(reason)
+
+
+def observe_memory(resident: int, anonymous: int):
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.observe_memory(resident, anonymous)
+
+
+def observe_recycle(reason: str):
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.observe_recycle(reason)
+
+
+def observe_batch(n_rows: int, waits):
+    """Record a micro-batch of n_rows and the wait in seconds of each invocation in it."""
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.observe_batch(n_rows, waits)
+
+
+def observe_cache(hits: int, duplicates: int, misses: int):
+    """Record the rows of an invocation found in the prediction cache, repeated within it or
+    scored."""
+    recorder = _recorder
+    if recorder is not None and recorder.pid == os.getpid():
+        recorder.observe_cache(hits, duplicates, misses)
+
+
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def render(table: np.ndarray, nginx_active: int = None) -> str:
+    """The metrics of all the workers, in the Prometheus text format.
+
+    nginx_active is the number of requests nginx is handling (see admission.nginx_active_requests),
+    those not in a worker are waiting for one. Without it, the queue depth isn't reported."""
+    live = np.array([pid != 0 and process_alive(pid) for pid in table["pid"].tolist()])
+    seconds = table["seconds"].sum(axis=0)
+    seconds_sum = table["seconds_sum"].sum(axis=0)
+    request = STAGE_INDEX["request"]
+
+    lines = [
+        "# HELP model_server_request_seconds Time to handle an invocation, until it's answered",
+        "# TYPE model_server_request_seconds histogram",
+    ]
+    name = "model_server_request_seconds"
+    _histogram(lines, name, "", SECONDS_BOUNDS, seconds[request], seconds_sum[request])
+    lines += [
+        "# HELP model_server_stage_seconds Time spent in each stage of an invocation",
+        "# TYPE model_server_stage_seconds histogram",
+    ]
+    for stage in STAGES:
+        if stage != "request":
+            i = STAGE_INDEX[stage]
+            labels = f'stage="{stage}"'
+            name = "model_server_stage_seconds"
+            _histogram(lines, name, labels, SECONDS_BOUNDS, seconds[i], seconds_sum[i])
+    lines += [
+        "# HELP model_server_request_rows Rows per invocation",
+        "# TYPE model_server_request_rows histogram",
+    ]
+    rows, rows_sum = table["rows"].sum(axis=0), table["rows_sum"].sum()
+    _histogram(lines, "model_server_request_rows", "", ROWS_BOUNDS, rows, rows_sum)
+    lines += [
+        "# HELP model_server_batch_rows Rows per micro-batch, scored with one model call",
+        "# TYPE model_server_batch_rows histogram",
+    ]
+    rows, rows_sum = table["batch_rows"].sum(axis=0), table["batch_rows_sum"].sum()
+    _histogram(lines, "model_server_batch_rows", "", BATCH_ROWS_BOUNDS, rows, rows_sum)
+    lines += [
+        "# HELP model_server_batch_wait_seconds Time invocations waited for their micro-batch",
+        "# TYPE model_server_batch_wait_seconds histogram",
+    ]
+    waits, waits_sum = table["batch_wait"].sum(axis=0), table["batch_wait_sum"].sum()
+    _histogram(lines, "model_server_batch_wait_seconds", "", BATCH_WAIT_BOUNDS, waits, waits_sum)
+    in_flight = int(table["in_flight"][live].sum())
+    lines += [
+        "# HELP model_server_requests_in_flight Invocations being handled",
+        "# TYPE model_server_requests_in_flight gauge",
+        f"model_server_requests_in_flight {in_flight}",
+        "# HELP model_server_workers Running workers that have recorded metrics",
+        "# TYPE model_server_workers gauge",
+        f"model_server_workers {int(live.sum())}",
+        "# HELP model_server_model_version Running workers per version of the default model",
+        "# TYPE model_server_model_version gauge",
+    ]
+    versions, counts = np.unique(
+        table["version"][live & (table["version"] != 0)], return_counts=True
+    )
+    for version, count in zip(versions.tolist(), counts.tolist()):
+        lines.append(f'model_server_model_version{{version="{version:012x}"}} {count}')
+    reloads = table["reloads"].sum(axis=0).tolist()
+    lines += [
+        "# HELP model_server_reloads_total Reloads of the default model by the workers",
+        "# TYPE model_server_reloads_total counter",
+        f'model_server_reloads_total{{result="succeeded"}} {reloads[0]}',
+        f'model_server_reloads_total{{result="failed"}} {reloads[1]}',
+        "# HELP model_server_reload_seconds_total Time spent reloading the default model",
+        "# TYPE model_server_reload_seconds_total counter",
+        f"model_server_reload_seconds_total {float(table['reload_seconds'].sum())!r}",
+        "# HELP model_server_shed_total Invocations turned away by the workers, per reason",
+        "# TYPE model_server_shed_total counter",
+    ]
+    shed = table["shed"].sum(axis=0).tolist()
+    for reason, count in zip(SHED_REASONS, shed):
+        lines.append(f'model_server_shed_total{{reason="{reason}"}} {count}')
+    lines += [
+        "# HELP model_server_worker_memory_bytes Memory of each running worker (by slot), "
+        "resident and not backed by files or shared memory",
+        "# TYPE model_server_worker_memory_bytes gauge",
+    ]
+    for index in np.flatnonzero(live & (table["memory"][:, 0] != 0)).tolist():
+        resident, anonymous = table["memory"][index].tolist()
+        lines.append(
+            f'model_server_worker_memory_bytes{{worker="{index}",kind="resident"}} {resident}'
+        )
+        lines.append(
+            f'model_server_worker_memory_bytes{{worker="{index}",kind="anonymous"}} {anonymous}'
+        )
+    lines += [
+        "# HELP model_server_worker_recycles_total Workers replaced, per reason",
+        "# TYPE model_server_worker_recycles_total counter",
+    ]
+    recycles = table["recycles"].sum(axis=0).tolist()
+    for reason, count in zip(RECYCLE_REASONS, recycles):
+        lines.append(f'model_server_worker_recycles_total{{reason="{reason}"}} {count}')
+    lines += [
+        "# HELP model_server_prediction_cache_total Rows looked up in the prediction cache: "
+        "found, repeated within their invocation or scored",
+        "# TYPE model_server_prediction_cache_total counter",
+    ]
+    cache = table["cache"].sum(axis=0).tolist()
+    for result, count in zip(CACHE_RESULTS, cache):
+        lines.append(f'model_server_prediction_cache_total{{result="{result}"}} {count}')
+    if nginx_active is not None:
+        # Less this scrape, which nginx counts twice: /metrics and the status page it reads
+        queued = max(nginx_active - 2 - in_flight, 0)
+        lines += [
+            "# HELP model_server_queue_depth Requests received by nginx and waiting for a worker",
+            "# TYPE model_server_queue_depth gauge",
+            f"model_server_queue_depth {queued}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def _histogram(lines, name, labels, bounds, counts, total):
+    """Append the series of a histogram, with cumulative buckets as Prometheus wants them."""
+    prefix = f"{labels}," if labels else ""
+    suffix = f"{{{labels}}}" if labels else ""
+    cumulative = np.cumsum(counts).tolist()
+    for bound, count in zip([f"{b:g}" for b in bounds] + ["+Inf"], cumulative):
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+    lines.append(f"{name}_sum{suffix} {float(total)!r}")
+    lines.append(f"{name}_count{suffix} {cumulative[-1]}")
@@ -0,0 +1,114 @@
+import gc
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from utils import *
+
+# Model names are subdirectory names, nothing that could leave the models directory
+MODEL_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+class ModelNotFound(LookupError):
+    pass
+
+
+class LoadedModel:
+    __slots__ = ("name", "backend", "parser", "load_seconds", "memory_mb", "last_used")
+
+    def __init__(self, name, backend, parser, load_seconds, memory_mb):
+        self.name = name
+        self.backend = backend
+        self.parser = parser  # CSV parser of the model's schema, None without a schema
+        self.load_seconds = load_seconds
+        self.memory_mb = memory_mb
+        self.last_used = time.time()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "version": self.backend.version,
+            "load_seconds": round(self.load_seconds, 3),
+            "memory_mb": round(self.memory_mb, 1),
+            "last_used": self.last_used,
+        }
+
+
+class ModelCache:
+    """
+    The models of a worker, loaded on first use and evicted least recently used first once their
+    memory adds up to more than max_memory_mb.
+
+    Each model has its own load lock: the requests for a model being loaded wait for it, while
+    the requests for the models already loaded only take the cache lock for a dictionary lookup.
+    The memory of a model is the growth of the worker's resident memory while it loaded, an
+    estimate when several models load at once.
+    """
+
+    def __init__(self, load, max_memory_mb: float):
+        self.load = load  # name -> (backends.Backend, parser)
+        self.max_memory_mb = max_memory_mb
+        self.entries = OrderedDict()  # name -> LoadedModel, least recently used first
+        self.load_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> LoadedModel:
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                self.entries.move_to_end(name)
+                entry.last_used = time.time()
+                return entry
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                entry = self.entries.get(name)  # loaded by the request we waited for
+            if entry is None:
+                entry = self._load(name)
+                with self.lock:
+                    self.entries[name] = entry
+                    evicted = self._evict(keep=name)
+                for old in evicted:
+                    logger.info(f"Model {old.name} evicted, {old.memory_mb:.0f}MB")
+                if evicted:
+                    gc.collect()
+        return entry
+
+    def _load(self, name: str) -> LoadedModel:
+        if not MODEL_NAME.fullmatch(name):
+            raise ModelNotFound(f"Invalid model name {name!r}")
+        rss = memory_usage()["Rss"]
+        started = time.perf_counter()
+        backend, parser = self.load(name)
+        load_seconds = time.perf_counter() - started
+        memory_mb = max(memory_usage()["Rss"] - rss, 0.0)
+        logger.info(
+            f"Model {name} loaded in {load_seconds:.2f}s, {memory_mb:.0f}MB, "
+            f"worker {os.getpid()}"
+        )
+        return LoadedModel(name, backend, parser, load_seconds, memory_mb)
+
+    def _evict(self, keep: str) -> list:
+        evicted = []
+        while self.memory_mb() > self.max_memory_mb and len(self.entries) > 1:
+            name = next(iter(self.entries))
+            if name == keep:
+                break
+            evicted.append(self.entries.pop(name))
+            self.load_locks.pop(name, None)
+        return evicted
+
+    def memory_mb(self) -> float:
+        return sum(entry.memory_mb for entry in self.entries.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            models = [entry.stats() for entry in self.entries.values()]
+        return {
+            "max_memory_mb": self.max_memory_mb,
+            "memory_mb": round(sum(model["memory_mb"] for model in models), 1),
+            "models": models,
+        }
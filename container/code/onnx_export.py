@@ -0,0 +1,65 @@
+from pathlib import Path
+
+import numpy as np
+
+from fused import FusedPreprocessor
+from utils import *
+
+INPUT_NAME = "input"
+
+
+def export_onnx(pipeline, n_features: int, path: Path):
+    """Export a fitted pycaret pipeline (fused preprocessing + LightGBM) as one ONNX graph.
+
+    pycaret's transformers have no ONNX converters, so the preprocessing goes in as its fused form
+    (Gather, IsNaN/Where imputation, MatMul, Add) in front of the graph that onnxmltools builds for
+    the estimator. The graph takes float32 rows of raw features and outputs "label" and
+    "probabilities"."""
+    import onnx
+    import onnxmltools
+    from onnx import helper, numpy_helper, TensorProto
+    from onnxmltools.convert.common.data_types import FloatTensorType
+
+    fused = FusedPreprocessor.from_pipeline(pipeline, n_features)
+    estimator = pipeline.steps[-1][1]
+    n_components = fused.weight.shape[1]
+
+    model = onnxmltools.convert_lightgbm(
+        estimator,
+        initial_types=[("features", FloatTensorType([None, n_components]))],
+        zipmap=False,
+    )
+    graph = model.graph
+
+    initializers = [
+        numpy_helper.from_array(fused.selected.astype(np.int64), "fused_selected"),
+        numpy_helper.from_array(fused.impute, "fused_impute"),
+        numpy_helper.from_array(fused.weight, "fused_weight"),
+        numpy_helper.from_array(fused.bias, "fused_bias"),
+    ]
+    nodes = [
+        helper.make_node("Gather", [INPUT_NAME, "fused_selected"], ["selected"], axis=1),
+        helper.make_node("IsNaN", ["selected"], ["missing"]),
+        helper.make_node("Where", ["missing", "fused_impute", "selected"], ["imputed"]),
+        helper.make_node("MatMul", ["imputed", "fused_weight"], ["projected"]),
+        helper.make_node("Add", ["projected", "fused_bias"], ["features"]),
+    ]
+
+    graph.initializer.extend(initializers)
+    existing = list(graph.node)
+    del graph.node[:]
+    graph.node.extend(nodes + existing)
+    del graph.input[:]
+    graph.input.append(
+        helper.make_tensor_value_info(INPUT_NAME, TensorProto.FLOAT, ["N", n_features])
+    )
+    for output in graph.output:
+        output.type.tensor_type.shape.dim[0].dim_param = "N"  # one label per input row
+    for opset in model.opset_import:
+        if opset.domain in ("", "ai.onnx") and opset.version < 9:
+            opset.version = 9  # IsNaN and Where
+
+    onnx.checker.check_model(model)
+    onnx.save(model, Path(path).as_posix())
+    logger.info(f"ONNX model saved to {path}")
+    return model
@@ -1,26 +1,167 @@
+import gc
+import hmac
 import io
+import itertools
+import json
+import os
 import pickle
+import re
+import threading
+import time
+import uuid
 from pathlib import Path
 
 import flask
 import numpy as np
 import pandas as pd
-from pycaret.regression import load_model, predict_model, load_config
 
+import metrics
+
+from admission import AdmissionControl, nginx_active_requests
+from autotune import calibration_rows
+from backends import load_backend, model_version
+from batching import MicroBatcher
+from cache import PredictionCache
+from challenger import Challenger
+from compression import (
+    ENCODINGS,
+    IDENTITY,
+    PayloadTooLarge,
+    UnsupportedEncoding,
+    compress,
+    compressor,
+    content_encoding,
+    decompress,
+    decompressing_reader,
+)
+from executor import InferenceExecutor
+from content_types import (
+    CSV,
+    DESERIALIZERS,
+    JSONLINES,
+    SERIALIZERS,
+    UnsupportedContentType,
+    deserialize,
+    format_custom_attributes,
+    negotiate,
+    parse_custom_attributes,
+    serialize,
+)
+from csv_parser import CsvParser
+from metrics import timed
+from models import ModelCache, ModelNotFound
+from profiler import Profiler
+from recycling import Recycler
+from schema import load_sample, load_schema
+from shared import group_directory, shared_arrays, shared_words, unlink_unmapped
 from utils import *
 
 
 class ServeConfig:
     OPT_ML_DIR = Path("/opt/ml")
-    MODEL_DIR = OPT_ML_DIR / "model"
+    # Models selected with the model custom attribute (model=<name>) are the subdirectories of
+    # MODELS_DIR, held in a cache of MODEL_CACHE_MB per worker (see models.py). Requests without
+    # it get the model of MODEL_DIR, which is the subdirectory DEFAULT_MODEL if set. The models
+    # selected by name need another backend than pycaret (see load_backend)
+    MODELS_DIR = Path(os.environ.get("MODEL_SERVER_MODELS_DIR", OPT_ML_DIR / "model"))
+    DEFAULT_MODEL = os.environ.get("MODEL_SERVER_DEFAULT_MODEL", "")
+    MODEL_DIR = MODELS_DIR / DEFAULT_MODEL if DEFAULT_MODEL else OPT_ML_DIR / "model"
+    MODEL_CACHE_MB = float(os.environ.get("MODEL_SERVER_MODEL_CACHE_MB", 2048))
+    # A model of MODELS_DIR that also scores the requests of the default model, off the response
+    # path, to compare with it (see challenger.py). Its statistics go to CHALLENGER_DIR
+    CHALLENGER = os.environ.get("MODEL_SERVER_CHALLENGER", "")
+    CHALLENGER_DIR = Path(os.environ.get("MODEL_SERVER_CHALLENGER_DIR", "/tmp/challenger"))
+    CHALLENGER_MAX_PENDING = int(os.environ.get("MODEL_SERVER_CHALLENGER_MAX_PENDING", 8))
+    # Reload the default model when the version of MODEL_DIR changes, besides on /admin/reload.
+    # Both are checked every RELOAD_POLL_SECONDS by a thread of each worker
+    RELOAD_WATCH = os.environ.get("MODEL_SERVER_RELOAD_WATCH", "false").lower() == "true"
+    RELOAD_POLL_SECONDS = float(os.environ.get("MODEL_SERVER_RELOAD_POLL_SECONDS", 2))
 
     ASSETS_PATH = Path("./assets")
     ASSETS_PATH.mkdir(parents=True, exist_ok=True)
 
-
-logger.info(f"Pycaret load_config")
-config_path = ServeConfig.MODEL_DIR / "final-config"
-load_config(config_path.as_posix())
+    # Inference runtime, see backends.py. Set by serve from MODEL_SERVER_BACKEND
+    BACKEND = os.environ.get("MODEL_SERVER_BACKEND", "pycaret")
+    # Score through the folded preprocessing instead of predict_model (see fused.py)
+    FUSED_PREPROCESSING = (
+        os.environ.get("MODEL_SERVER_FUSED_PREPROCESSING", "true").lower() == "true"
+    )
+    # Load the model in the gunicorn master before forking (serve adds --preload)
+    PRELOAD = os.environ.get("MODEL_SERVER_PRELOAD", "false").lower() == "true"
+    # Memory-mapped model arrays and tables, shared by all workers. By default a directory of the
+    # process group of the server in /dev/shm, see shared.group_directory
+    SHARED_DIR = Path(os.environ.get("MODEL_SERVER_SHARED_DIR", group_directory()))
+    # Score rows of concurrent requests together (see batching.py)
+    BATCHING = os.environ.get("MODEL_SERVER_BATCHING", "false").lower() == "true"
+    BATCH_MAX_ROWS = int(os.environ.get("MODEL_SERVER_BATCH_MAX_ROWS", 256))
+    BATCH_MAX_WAIT_MS = float(os.environ.get("MODEL_SERVER_BATCH_MAX_WAIT_MS", 2))
+    # sync: one request at a time per worker. threaded: many request threads per worker, which
+    # hand the scoring to a pool of INFERENCE_THREADS threads (see executor.py). Set by serve
+    MODE = os.environ.get("MODEL_SERVER_MODE", "sync").lower()
+    INFERENCE_THREADS = int(os.environ.get("MODEL_SERVER_INFERENCE_THREADS", os.cpu_count()))
+    # OpenMP threads of one model call, serve sizes it so that the workers don't oversubscribe
+    # the cores (see autotune.py)
+    INTRA_OP_THREADS = int(os.environ.get("MODEL_SERVER_INTRA_OP_THREADS", 0)) or None
+    # Parse, score and answer CSV payloads block by block (see stream_predictions)
+    STREAMING = os.environ.get("MODEL_SERVER_STREAMING", "false").lower() == "true"
+    STREAM_BLOCK_ROWS = int(os.environ.get("MODEL_SERVER_STREAM_BLOCK_ROWS", 4096))
+    # Cache of the label per row (see cache.py): off, local (per worker) or shared (per instance)
+    CACHE = os.environ.get("MODEL_SERVER_CACHE", "off").lower()
+    CACHE_SIZE = int(os.environ.get("MODEL_SERVER_CACHE_SIZE", 100000))
+    CACHE_TTL = float(os.environ.get("MODEL_SERVER_CACHE_TTL", 600))
+    CACHE_DIR = Path(os.environ.get("MODEL_SERVER_CACHE_DIR", SHARED_DIR))
+    # Load the model and run synthetic inferences in every worker before /ping reports healthy
+    WARMUP = os.environ.get("MODEL_SERVER_WARMUP", "true").lower() == "true"
+    WARMUP_ITERATIONS = int(os.environ.get("MODEL_SERVER_WARMUP_ITERATIONS", 3))
+    WARMUP_BATCH_SIZES = [
+        int(size)
+        for size in os.environ.get("MODEL_SERVER_WARMUP_BATCH_SIZES", "1,10,100,1000").split(",")
+    ]
+    # Latency histograms of the invocation stages, summed over the workers on /metrics (see
+    # metrics.py). The table of the workers is kept in METRICS_DIR
+    METRICS = os.environ.get("MODEL_SERVER_METRICS", "true").lower() == "true"
+    METRICS_DIR = Path(os.environ.get("MODEL_SERVER_METRICS_DIR", "/dev/shm"))
+    # Profile one in PROFILE_EVERY requests into PROFILE_DIR (see profiler.py), also switched on
+    # and off at runtime with /admin/profiling
+    PROFILE = os.environ.get("MODEL_SERVER_PROFILE", "false").lower() == "true"
+    PROFILE_EVERY = int(os.environ.get("MODEL_SERVER_PROFILE_EVERY", 100))
+    PROFILE_INTERVAL_MS = float(os.environ.get("MODEL_SERVER_PROFILE_INTERVAL_MS", 1))
+    PROFILE_DIR = Path(os.environ.get("MODEL_SERVER_PROFILE_DIR", "/tmp/profiles"))
+    PROFILE_KEEP = int(os.environ.get("MODEL_SERVER_PROFILE_KEEP", 200))
+    # The /admin routes need this token in the X-Admin-Token header, they are off without it
+    ADMIN_TOKEN = os.environ.get("MODEL_SERVER_ADMIN_TOKEN", "")
+    # Turn invocations away with a 503 and Retry-After when they waited in the queue longer than
+    # MAX_QUEUE_MS, or when the worker already handles MAX_WORKER_IN_FLIGHT (threaded mode), 0
+    # for no limit (see admission.py). nginx limits the whole instance, see serve
+    MAX_QUEUE_MS = float(os.environ.get("MODEL_SERVER_MAX_QUEUE_MS", 0))
+    MAX_WORKER_IN_FLIGHT = int(os.environ.get("MODEL_SERVER_MAX_WORKER_IN_FLIGHT", 0))
+    RETRY_AFTER = int(os.environ.get("MODEL_SERVER_RETRY_AFTER", 1))
+    # Request bodies sent with Content-Encoding gzip or zstd (or the content-encoding custom
+    # attribute, as SageMaker doesn't forward the header) decompress to MAX_DECOMPRESSED_MB at most.
+    # Responses of COMPRESS_MIN_BYTES or more are compressed when Accept-Encoding or the
+    # accept-encoding custom attribute asks for it (see compression.py)
+    MAX_DECOMPRESSED_MB = float(os.environ.get("MODEL_SERVER_MAX_DECOMPRESSED_MB", 200))
+    COMPRESS_MIN_BYTES = int(os.environ.get("MODEL_SERVER_COMPRESS_MIN_BYTES", 1024))
+    # Execution parameters advertised to Batch Transform (see ScoringService.execution_parameters).
+    # serve sets TRANSFORM_CONCURRENCY to the requests the workers score at once, the payload size
+    # is measured for a request to take about TRANSFORM_TARGET_SECONDS unless it's set
+    TRANSFORM_CONCURRENCY = int(os.environ.get("MODEL_SERVER_TRANSFORM_CONCURRENCY", 1))
+    TRANSFORM_MAX_PAYLOAD_MB = int(os.environ.get("MODEL_SERVER_TRANSFORM_MAX_PAYLOAD_MB", 0))
+    TRANSFORM_TARGET_SECONDS = float(os.environ.get("MODEL_SERVER_TRANSFORM_TARGET_SECONDS", 10))
+    TIMEOUT = float(os.environ.get("MODEL_SERVER_TIMEOUT", 60))
+    MAX_BODY_SIZE = os.environ.get("MODEL_SERVER_MAX_BODY_SIZE", "5m")
+    # Replace a worker once its request is answered when its memory passes MAX_WORKER_RSS_MB (less
+    # the model arrays shared by the workers) or it has answered MAX_REQUESTS invocations, 0 for no
+    # limit, the default. One worker is replaced at a time (see recycling.py)
+    MAX_WORKER_RSS_MB = float(os.environ.get("MODEL_SERVER_MAX_WORKER_RSS_MB", 0))
+    MAX_REQUESTS = int(os.environ.get("MODEL_SERVER_MAX_REQUESTS", 0))
+    # Log the stages of each invocation as a JSON line with its trace id, which the caller sets
+    # with the trace-id custom attribute (see api/app.py), else nginx with X-Request-Id
+    TRACE_LOG = os.environ.get("MODEL_SERVER_TRACE_LOG", "true").lower() == "true"
+    # The stub_status page of nginx, read by /metrics for the queue depth
+    NGINX_STATUS_URL = os.environ.get(
+        "MODEL_SERVER_NGINX_STATUS_URL", "http://127.0.0.1:8080/nginx_status"
+    )
 
 
 class ScoringService(object):
@@ -29,29 +170,460 @@ class ScoringService(object):
     It has a predict function that does a prediction based on the model and the input data.
     """
 
-    model = None  # Where we keep the model when it's loaded
+    model = None  # Where we keep the model when it's loaded, as a backends.Backend
+    batcher = None  # Collects concurrent requests when batching is enabled
+    parser = None  # Schema-aware CSV parser, False for models saved without a schema
+    cache = None  # Prediction cache of the current model version, when enabled
+    executor = None  # Inference threads of the threaded mode
+    profiler = None  # Samples the stacks of one in N requests
+    models = None  # The models selected by name, see get_named_model
+    challenger = None  # Scores the requests of the default model too, when configured
+    reload_pid = None  # The worker whose reload watch is started
+    admission = None  # Turns invocations away under overload
+    recycler = None  # Replaces the worker when it grew too large
+    transform_parameters = None  # Measured on the first /execution-parameters request
+    warm_up_state = None  # warming, ready or failed, in the worker that started the warm-up
+    warm_up_pid = None
+    lock = threading.Lock()
 
     @classmethod
     def get_model(cls):
         """Get the model object for this instance, loading it if it's not already loaded."""
         if cls.model == None:
-            logger.info(f"Pycaret load_model")
-            model_path = ServeConfig.MODEL_DIR / "final-model"
-            saved_model = load_model(model_path.as_posix())
-            cls.model = saved_model
+            with cls.lock:  # the warm-up thread and a request thread may get here together
+                if cls.model == None:
+                    cls.load_model()
         return cls.model
 
     @classmethod
-    def predict(cls, input_df: pd.DataFrame):
+    def load_model(cls):
+        """Load the model of ServeConfig.BACKEND and share its arrays between the workers."""
+        logger.info(f"Load model with the {ServeConfig.BACKEND} backend")
+        model = load_backend(
+            ServeConfig.BACKEND,
+            ServeConfig.MODEL_DIR,
+            fused=ServeConfig.FUSED_PREPROCESSING,
+            n_threads=ServeConfig.INTRA_OP_THREADS,
+        )
+        model.share(ServeConfig.SHARED_DIR)
+        metrics.set_version(model.version)
+        if ServeConfig.CHALLENGER:
+            challenger, _ = cls.load_named_model(ServeConfig.CHALLENGER)
+            cls.challenger = Challenger(
+                challenger,
+                ServeConfig.CHALLENGER,
+                ServeConfig.CHALLENGER_DIR,
+                max_pending=ServeConfig.CHALLENGER_MAX_PENDING,
+            )
+        cls.model = model
+        logger.info(f"Model loaded, memory of process {os.getpid()}: {memory_usage()}")
+
+    @classmethod
+    def get_named_model(cls, name: str):
+        """Get a model of ServeConfig.MODELS_DIR as a models.LoadedModel, loading it on first use.
+
+        The prediction cache, the micro-batching and the warm-up only serve the default model."""
+        if cls.models is None:
+            with cls.lock:
+                if cls.models is None:
+                    cls.models = ModelCache(cls.load_named_model, ServeConfig.MODEL_CACHE_MB)
+        return cls.models.get(name)
+
+    @classmethod
+    def load_named_model(cls, name: str):
+        model_dir = ServeConfig.MODELS_DIR / name
+        if not model_dir.is_dir():
+            raise ModelNotFound(f"No model {name} in {ServeConfig.MODELS_DIR}")
+        model = load_backend(
+            ServeConfig.BACKEND,
+            model_dir,
+            fused=ServeConfig.FUSED_PREPROCESSING,
+            n_threads=ServeConfig.INTRA_OP_THREADS,
+            named=True,
+        )
+        model.share(ServeConfig.SHARED_DIR)
+        schema = load_schema(model_dir)
+        return model, CsvParser.from_schema(schema) if schema else None
+
+    @classmethod
+    def preload(cls):
+        """Load the model in the gunicorn master, before the workers are forked.
+
+        The workers then inherit the model copy-on-write instead of each unpickling its own copy.
+        Freezing the garbage collector keeps the collector from touching, and thereby copying, the
+        pages of the objects loaded here."""
+        cls.get_model()
+        gc.collect()
+        gc.freeze()
+
+    @classmethod
+    def start_warm_up(cls):
+        """Warm the model up in a background thread of this worker, unless it's already started.
+
+        Called by the gunicorn post_worker_init hook when the worker starts, and by /ping in
+        case the server runs without it."""
+        with cls.lock:
+            if cls.warm_up_pid == os.getpid():
+                return
+            cls.warm_up_state, cls.warm_up_pid = "warming", os.getpid()
+        threading.Thread(target=cls.warm_up, name="warm-up", daemon=True).start()
+
+    @classmethod
+    def warm_up(cls):
+        """Load the model and send it synthetic requests at several batch sizes.
+
+        The inputs are rows of the training sample saved by train, so that the first real
+        requests find the lazy imports done, the parser, serializers and thread pools started
+        and the model's pages and the CPU caches warm."""
+        metrics.pause_thread()  # the synthetic requests aren't invocations
+        start = time.perf_counter()
+        try:
+            model = cls.get_model()
+            rows = load_sample(ServeConfig.MODEL_DIR)
+            if rows is None:
+                rows = calibration_rows(ServeConfig.MODEL_DIR, n_columns=model.n_inputs)
+            if rows is not None:
+                cls.send_synthetic_requests(rows)
+            else:
+                # A model saved without its schema or sample, of unknown width: loaded is ready
+                logger.warning(
+                    f"No schema or sample in {ServeConfig.MODEL_DIR}, worker {os.getpid()} "
+                    f"skips the synthetic requests of the warm-up"
+                )
+        except Exception as e:
+            cls.warm_up_state = "failed"
+            logger.error(f"Warm-up of worker {os.getpid()} failed: {e!r}")
+            return
+        cls.warm_up_state = "ready"
+        cls.get_recycler().warm()  # a replacement gives the recycling turn back
+        logger.info(
+            f"Warm-up of worker {os.getpid()} done in {time.perf_counter() - start:.2f}s "
+            f"(batch sizes {ServeConfig.WARMUP_BATCH_SIZES}, {ServeConfig.WARMUP_ITERATIONS} "
+            f"iterations each)"
+        )
+
+    @classmethod
+    def send_synthetic_requests(cls, rows: np.ndarray):
+        for batch_size in ServeConfig.WARMUP_BATCH_SIZES:
+            body = serialize(rows[np.arange(batch_size) % len(rows)], CSV)
+            for _ in range(ServeConfig.WARMUP_ITERATIONS):
+                # The path of an invocation, minus the prediction cache
+                serialize(cls.score(decode_input(body, CSV)), CSV)
+            cls.predict(decode_input(body, CSV), probabilities=True)
+
+    @classmethod
+    def execution_parameters(cls) -> dict:
+        """The settings of the Batch Transform jobs that don't set their own.
+
+        One concurrent transform per request the workers score at once, mini-batches of as many
+        lines as fit the payload (SplitType Line, MultiRecord), and a payload that takes about
+        TRANSFORM_TARGET_SECONDS to score, from the time per row of an invocation measured on
+        the sample rows. The payload stays within the body size nginx accepts, half the worker
+        timeout, and the 100MB Batch Transform allows over the concurrent transforms. Models saved
+        without their schema or sample, which can't be measured, get the default of SageMaker."""
+        if cls.transform_parameters is None:
+            concurrency = max(ServeConfig.TRANSFORM_CONCURRENCY, 1)
+            payload_mb = ServeConfig.TRANSFORM_MAX_PAYLOAD_MB
+            if not payload_mb:
+                cost = cls.measure_row_cost()
+                if cost is None:
+                    payload_mb = DEFAULT_PAYLOAD_MB
+                    logger.warning(
+                        f"Batch Transform: no rows to measure the model with, {payload_mb}MB per "
+                        f"request"
+                    )
+                else:
+                    seconds_per_row, bytes_per_row = cost
+                    seconds = min(ServeConfig.TRANSFORM_TARGET_SECONDS, ServeConfig.TIMEOUT / 2)
+                    payload_mb = int(seconds / seconds_per_row * bytes_per_row / MB)
+                    max_body_mb = nginx_size(ServeConfig.MAX_BODY_SIZE) // MB
+                    if max_body_mb:
+                        payload_mb = min(payload_mb, max_body_mb)
+                    payload_mb = max(min(payload_mb, 100 // concurrency), 1)
+                    logger.info(
+                        f"Batch Transform: {seconds_per_row * 1e6:.1f}us and {bytes_per_row:.0f} "
+                        f"bytes per row, {payload_mb}MB per request"
+                    )
+            cls.transform_parameters = {
+                "MaxConcurrentTransforms": concurrency,
+                "BatchStrategy": "MULTI_RECORD",
+                "MaxPayloadInMB": payload_mb,
+            }
+        return cls.transform_parameters
+
+    @classmethod
+    def measure_row_cost(cls, n_rows=2000):
+        """Seconds and CSV bytes per row of an invocation, from parsing to serializing, None when
+        there are no rows of the model's width to measure with."""
+        rows = calibration_rows(ServeConfig.MODEL_DIR, n_rows, cls.get_model().n_inputs)
+        if rows is None:
+            return None
+        body = serialize(rows, CSV)
+        with metrics.paused():
+            serialize(cls.score(decode_input(body, CSV)), CSV)  # warm
+            start = time.perf_counter()
+            serialize(cls.score(decode_input(body, CSV)), CSV)
+            seconds = time.perf_counter() - start
+        return seconds / n_rows, len(body) / n_rows
+
+    @classmethod
+    def start_reload_watch(cls):
+        """Start the thread of this worker that reloads the model when asked, unless it's already
+        started or nothing can ask for it."""
+        if not (ServeConfig.RELOAD_WATCH or ServeConfig.ADMIN_TOKEN):
+            return
+        with cls.lock:
+            if cls.reload_pid == os.getpid():
+                return
+            cls.reload_pid = os.getpid()
+        threading.Thread(target=cls.watch, name="reload-watch", daemon=True).start()
+
+    @classmethod
+    def watch(cls):
+        """Reload the model on each new /admin/reload request, and with ServeConfig.RELOAD_WATCH
+        once the version of the model directory has changed and stayed the same for one poll,
+        so that a model still being copied isn't loaded. A version that failed to load isn't
+        tried again. After a reload, the shared arrays no worker maps any more are unlinked."""
+        metrics.pause_thread()
+        requests = reload_requests()
+        seen = requests[0]
+        previous = failed = None
+        release_until = 0
+        while True:
+            time.sleep(ServeConfig.RELOAD_POLL_SECONDS)
+            reloaded = False
+            if requests[0] != seen:
+                seen = requests[0]
+                reloaded = cls.reload()
+            elif ServeConfig.RELOAD_WATCH and cls.model is not None:
+                version = model_version(ServeConfig.MODEL_DIR)
+                if version not in (cls.model.version, failed) and version == previous:
+                    reloaded = cls.reload()
+                    if not reloaded:
+                        failed = version
+                previous = version
+            if reloaded:
+                # The workers reload within a poll or two and finish the requests of the previous
+                # model within the timeout, the arrays of the previous model are unmapped by then
+                release_until = time.monotonic() + 2 * ServeConfig.TIMEOUT
+            if time.monotonic() < release_until:
+                unlink_unmapped(shared_arrays(ServeConfig.SHARED_DIR))
+
+    @classmethod
+    def reload(cls) -> bool:
+        """Load the model of ServeConfig.MODEL_DIR again and swap it in once it's validated.
+
+        Requests being scored finish on the previous model, which is released when they're done.
+        The model stays as it is if the new one fails to load or to validate."""
+        started = time.perf_counter()
+        previous = cls.model
+        if ServeConfig.METRICS:
+            metrics.start(ServeConfig.METRICS_DIR)  # the reload is counted by every worker
+        try:
+            model = load_backend(
+                ServeConfig.BACKEND,
+                ServeConfig.MODEL_DIR,
+                fused=ServeConfig.FUSED_PREPROCESSING,
+                n_threads=ServeConfig.INTRA_OP_THREADS,
+            )
+            model.share(ServeConfig.SHARED_DIR)
+            cls.validate(model, previous)
+        except Exception as e:
+            metrics.observe_reload(time.perf_counter() - started, succeeded=False)
+            logger.error(f"Reload of worker {os.getpid()} failed, keeping the model: {e!r}")
+            return False
+
+        with cls.lock:
+            cls.model = model
+            cls.parser = None  # the schema may have changed
+        metrics.set_version(model.version)
+        elapsed = time.perf_counter() - started
+        metrics.observe_reload(elapsed, succeeded=True)
+        old_version = previous.version if previous is not None else None
+        del previous
+        release_memory()
+        logger.info(
+            f"Model of worker {os.getpid()} reloaded in {elapsed:.2f}s, version {old_version} -> "
+            f"{model.version}, memory {memory_usage()}"
+        )
+        return True
+
+    @classmethod
+    def validate(cls, model, previous=None):
+        """Score the training sample with a model about to be swapped in, which also warms it up,
+        raising ValueError if its predictions are unusable.
+
+        Models saved without their sample are checked on synthetic rows of their width, and
+        swapped in unchecked when that isn't known either."""
+        rows = load_sample(ServeConfig.MODEL_DIR)
+        if rows is None:
+            rows = calibration_rows(ServeConfig.MODEL_DIR, n_columns=model.n_inputs)
+        if rows is None:
+            logger.warning(
+                f"No schema or sample in {ServeConfig.MODEL_DIR}, model {model.version} is not "
+                f"validated"
+            )
+            return
+        labels = np.asarray(model.predict(rows))
+        if labels.shape != (len(rows),) or not np.isin(labels, model.classes).all():
+            raise ValueError(f"The model predicted {labels.shape} labels outside of its classes")
+        proba = model.predict_proba(rows)
+        if not (np.isfinite(proba).all() and np.allclose(proba.sum(axis=1), 1, atol=1e-3)):
+            raise ValueError("The model predicted probabilities that don't sum to 1")
+        for batch_size in ServeConfig.WARMUP_BATCH_SIZES:
+            model.predict(rows[np.arange(batch_size) % len(rows)])
+        if previous is not None and previous.version != model.version:
+            agreement = np.mean(labels == np.asarray(previous.predict(rows)))
+            logger.info(
+                f"Model {model.version} agrees with {previous.version} on {agreement:.1%} of "
+                f"the {len(rows)} sample rows"
+            )
+
+    @classmethod
+    def predict(cls, input_data: np.ndarray, probabilities: bool = False, model_name: str = None):
         """For the input, do the predictions and return them.
 
         Args:
-            input (a pandas dataframe): The data on which to do the predictions. There will be
-                one prediction per row in the dataframe"""
+            input (a 2D numpy array): The data on which to do the predictions. There will be
+                one prediction per row in the array
+            probabilities (bool): Also return the class probabilities, as a (labels,
+                probabilities) tuple. The labels are then the most probable classes
+            model_name (str): The model of ServeConfig.MODELS_DIR to use, None for the default"""
+        if model_name is not None:
+            model = cls.get_named_model(model_name).backend
+            if probabilities:
+                proba = cls.run(model.predict_proba, input_data)
+                return model.classes[proba.argmax(axis=1)], proba
+            return cls.run(model.predict, input_data)
+
+        started = time.perf_counter()
+        model = cls.get_model()  # and the challenger, loaded with it
+        features = None
+        if probabilities:
+            proba = cls.run(model.predict_proba, input_data)
+            labels = model.classes[proba.argmax(axis=1)]
+        elif ServeConfig.CACHE != "off":
+            labels = cls.get_cache().predict(input_data, cls.score)
+        elif cls.challenger is not None and not ServeConfig.BATCHING:
+            labels, features = cls.score_with_features(input_data)
+        else:
+            labels = cls.score(input_data)
+        if cls.challenger is not None:
+            cls.challenger.submit(input_data, labels, time.perf_counter() - started, features)
+        return (labels, proba) if probabilities else labels
+
+    @classmethod
+    def score(cls, input_data: np.ndarray):
+        if ServeConfig.BATCHING:
+            return cls.get_batcher().submit(input_data)
+        return cls.run(cls.get_model().predict, input_data)
+
+    @classmethod
+    def score_with_features(cls, input_data: np.ndarray):
+        """Score with the default model, also returning the rows through its fused preprocessing
+        when the challenger has the same one, else None."""
         model = cls.get_model()
-        pred_df = predict_model(model, data=input_df)
-        output = pred_df["Label"]
-        return output
+        preprocessor = model.fused_preprocessor(input_data.shape[1])
+        shared = cls.challenger.model.fused_preprocessor(input_data.shape[1])
+        if preprocessor is None or preprocessor is not shared:
+            return cls.score(input_data), None
+        with timed("preprocess"):
+            features = cls.run(preprocessor.transform, input_data)
+        return cls.run(model.predict_features, features), features
+
+    @classmethod
+    def run(cls, fn, *args):
+        """Call the model, on the inference executor in the threaded mode."""
+        if ServeConfig.MODE == "threaded":
+            return cls.get_executor().run(fn, *args)
+        return fn(*args)
+
+    @classmethod
+    def get_parser(cls, model_name: str = None):
+        """Get the CSV parser for the schema saved by train, None if there's no schema."""
+        if model_name is not None:
+            return cls.get_named_model(model_name).parser
+        if cls.parser is None:
+            schema = load_schema(ServeConfig.MODEL_DIR)
+            cls.parser = CsvParser.from_schema(schema) if schema else False
+        return cls.parser or None
+
+    @classmethod
+    def get_cache(cls):
+        """Get the prediction cache, starting an empty one whenever the model version changes."""
+        model = cls.get_model()
+        if cls.cache is None or cls.cache.version != model.version:
+            cls.cache = None  # unmaps the table of the previous version, see PredictionCache.create
+            cls.cache = PredictionCache.create(
+                ServeConfig.CACHE,
+                model.version,
+                model.classes,
+                max_entries=ServeConfig.CACHE_SIZE,
+                ttl=ServeConfig.CACHE_TTL,
+                directory=ServeConfig.CACHE_DIR,
+            )
+        return cls.cache
+
+    @classmethod
+    def get_executor(cls):
+        if cls.executor is None:
+            cls.executor = InferenceExecutor(ServeConfig.INFERENCE_THREADS)
+        return cls.executor
+
+    @classmethod
+    def get_profiler(cls):
+        if cls.profiler is None:
+            cls.profiler = Profiler(
+                ServeConfig.PROFILE_DIR,
+                every=ServeConfig.PROFILE_EVERY,
+                interval_ms=ServeConfig.PROFILE_INTERVAL_MS,
+                keep=ServeConfig.PROFILE_KEEP,
+                enabled=ServeConfig.PROFILE,
+            )
+        return cls.profiler
+
+    @classmethod
+    def get_admission(cls):
+        if cls.admission is None:
+            cls.admission = AdmissionControl(
+                max_in_flight=ServeConfig.MAX_WORKER_IN_FLIGHT,
+                max_queue_ms=ServeConfig.MAX_QUEUE_MS,
+                retry_after=ServeConfig.RETRY_AFTER,
+            )
+        return cls.admission
+
+    @classmethod
+    def get_recycler(cls):
+        if cls.recycler is None:
+            with cls.lock:  # from the warm-up thread too
+                if cls.recycler is None:
+                    if ServeConfig.METRICS:
+                        metrics.start(ServeConfig.METRICS_DIR)  # every worker reports its memory
+                    cls.recycler = Recycler(
+                        ServeConfig.SHARED_DIR / f"recycle-{os.getppid()}.npy",
+                        max_memory_mb=ServeConfig.MAX_WORKER_RSS_MB,
+                        max_requests=ServeConfig.MAX_REQUESTS,
+                        # Time for the worker to finish its requests and its replacement to warm up
+                        turn_seconds=2 * ServeConfig.TIMEOUT,
+                    )
+        return cls.recycler
+
+    @classmethod
+    def recycle_reason(cls, invocation: bool = True):
+        """Why this worker should stop once the request it answered is sent, None if it keeps
+        serving. Called by the gunicorn post_request hook."""
+        ready = cls.warm_up_state == "ready" if ServeConfig.WARMUP else cls.model is not None
+        return cls.get_recycler().after_request(ready, invocation)
+
+    @classmethod
+    def get_batcher(cls):
+        if cls.batcher is None:
+            cls.batcher = MicroBatcher(
+                lambda rows: cls.get_model().predict(rows),
+                max_batch_rows=ServeConfig.BATCH_MAX_ROWS,
+                max_wait_ms=ServeConfig.BATCH_MAX_WAIT_MS,
+            )
+        return cls.batcher
 
 
 app = flask.Flask(__name__)
@@ -60,37 +632,416 @@ app = flask.Flask(__name__)
 @app.route("/ping", methods=["GET"])
 def ping():
     """Determine if the container is working and healthy. In this sample container, we declare
-    it healthy if we can load the model successfully."""
+    it healthy if we can load the model successfully.
+
+    This is the readiness check: with warm-up enabled the worker answers 503 until its warm-up
+    is done, so that no traffic is sent to a cold model."""
+    ScoringService.start_reload_watch()
+    if ServeConfig.WARMUP:
+        ScoringService.start_warm_up()
+        status = 200 if ScoringService.warm_up_state == "ready" else 503
+        return flask.Response(response="\n", status=status, mimetype="application/json")
+
     health = ScoringService.get_model() is not None
 
     status = 200 if health else 404
     return flask.Response(response="\n", status=status, mimetype="application/json")
 
 
+@app.route("/live", methods=["GET"])
+def live():
+    """The liveness check: the worker answers, including while it warms up, and its warm-up
+    didn't fail."""
+    status = 500 if ScoringService.warm_up_state == "failed" else 200
+    return flask.Response(response="\n", status=status, mimetype="application/json")
+
+
+MB = 1 << 20
+# The MaxPayloadInMB of Batch Transform when neither the job nor the container sets it
+DEFAULT_PAYLOAD_MB = 6
+
+
+def nginx_size(size: str) -> int:
+    """Bytes of an nginx size such as 5m, 0 for no limit."""
+    size = size.strip().lower()
+    scale = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}.get(size[-1:], 1)
+    return int(size.rstrip("kmg")) * scale
+
+
+def decode_input(data: bytes, content_type: str, model_name: str = None) -> np.ndarray:
+    """Read the request body into a 2D array of rows, raising ValueError if it is malformed."""
+    if content_type == CSV:
+        parser = ScoringService.get_parser(model_name)
+        if parser is not None:
+            return parser.parse(data)
+        s = io.StringIO(data.decode("utf-8"))
+        # Blank lines are rows of missing values, one prediction per line whatever the lines
+        return pd.read_csv(s, header=None, skip_blank_lines=False).to_numpy()
+
+    rows = deserialize(data, content_type)
+    if rows.ndim != 2:
+        raise ValueError(f"Expected a 2D array of rows, got shape {rows.shape}")
+    parser = ScoringService.get_parser(model_name)
+    if parser is not None and rows.shape[1] != parser.n_columns:
+        raise ValueError(f"Expected {parser.n_columns} columns, got {rows.shape[1]}")
+    return rows
+
+
+# Response formats that are a concatenation of independent lines, one per prediction
+STREAMABLE = (CSV, JSONLINES)
+
+
+def check_aligned(rows: np.ndarray, predictions: np.ndarray):
+    """Fail the invocation rather than answer with a prediction per row missing or extra: Batch
+    Transform joins the responses line by line (AssembleWith Line) and matches the output to the
+    input by position, which a CSV or JSON Lines response keeps."""
+    if len(predictions) != len(rows):
+        raise RuntimeError(f"{len(predictions)} predictions for {len(rows)} rows")
+
+
+def stream_predictions(blocks, accept, with_probabilities, request, model_name=None):
+    """Score the parsed blocks one at a time, in order, and serialize each one as it's done.
+
+    Only one block of rows and its predictions are held in memory, whatever the payload size.
+    The response has already started when a later block fails, so the error is logged and the
+    response is cut short."""
+    for block in blocks:
+        print("Invoked with {} records".format(block.shape[0]))
+        request.rows += block.shape[0]
+        if with_probabilities:
+            predictions, probabilities = ScoringService.predict(
+                block, probabilities=True, model_name=model_name
+            )
+        else:
+            predictions, probabilities = ScoringService.predict(block, model_name=model_name), None
+        check_aligned(block, predictions)
+        with timed("serialize"):
+            result = serialize(predictions, accept, probabilities=probabilities)
+        yield result
+
+
+def timed_blocks(blocks):
+    """The blocks of a streamed payload, timing the read and parse of each as the parse stage."""
+    while True:
+        with timed("parse"):
+            block = next(blocks, None)
+        if block is None:
+            return
+        yield block
+
+
+def compressed_chunks(chunks, encoding: str):
+    """The chunks of a streamed response compressed as one body, as they come."""
+    c = compressor(encoding)
+    for chunk in chunks:
+        compressed = c.compress(chunk)
+        if compressed:
+            yield compressed
+    yield c.flush()
+
+
+def streaming_response(
+    accept,
+    with_probabilities,
+    request,
+    model_name=None,
+    encoding=IDENTITY,
+    accept_encoding=IDENTITY,
+):
+    """The chunked response for a CSV payload, read from the request stream in row blocks and
+    decompressed on the way when it has a content encoding."""
+    max_size = int(ServeConfig.MAX_DECOMPRESSED_MB * 1e6)
+    stream = decompressing_reader(flask.request.stream, encoding, max_size)
+    blocks = timed_blocks(
+        ScoringService.get_parser(model_name).parse_stream(stream, ServeConfig.STREAM_BLOCK_ROWS)
+    )
+    # The first block is parsed before answering so that a malformed payload still gets a 400
+    first = next(blocks)
+
+    def generate():
+        # Scored once the response is returned, out of the traced block of invocations
+        with metrics.traced(request.trace):
+            try:
+                yield from stream_predictions(
+                    itertools.chain([first], blocks),
+                    accept,
+                    with_probabilities,
+                    request,
+                    model_name,
+                )
+            except Exception as e:
+                logger.error(f"Streaming response aborted: {e}")
+                raise
+
+    chunks = generate()
+    if accept_encoding != IDENTITY:  # the size isn't known in advance, always compressed
+        chunks = compressed_chunks(chunks, accept_encoding)
+    return flask.Response(
+        flask.stream_with_context(chunks),
+        status=200,
+        mimetype=accept,
+        headers=response_headers(accept_encoding, request.trace),  # timed to the first block
+    )
+
+
+@app.route("/execution-parameters", methods=["GET"])
+def execution_parameters():
+    """The defaults of the Batch Transform jobs run on this container, read once per job."""
+    return flask.Response(
+        response=json.dumps(ScoringService.execution_parameters()),
+        status=200,
+        mimetype="application/json",
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """The latency histograms and counts of all the workers, in the Prometheus text format."""
+    if not ServeConfig.METRICS:
+        return flask.Response(response="Metrics are disabled\n", status=404, mimetype="text/plain")
+    recorder = metrics.start(ServeConfig.METRICS_DIR)
+    nginx_active = nginx_active_requests(ServeConfig.NGINX_STATUS_URL)
+    return flask.Response(
+        response=metrics.render(recorder.table, nginx_active),
+        status=200,
+        content_type=metrics.CONTENT_TYPE,
+    )
+
+
+def reload_requests() -> memoryview:
+    """The count of /admin/reload requests, shared by the workers of the server."""
+    return shared_words(ServeConfig.SHARED_DIR / f"reload-{os.getppid()}.npy", 1)
+
+
+def authorized() -> bool:
+    """Whether the request carries the admin token, with the admin routes enabled."""
+    token = flask.request.headers.get("X-Admin-Token", "")
+    return bool(ServeConfig.ADMIN_TOKEN) and hmac.compare_digest(token, ServeConfig.ADMIN_TOKEN)
+
+
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def profiling():
+    """The profiling state, switched for all the workers by a POST of {"enabled": bool} and
+    optionally {"every": N}."""
+    if not authorized():
+        return flask.Response(response="\n", status=403, mimetype="text/plain")
+    profiler = ScoringService.get_profiler()
+    if flask.request.method == "POST":
+        settings = flask.request.get_json(force=True, silent=True)
+        if not isinstance(settings, dict):
+            return flask.Response(
+                response="Expected a JSON object", status=400, mimetype="text/plain"
+            )
+        profiler.configure(enabled=settings.get("enabled"), every=settings.get("every"))
+    return flask.jsonify(profiler.state())
+
+
+@app.route("/admin/models", methods=["GET"])
+def loaded_models():
+    """The models loaded by the worker that answers, with their load time and memory."""
+    if not authorized():
+        return flask.Response(response="\n", status=403, mimetype="text/plain")
+    if ScoringService.models is None:
+        return flask.jsonify({"models": []})
+    return flask.jsonify(ScoringService.models.stats())
+
+
+@app.route("/admin/challenger", methods=["GET"])
+def challenger_stats():
+    """The comparison of the challenger with the default model, in the worker that answers."""
+    if not authorized():
+        return flask.Response(response="\n", status=403, mimetype="text/plain")
+    if ScoringService.challenger is None:
+        return flask.Response(response="No challenger\n", status=404, mimetype="text/plain")
+    return flask.jsonify(ScoringService.challenger.stats())
+
+
+@app.route("/admin/reload", methods=["POST"])
+def request_reload():
+    """Ask every worker to reload the default model, which they do within
+    ServeConfig.RELOAD_POLL_SECONDS (see ScoringService.watch)."""
+    if not authorized():
+        return flask.Response(response="\n", status=403, mimetype="text/plain")
+    requests = reload_requests()
+    requests[0] += 1
+    return flask.jsonify({"requests": requests[0], "version": ScoringService.get_model().version})
+
+
 @app.route("/invocations", methods=["POST"])
 def invocations():
-    data = None
+    recorder = metrics.start(ServeConfig.METRICS_DIR) if ServeConfig.METRICS else None
+    trace = metrics.Trace(trace_id())
+    with metrics.traced(trace):
+        admission = ScoringService.get_admission()
+        if admission.admit(flask.request.headers.get("X-Request-Start")) is not None:
+            # Before reading the body, the cheapest answer the worker can give
+            headers = response_headers(IDENTITY, trace)
+            headers["Retry-After"] = str(admission.retry_after)
+            return flask.Response(
+                response="Overloaded, retry later\n",
+                status=503,
+                headers=headers,
+                mimetype="text/plain",
+            )
+        request = metrics.Request(recorder, trace)
+        profiler = ScoringService.get_profiler()
+        sampler = profiler.start_request(trace)
+        status = 500
+
+        def finish():
+            admission.release()
+            request.finish()
+            if sampler is not None:
+                profiler.finish_request(sampler)
+            if ServeConfig.TRACE_LOG:
+                log_trace(trace, status, request.rows)
 
-    # Convert from CSV to pandas
-    if flask.request.content_type == "text/csv":
-        data = flask.request.data.decode("utf-8")
-        s = io.StringIO(data)
-        data = pd.read_csv(s, header=None)
+        try:
+            response = invoke(request)
+        except BaseException:
+            finish()
+            raise
+    status = response.status_code
+    response.headers.setdefault("X-Trace-Id", trace.trace_id)  # errors too
+    # Once the response is sent, which for a streamed one is once it's scored
+    response.call_on_close(finish)
+    return response
+
+
+def trace_id() -> str:
+    """The trace id of the invocation: the trace-id custom attribute of the caller, else the
+    X-Request-Id of nginx, else a new one. Kept to 64 characters that fit a header."""
+    attributes = parse_custom_attributes(
+        flask.request.headers.get("X-Amzn-SageMaker-Custom-Attributes")
+    )
+    given = attributes.get("trace-id") or flask.request.headers.get("X-Request-Id") or ""
+    return re.sub(r"[^A-Za-z0-9._:-]", "", given)[:64] or uuid.uuid4().hex
+
+
+def log_trace(trace: metrics.Trace, status: int, rows: int):
+    """One JSON line per invocation, found in CloudWatch by the trace id the caller logged."""
+    logger.info(
+        json.dumps(
+            {
+                "trace_id": trace.trace_id,
+                "worker": os.getpid(),
+                "status": status,
+                "rows": rows,
+                "spans_ms": trace.timings(),
+            }
+        )
+    )
+
+
+def invoke(request: metrics.Request):
+    # Unknown Accept values get CSV, as before content negotiation
+    accept = negotiate(flask.request.headers.get("Accept"), SERIALIZERS, default=CSV) or CSV
+    attributes = parse_custom_attributes(
+        flask.request.headers.get("X-Amzn-SageMaker-Custom-Attributes")
+    )
+    with_probabilities = attributes.get("probabilities", "false").lower() == "true"
+    try:
+        encoding = content_encoding(
+            flask.request.headers.get("Content-Encoding") or attributes.get("content-encoding")
+        )
+        if encoding not in ENCODINGS + (IDENTITY,):
+            raise UnsupportedEncoding(f"Unsupported content encoding: {encoding}")
+    except UnsupportedEncoding as e:
+        return flask.Response(response=str(e), status=415, mimetype="text/plain")
+    accept_encoding = (
+        negotiate(
+            flask.request.headers.get("Accept-Encoding") or attributes.get("accept-encoding"),
+            ENCODINGS + (IDENTITY,),
+            default=IDENTITY,
+        )
+        or IDENTITY
+    )
+
+    model_name = attributes.get("model") or None
+    if model_name == ServeConfig.DEFAULT_MODEL:
+        model_name = None
+    if model_name is not None:
+        try:
+            version = ScoringService.get_named_model(model_name).backend.version
+        except ModelNotFound as e:
+            return flask.Response(response=str(e), status=404, mimetype="text/plain")
     else:
+        version = ScoringService.get_model().version
+    headers = {"X-Model-Version": version}  # the model as of the request, a reload may follow
+
+    if (
+        ServeConfig.STREAMING
+        and flask.request.mimetype == CSV
+        and accept in STREAMABLE
+        and ScoringService.get_parser(model_name) is not None
+    ):
+        try:
+            response = streaming_response(
+                accept, with_probabilities, request, model_name, encoding, accept_encoding
+            )
+            response.headers.update(headers)
+            return response
+        except PayloadTooLarge as e:
+            return flask.Response(response=str(e), status=413, mimetype="text/plain")
+        except ValueError as e:
+            return flask.Response(response=str(e), status=400, mimetype="text/plain")
+
+    try:
+        with timed("read"):  # decompression included
+            body = flask.request.get_data()
+            body = decompress(body, encoding, int(ServeConfig.MAX_DECOMPRESSED_MB * 1e6))
+    except PayloadTooLarge as e:
+        return flask.Response(response=str(e), status=413, mimetype="text/plain")
+    except ValueError as e:
+        return flask.Response(response=str(e), status=400, mimetype="text/plain")
+    try:
+        with timed("parse"):
+            data = decode_input(body, flask.request.mimetype, model_name)
+    except UnsupportedContentType:
         return flask.Response(
-            response="This predictor only supports CSV data",
+            response="This predictor supports {} data".format(", ".join(DESERIALIZERS)),
             status=415,
             mimetype="text/plain",
         )
+    except ValueError as e:
+        return flask.Response(response=str(e), status=400, mimetype="text/plain")
 
     print("Invoked with {} records".format(data.shape[0]))
+    request.rows = data.shape[0]
 
     # Do the prediction
-    predictions = ScoringService.predict(data)
+    if with_probabilities:
+        predictions, probabilities = ScoringService.predict(
+            data, probabilities=True, model_name=model_name
+        )
+    else:
+        predictions, probabilities = ScoringService.predict(data, model_name=model_name), None
+    check_aligned(data, predictions)
+
+    with timed("serialize"):
+        result = serialize(predictions, accept, probabilities=probabilities)
+        if len(result) < ServeConfig.COMPRESS_MIN_BYTES:
+            accept_encoding = IDENTITY
+        result = compress(result, accept_encoding)
+    headers.update(response_headers(accept_encoding, request.trace))
+    return flask.Response(response=result, status=200, mimetype=accept, headers=headers)
 
-    # Convert from numpy back to CSV
-    out = io.StringIO()
-    pd.DataFrame({"results": predictions}).to_csv(out, header=False, index=False)
-    result = out.getvalue()
 
-    return flask.Response(response=result, status=200, mimetype="text/csv")
+def response_headers(encoding: str, trace: metrics.Trace) -> dict:
+    """The encoding, the trace id and the stages timed so far of a response, as Server-Timing."""
+    timings = trace.timings()
+    headers = {
+        "Vary": "Accept-Encoding",
+        "X-Trace-Id": trace.trace_id,
+        "Server-Timing": ", ".join(f"{stage};dur={ms}" for stage, ms in timings.items()),
+    }
+    # SageMaker returns the custom attributes of the response to the caller, not its headers
+    attributes = {
+        "trace-id": trace.trace_id,
+        "server-timing": "|".join(f"{stage}:{ms}" for stage, ms in timings.items()),
+    }
+    if encoding != IDENTITY:
+        headers["Content-Encoding"] = encoding
+        attributes["content-encoding"] = encoding
+    headers["X-Amzn-SageMaker-Custom-Attributes"] = format_custom_attributes(attributes)
+    return headers
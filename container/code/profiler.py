@@ -0,0 +1,174 @@
+import collections
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import metrics
+from shared import shared_words
+from utils import *
+
+# Values of the shared on/off switch, UNSET leaves it to the environment
+UNSET, ON, OFF = 0, 1, 2
+
+
+class Sampler:
+    """
+    Samples the Python stack of one request at a fixed interval, from a background thread.
+
+    Reading the stack from another thread rather than in a SIGPROF handler, which only runs on the
+    main thread, also samples the request threads of the threaded mode, and the time spent in
+    native code that releases the GIL (LightGBM, NumPy) is charged to the Python call it's in.
+
+    The request thread is sampled unless other threads run stages of its trace: in the threaded
+    mode the model runs on the inference threads and with micro-batching on the scoring thread,
+    while the request thread waits for them. Those are sampled instead, a micro-batch being
+    charged to each request in it.
+    """
+
+    def __init__(self, thread_id: int, interval: float, trace: metrics.Trace = None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.trace = trace
+        self.counts = collections.Counter()  # folded stack -> samples
+        self.started = time.perf_counter()
+        self.duration = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            threads = [self.thread_id]
+            if self.trace is not None:
+                working = metrics.working_threads(self.trace)
+                threads = [ident for ident in working if ident != self.thread_id] or threads
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.counts[folded_stack(frame)] += 1
+
+    def stop(self) -> collections.Counter:
+        self.stopped.set()
+        self.thread.join()
+        self.duration = time.perf_counter() - self.started
+        return self.counts
+
+
+class Profiler:
+    """
+    Profiles one in every N requests of the worker with a Sampler.
+
+    Each profile is written to the directory as a file of folded stacks, the input format of
+    flamegraph.pl and speedscope, and the profiles of the last requests are summed in the
+    worker's aggregate-<pid>.folded. Older request files are deleted beyond keep per worker.
+
+    Profiling is switched on and off at runtime for all the workers through a word of a table
+    shared by them, which the requests read: while off, a request costs a memory read and nothing
+    else.
+    """
+
+    def __init__(self, directory, every=100, interval_ms=1.0, keep=200, enabled=False):
+        self.directory = Path(directory)
+        self.every = max(int(every), 1)
+        self.interval = interval_ms / 1000
+        self.keep = keep
+        self.enabled = enabled  # the setting of the environment, until switched at runtime
+        self.requests = 0
+        self.pid = None  # the shared table is mapped again in each worker
+        self.control = None
+        self.lock = threading.Lock()
+        self.files = collections.deque()
+        self.window = collections.deque()  # counts of the last keep profiles
+        self.aggregate = collections.Counter()
+
+    def _control(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # Named after the gunicorn master, so that every server starts from the
+                    # environment
+                    path = self.directory / f".control-{os.getppid()}.npy"
+                    self.control = shared_words(path, 2)
+                    self.files, self.window = collections.deque(), collections.deque()
+                    self.aggregate = collections.Counter()
+                    self.pid = os.getpid()
+        return self.control
+
+    def is_enabled(self) -> bool:
+        state = self._control()[0]
+        return state == ON or (state == UNSET and self.enabled)
+
+    def start_request(self, trace: metrics.Trace = None):
+        """Start sampling the calling thread, or those running the stages of its trace, if this
+        request is one to profile, else None."""
+        if not self.is_enabled():
+            return None
+        self.requests += 1
+        if self.requests % (self._control()[1] or self.every):
+            return None
+        return Sampler(threading.get_ident(), self.interval, trace)
+
+    def finish_request(self, sampler: Sampler):
+        """Stop the sampler and write its profile, after the response is sent."""
+        counts = sampler.stop()
+        name = f"request-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self.requests}"
+        path = self.directory / f"{name}-{sampler.duration * 1000:.0f}ms.folded"
+        with self.lock:
+            self.window.append(counts)
+            self.aggregate.update(counts)
+            if len(self.window) > self.keep:
+                self.aggregate.subtract(self.window.popleft())
+                self.aggregate = +self.aggregate  # drops the stacks down to 0
+            write_folded(counts, path)
+            self.files.append(path)
+            while len(self.files) > self.keep:
+                self.files.popleft().unlink(missing_ok=True)
+            write_folded(self.aggregate, self.directory / f"aggregate-{os.getpid()}.folded")
+
+    def configure(self, enabled: bool = None, every: int = None):
+        """Switch profiling on or off and set N, for all the workers."""
+        control = self._control()
+        if every is not None:
+            control[1] = max(int(every), 1)
+        if enabled is not None:
+            control[0] = ON if enabled else OFF
+        logger.info(f"Profiling: {self.state()}")
+
+    def state(self) -> dict:
+        return {
+            "enabled": self.is_enabled(),
+            "every": self._control()[1] or self.every,
+            "interval_ms": self.interval * 1000,
+            "directory": self.directory.as_posix(),
+        }
+
+
+_LABELS = {}
+
+
+def folded_stack(frame) -> str:
+    """The stack of a frame as "outermost;...;innermost", a function being "name (file:line)"."""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        label = _LABELS.get(code)
+        if label is None:
+            path = Path(code.co_filename)
+            label = f"{code.co_name} ({path.parent.name}/{path.name}:{code.co_firstlineno})"
+            _LABELS[code] = label
+        labels.append(label)
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def write_folded(counts: collections.Counter, path: Path):
+    """Write folded stacks, one "stack samples" line each, replacing the file atomically."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "w") as f:
+        for stack, samples in counts.most_common():
+            f.write(f"{stack} {samples}\n")
+    os.replace(tmp, path)
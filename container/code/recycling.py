@@ -0,0 +1,116 @@
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import metrics
+from shared import shared_words
+from utils import *
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class Recycler:
+    """
+    Replaces the workers that grew too large or served enough requests, one worker at a time.
+
+    After each request, a worker compares its memory with max_memory_mb and its count of
+    invocations with max_requests, 0 for no limit. Past either, it takes the recycling turn of the
+    server and stops once its request is answered (see post_request in gunicorn.conf.py), and
+    gunicorn starts a replacement, which gives the turn back once its model is loaded and warm.
+    The other workers keep serving meanwhile and try again after their next request, so at most
+    one worker is missing at any time. A turn that isn't given back within turn_seconds (say the
+    replacement fails to start) expires.
+
+    The memory of a worker is its resident set less the pages of files and shared memory, that
+    is less the model arrays and libraries all the workers share (see shared.py). That's what
+    grows with leaks and heap fragmentation, and what a new worker gets back. A worker whose model
+    alone takes more than max_memory_mb wouldn't get anything back, so its memory isn't checked.
+    """
+
+    def __init__(self, path: Path, max_memory_mb=0, max_requests=0, turn_seconds=120):
+        self.path = Path(path)
+        # pid of the worker being replaced and when it took the turn (ms), 0 when nobody has it
+        self.turn = shared_words(self.path, 2)
+        self.max_memory = max_memory_mb * (1 << 20)
+        self.max_requests = max_requests
+        self.turn_ms = int(turn_seconds * 1000)
+        self.started_ms = int(time.time() * 1000)
+        self.requests = 0
+        self.ready = False
+        self.reason = None  # why this worker is being replaced
+
+    def after_request(self, ready: bool, invocation: bool = True):
+        """Take note of a request answered by this worker and return why it should stop, None if
+        it keeps serving. ready tells whether the worker's model is loaded and warm, invocation
+        whether the request counts towards max_requests (health checks don't)."""
+        if self.reason is not None:
+            return None  # already stopping, answering the requests it accepted (threaded mode)
+        if invocation:
+            self.requests += 1
+        resident, anonymous = memory_bytes()
+        metrics.observe_memory(resident, anonymous)
+        if ready:
+            self.warm()
+        if self.max_requests and self.requests >= self.max_requests:
+            reason = "requests"
+        elif self.max_memory and self.ready and anonymous > self.max_memory:
+            reason = "memory"
+        else:
+            return None
+        if not self._take_turn():
+            return None
+        self.reason = reason
+        metrics.observe_recycle(reason)
+        logger.info(
+            f"Recycling worker {os.getpid()} ({reason}) after {self.requests} invocations, "
+            f"memory {anonymous / (1 << 20):.0f}MB"
+        )
+        return reason
+
+    def warm(self):
+        """Take note, once, that the model of this worker is loaded and warm: the turn is given
+        back if this worker is a replacement, and its memory is checked from now on."""
+        if self.ready:
+            return
+        self.ready = True
+        resident, anonymous = memory_bytes()
+        metrics.observe_memory(resident, anonymous)
+        if self.max_memory and anonymous > self.max_memory:
+            logger.warning(
+                f"Worker {os.getpid()} takes {anonymous / (1 << 20):.0f}MB once its model is "
+                f"loaded, more than the {self.max_memory / (1 << 20):.0f}MB limit: not recycling "
+                f"it for its memory"
+            )
+            self.max_memory = 0
+        # A replacement started after the turn was taken, and the worker it replaces is gone
+        with self._locked():
+            pid, taken = self.turn[0], self.turn[1]
+            if pid and self.started_ms > taken and not process_alive(pid):
+                self.turn[0] = self.turn[1] = 0
+
+    def _take_turn(self) -> bool:
+        now = int(time.time() * 1000)
+        with self._locked():
+            pid, taken = self.turn[0], self.turn[1]
+            if pid and now - taken < self.turn_ms:
+                return pid == os.getpid()
+            self.turn[0], self.turn[1] = os.getpid(), now
+        return True
+
+    @contextmanager
+    def _locked(self):
+        """The turn is read and written by several workers at once, under a lock of its file."""
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def memory_bytes():
+    """Resident memory of this process, and the part of it not backed by files or shared memory,
+    read from /proc/self/statm at the cost of a system call."""
+    with open("/proc/self/statm", "rb") as f:
+        fields = f.read().split()
+    resident, shared = int(fields[1]), int(fields[2])
+    return resident * PAGE_SIZE, (resident - shared) * PAGE_SIZE
@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils import *
+
+SCHEMA_FILE = "final-schema.json"
+SAMPLE_FILE = "final-sample.npy"
+
+
+def save_schema(features: pd.DataFrame, model_dir: Path):
+    """Record the feature columns the model was trained on, in order, next to the model."""
+    schema = {
+        "columns": [str(column) for column in features.columns],
+        "dtype": "float32",
+    }
+    path = Path(model_dir) / SCHEMA_FILE
+    with open(path.as_posix(), "w") as f:
+        json.dump(schema, f)
+    logger.info(f"Schema with {len(schema['columns'])} columns saved to {path}")
+    return schema
+
+
+def load_schema(model_dir: Path):
+    """The schema saved by train, or None for models trained before it was recorded."""
+    path = Path(model_dir) / SCHEMA_FILE
+    if not path.exists():
+        return None
+    with open(path.as_posix()) as f:
+        schema = json.load(f)
+    schema["n_columns"] = len(schema["columns"])
+    schema["dtype"] = np.dtype(schema["dtype"])
+    return schema
+
+
+def save_sample(features: pd.DataFrame, model_dir: Path, n_rows: int = 256, seed: int = 17):
+    """Keep a few training rows next to the model, as realistic inputs for warming it up."""
+    sample = features.sample(min(n_rows, len(features)), random_state=seed)
+    path = Path(model_dir) / SAMPLE_FILE
+    np.save(path, sample.to_numpy(dtype=np.float32))
+    logger.info(f"Sample of {len(sample)} rows saved to {path}")
+
+
+def load_sample(model_dir: Path):
+    """The training rows saved by train, or None for models trained before they were kept."""
+    path = Path(model_dir) / SAMPLE_FILE
+    if not path.exists():
+        return None
+    return np.load(path)
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from utils import *
+
+# The files of share_array: content digest, dtype and shape
+ARRAY_NAME = re.compile(r"[0-9a-f]{20}-\w+-[0-9x]*\.npy")
+
+
+def group_directory() -> Path:
+    """The directory of the files shared by the processes of the server, which serve, gunicorn and
+    its workers are: named after their process group, in /dev/shm else the temporary directory.
+    Those of the groups that are gone are removed."""
+    base = Path("/dev/shm") if os.path.isdir("/dev/shm") else Path(tempfile.gettempdir())
+    for other in base.glob("model-server-*"):
+        group = other.name.rsplit("-", 1)[1]
+        if group.isdigit() and int(group) != os.getpgrp() and not group_alive(int(group)):
+            shutil.rmtree(other, ignore_errors=True)
+    return base / f"model-server-{os.getpgrp()}"
+
+
+def group_alive(group: int) -> bool:
+    try:
+        os.killpg(group, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def share_array(array: np.ndarray, directory: Path) -> np.ndarray:
+    """Back an array with a read-only memory-mapped file.
+
+    Files are named after the array content, so every worker that loads the same model maps the
+    same page cache pages, and a model loaded before gunicorn forks keeps its arrays shared since
+    nobody writes to them. They're unlinked once no worker maps them (see shared_arrays)."""
+    array = np.ascontiguousarray(array)
+    if array.size == 0:
+        return array
+    digest = hashlib.sha1(array.tobytes()).hexdigest()[:20]
+    shape = "x".join(str(n) for n in array.shape)
+    path = Path(directory) / f"{digest}-{array.dtype.name}-{shape}.npy"
+    for attempt in range(3):
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        try:
+            return np.asarray(np.load(path, mmap_mode="r"))
+        except FileNotFoundError:
+            if attempt == 2:
+                raise
+            # Unlinked by another worker before this one mapped it, written again
+
+
+def shared_arrays(directory: Path) -> list:
+    """The files share_array wrote to directory."""
+    directory = Path(directory)
+    if not directory.is_dir():
+        return []
+    return [path for path in directory.iterdir() if ARRAY_NAME.fullmatch(path.name)]
+
+
+def unlink_unmapped(paths) -> list:
+    """Unlink the files that no process maps, returning those kept. Nothing is unlinked without
+    /proc to tell."""
+    mapped = mapped_files()
+    if mapped is None:
+        return list(paths)
+    kept = []
+    for path in paths:
+        if os.path.realpath(path) in mapped:
+            kept.append(path)
+        else:
+            Path(path).unlink(missing_ok=True)
+    return kept
+
+
+def mapped_files():
+    """The files mapped by the processes this one can see, None without /proc."""
+    if not os.path.isdir("/proc/self"):
+        return None
+    mapped = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/maps") as f:
+                for line in f:
+                    fields = line.split(maxsplit=5)
+                    if len(fields) == 6 and fields[5].startswith("/"):
+                        mapped.add(fields[5].rstrip("\n"))
+        except OSError:  # gone meanwhile, or not ours
+            continue
+    return mapped
+
+
+def shared_words(path: Path, n_words: int) -> memoryview:
+    """Integers shared by the workers, read and written with plain indexing at the cost of a
+    memory access."""
+    return memoryview(np.asarray(open_shared_table(path, np.int64, (n_words,))))
+
+
+def open_shared_table(path: Path, dtype: np.dtype, shape: tuple) -> np.ndarray:
+    """Open the writable zero-initialized array at path that the workers share, the first worker
+    to get there creates it."""
+    path = Path(path)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape).flush()
+        try:
+            os.link(tmp, path)  # fails if another worker created it first, unlike a rename
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+    table = np.load(path, mmap_mode="r+")
+    if table.dtype != dtype or table.shape != shape:
+        raise ValueError(f"{path} doesn't hold a shared table of shape {shape}")
+    return table
@@ -0,0 +1,50 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from fused import FusedPreprocessor
+from utils import *
+
+SLIM_DIR = "final-serving"
+MANIFEST_FILE = "manifest.json"
+PREPROCESSING_FILE = "preprocessing.npz"
+BOOSTER_FILE = "booster.txt"
+
+
+def export_slim(pipeline, features: pd.DataFrame, model_dir: Path) -> Path:
+    """Write the serving artifact: the fitted pipeline reduced to plain arrays and a model file.
+
+    The preprocessing goes in as its fused form (see fused.py) and the LightGBM estimator as its
+    text model file, so that the slim backend serves them with NumPy and LightGBM only: pycaret,
+    and the seconds it takes to import, stay out of the serving workers."""
+    directory = Path(model_dir) / SLIM_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+
+    n_features = features.shape[1]
+    fused = FusedPreprocessor.from_pipeline(pipeline, n_features)
+    fused.save(directory / PREPROCESSING_FILE)
+
+    estimator = pipeline.steps[-1][1]
+    estimator.booster_.save_model((directory / BOOSTER_FILE).as_posix())
+
+    classes = np.asarray(estimator.classes_)
+    manifest = {
+        "columns": [str(column) for column in features.columns],
+        "dtype": "float32",
+        "n_components": int(fused.weight.shape[1]),
+        "classes": classes.tolist(),
+        "estimator": type(estimator).__name__,
+        "preprocessing": PREPROCESSING_FILE,
+        "booster": BOOSTER_FILE,
+    }
+    with open(directory / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info(f"Serving artifact saved to {directory}")
+    return directory
+
+
+def load_manifest(model_dir: Path) -> dict:
+    with open(Path(model_dir) / SLIM_DIR / MANIFEST_FILE) as f:
+        return json.load(f)
@@ -0,0 +1,123 @@
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The modules of the container are imported from /opt/program, flat, as the server does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+DATA_PATH = Path(__file__).resolve().parents[3] / "data" / "test.csv"
+
+# The state ScoringService builds on first use, started afresh by every test
+SCORING_STATE = [
+    "model",
+    "batcher",
+    "parser",
+    "cache",
+    "executor",
+    "profiler",
+    "models",
+    "challenger",
+    "reload_pid",
+    "admission",
+    "recycler",
+    "transform_parameters",
+    "warm_up_state",
+    "warm_up_pid",
+]
+
+
+@pytest.fixture(scope="session")
+def test_data():
+    """The features and labels of data/test.csv."""
+    data = pd.read_csv(DATA_PATH)
+    return data.drop(columns="target"), data["target"].to_numpy()
+
+
+def write_slim_model(model_dir: Path, features: pd.DataFrame, labels: np.ndarray):
+    """A serving artifact as export_slim writes it, without pycaret: mean imputation and the
+    identity as the fused preprocessing, and a small LightGBM trained on the features."""
+    lightgbm = pytest.importorskip("lightgbm")
+    from fused import FusedPreprocessor
+    from slim import BOOSTER_FILE, MANIFEST_FILE, PREPROCESSING_FILE, SLIM_DIR
+
+    X = features.to_numpy(dtype=np.float32)
+    n_features = X.shape[1]
+    preprocessor = FusedPreprocessor(
+        n_features,
+        np.arange(n_features),
+        np.nanmean(X, axis=0),
+        np.eye(n_features),
+        np.zeros(n_features),
+    )
+    estimator = lightgbm.LGBMClassifier(n_estimators=10, num_leaves=7, verbose=-1)
+    estimator.fit(preprocessor.transform(X), labels)
+
+    directory = model_dir / SLIM_DIR
+    directory.mkdir(parents=True)
+    preprocessor.save(directory / PREPROCESSING_FILE)
+    estimator.booster_.save_model((directory / BOOSTER_FILE).as_posix())
+    manifest = {
+        "columns": [str(column) for column in features.columns],
+        "dtype": "float32",
+        "n_components": n_features,
+        "classes": estimator.classes_.tolist(),
+        "estimator": type(estimator).__name__,
+        "preprocessing": PREPROCESSING_FILE,
+        "booster": BOOSTER_FILE,
+    }
+    with open(directory / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f)
+
+
+@pytest.fixture(scope="session")
+def slim_model(tmp_path_factory, test_data):
+    """A model directory as train leaves it: the serving artifact, the schema and the sample."""
+    from schema import save_sample, save_schema
+
+    features, labels = test_data
+    model_dir = tmp_path_factory.mktemp("model")
+    write_slim_model(model_dir, features, labels)
+    save_schema(features, model_dir)
+    save_sample(features, model_dir)
+    return model_dir
+
+
+@pytest.fixture(scope="session")
+def bare_model(tmp_path_factory, slim_model):
+    """The same model saved without its schema and sample, as by train before they were kept."""
+    from slim import SLIM_DIR
+
+    model_dir = tmp_path_factory.mktemp("bare-model")
+    shutil.copytree(slim_model / SLIM_DIR, model_dir / SLIM_DIR)
+    return model_dir
+
+
+@pytest.fixture
+def predictor(monkeypatch, tmp_path, tmp_path_factory, slim_model):
+    """The predictor module serving slim_model with the slim backend, its files kept in tmp_path
+    and its ScoringService started afresh. Tests change ServeConfig with monkeypatch."""
+    monkeypatch.chdir(tmp_path)  # the first import creates ./assets
+    import predictor
+
+    settings = {
+        "MODEL_DIR": slim_model,
+        "MODELS_DIR": slim_model.parent,
+        "BACKEND": "slim",
+        "SHARED_DIR": tmp_path / "shared",
+        "CACHE_DIR": tmp_path,
+        "METRICS_DIR": tmp_path_factory.getbasetemp(),  # one recorder per process
+        "PROFILE_DIR": tmp_path / "profiles",
+        "WARMUP_BATCH_SIZES": [1, 10],
+        "WARMUP_ITERATIONS": 1,
+        "TRACE_LOG": False,
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(predictor.ServeConfig, name, value)
+    for name in SCORING_STATE:
+        monkeypatch.setattr(predictor.ScoringService, name, None)
+    return predictor
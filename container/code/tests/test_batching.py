@@ -0,0 +1,85 @@
+import threading
+
+import numpy as np
+import pytest
+
+from batching import MicroBatcher
+
+
+class RecordingModel:
+    """Predicts the first column of each row and records the size of every batch."""
+
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, X):
+        self.batches.append(len(X))
+        return X[:, 0].copy()
+
+
+def submit_concurrently(batcher, requests):
+    results = [None] * len(requests)
+    errors = [None] * len(requests)
+    start = threading.Barrier(len(requests))
+
+    def submit(i):
+        start.wait()
+        try:
+            results[i] = batcher.submit(requests[i])
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results, errors
+
+
+def test_concurrent_requests_are_scored_together():
+    model = RecordingModel()
+    batcher = MicroBatcher(model.predict, max_batch_rows=1000, max_wait_ms=200)
+    requests = [np.full((i + 1, 3), i, dtype=np.float32) for i in range(8)]
+    results, errors = submit_concurrently(batcher, requests)
+    assert errors == [None] * len(requests)
+    for rows, result in zip(requests, results):
+        np.testing.assert_array_equal(result, rows[:, 0])
+    assert sum(model.batches) == sum(len(rows) for rows in requests)
+    assert len(model.batches) < len(requests)
+
+
+def test_batches_are_capped_at_max_batch_rows():
+    model = RecordingModel()
+    batcher = MicroBatcher(model.predict, max_batch_rows=10, max_wait_ms=50)
+    requests = [np.full((4, 3), i, dtype=np.float32) for i in range(6)] + [
+        np.zeros((25, 3), dtype=np.float32)  # larger than a batch, scored on its own
+    ]
+    results, errors = submit_concurrently(batcher, requests)
+    assert errors == [None] * len(requests)
+    for rows, result in zip(requests, results):
+        np.testing.assert_array_equal(result, rows[:, 0])
+    assert all(size <= 10 or size == 25 for size in model.batches)
+
+
+def test_requests_of_different_widths_are_scored_apart():
+    model = RecordingModel()
+    batcher = MicroBatcher(model.predict, max_batch_rows=1000, max_wait_ms=200)
+    requests = [np.full((2, 3 + i % 2), i, dtype=np.float32) for i in range(6)]
+    results, errors = submit_concurrently(batcher, requests)
+    assert errors == [None] * len(requests)
+    for rows, result in zip(requests, results):
+        np.testing.assert_array_equal(result, rows[:, 0])
+
+
+def test_errors_reach_every_request_of_the_batch():
+    def fail(X):
+        raise RuntimeError("model failed")
+
+    batcher = MicroBatcher(fail, max_batch_rows=1000, max_wait_ms=50)
+    requests = [np.ones((2, 3), dtype=np.float32) for _ in range(4)]
+    results, errors = submit_concurrently(batcher, requests)
+    assert results == [None] * len(requests)
+    assert all(isinstance(error, RuntimeError) for error in errors)
+    with pytest.raises(RuntimeError, match="model failed"):
+        batcher.submit(requests[0])
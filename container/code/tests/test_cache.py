@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from cache import LruStore, PredictionCache, SharedStore, row_hashes
+
+
+@pytest.fixture(params=["local", "shared"])
+def store(request, tmp_path):
+    if request.param == "local":
+        return LruStore(max_entries=1000, ttl=600)
+    return SharedStore(tmp_path / "prediction-cache-test.npy", max_entries=1000, ttl=600)
+
+
+def test_store_returns_what_was_put(store):
+    keys = np.array([3, 1 << 40, 12345], dtype=np.uint64)
+    store.put(keys, np.array([0, 1, 2], dtype=np.int64))
+    found, values = store.get(np.array([1 << 40, 7, 3, 12345], dtype=np.uint64))
+    assert found.tolist() == [True, False, True, True]
+    assert values[found].tolist() == [1, 0, 2]
+
+
+def test_store_forgets_expired_entries(store):
+    store.ttl = -1
+    store.put(np.array([1, 2], dtype=np.uint64), np.array([0, 1], dtype=np.int64))
+    found, _ = store.get(np.array([1, 2], dtype=np.uint64))
+    assert not found.any()
+
+
+def test_lru_store_evicts_the_least_recently_used():
+    store = LruStore(max_entries=2, ttl=600)
+    store.put(np.array([1, 2], dtype=np.uint64), np.array([0, 1], dtype=np.int64))
+    store.get(np.array([1], dtype=np.uint64))
+    store.put(np.array([3], dtype=np.uint64), np.array([2], dtype=np.int64))
+    found, _ = store.get(np.array([1, 2, 3], dtype=np.uint64))
+    assert found.tolist() == [True, False, True]
+
+
+def test_shared_store_is_seen_by_another_mapping(tmp_path):
+    path = tmp_path / "prediction-cache-test.npy"
+    SharedStore(path, 1000, 600).put(np.array([5], dtype=np.uint64), np.array([1], dtype=np.int64))
+    found, values = SharedStore(path, 1000, 600).get(np.array([5], dtype=np.uint64))
+    assert found.tolist() == [True] and values.tolist() == [1]
+
+
+def test_row_hashes_differ_by_row_and_seed():
+    X = np.arange(30, dtype=np.float32).reshape(10, 3)
+    hashes = row_hashes(X, seed=1)
+    assert len(np.unique(hashes)) == len(X)
+    np.testing.assert_array_equal(row_hashes(X.copy(), seed=1), hashes)
+    assert not np.array_equal(row_hashes(X, seed=2), hashes)
+
+
+@pytest.mark.parametrize("kind", ["local", "shared"])
+def test_prediction_cache_scores_each_distinct_row_once(kind, tmp_path):
+    cache = PredictionCache.create(kind, "v1", ["no", "yes"], 1000, 600, tmp_path)
+    X = np.array([[0, 1], [1, 1], [0, 1], [2, 1]], dtype=np.float32)
+    scored = []
+
+    def score(rows):
+        scored.append(len(rows))
+        return np.where(rows[:, 0] > 0, "yes", "no")
+
+    assert cache.predict(X, score).tolist() == ["no", "yes", "no", "yes"]
+    assert cache.predict(X, score).tolist() == ["no", "yes", "no", "yes"]
+    assert scored == [3]
+    stats = cache.stats()
+    assert (stats["hits"], stats["duplicates"], stats["misses"]) == (4, 1, 3)
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+from content_types import (
+    CSV,
+    DESERIALIZERS,
+    JSON,
+    JSONLINES,
+    NPY,
+    SERIALIZERS,
+    UnsupportedContentType,
+    deserialize,
+    format_custom_attributes,
+    negotiate,
+    parse_custom_attributes,
+    serialize,
+)
+
+FORMATS = sorted(SERIALIZERS)
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(20, 7)) * 10.0 ** rng.integers(-3, 4, size=(20, 7))
+    X[rng.random(X.shape) < 0.2] = np.nan
+    X[0, 0], X[1, 1], X[2, 2] = 0.0, -1.5e-300, 123456789.125
+    return X
+
+
+@pytest.mark.parametrize("content_type", FORMATS)
+def test_features_round_trip(content_type, features):
+    decoded = deserialize(serialize(features, content_type), content_type)
+    np.testing.assert_array_equal(decoded, features)
+
+
+@pytest.mark.parametrize("content_type", FORMATS)
+def test_features_decode_as_the_csv_path(content_type, features):
+    """Every format gives the model the same input as the CSV payload of the same rows."""
+    expected = deserialize(serialize(features, CSV), CSV)
+    decoded = deserialize(serialize(features, content_type), content_type)
+    assert decoded.shape == expected.shape
+    np.testing.assert_array_equal(np.asarray(decoded, dtype=np.float64), expected)
+
+
+@pytest.mark.parametrize("content_type", FORMATS)
+def test_predictions_round_trip(content_type):
+    labels = np.array([0, 2, 1, 1])
+    decoded = deserialize(serialize(labels, content_type), content_type)
+    np.testing.assert_array_equal(decoded, labels)
+
+
+@pytest.mark.parametrize("content_type", [c for c in FORMATS if c != CSV])
+def test_class_names_round_trip(content_type):
+    # CSV is read back as numbers, like the features it's mostly used for
+    labels = np.array(["no", "yes", "yes", "no"])
+    decoded = deserialize(serialize(labels, content_type), content_type)
+    np.testing.assert_array_equal(decoded, labels)
+
+
+@pytest.mark.parametrize("content_type", [c for c in FORMATS if c != CSV])
+def test_predictions_with_probabilities_round_trip(content_type):
+    labels = np.array(["a", "c", "b"])
+    probabilities = np.array([[0.7, 0.2, 0.1], [0.1, 0.1, 0.8], [0.25, 0.5, 0.25]])
+    body = serialize(labels, content_type, probabilities=probabilities)
+    np.testing.assert_array_equal(deserialize(body, content_type), labels)
+
+
+def test_csv_with_probabilities():
+    body = serialize(np.array([1, 0]), CSV, probabilities=np.array([[0.25, 0.75], [0.5, 0.5]]))
+    assert body == b"1,0.25,0.75\n0,0.5,0.5\n"
+
+
+def test_missing_values_are_empty_csv_fields_and_json_nulls():
+    X = np.array([[1.0, np.nan], [np.nan, 2.5]])
+    assert serialize(X, CSV) == b"1.0,\n,2.5\n"
+    assert serialize(X, JSON) == b'{"instances":[[1.0,null],[null,2.5]]}'
+    assert serialize(X, JSONLINES) == b"[1.0,null]\n[null,2.5]\n"
+
+
+def test_json_row_forms():
+    expected = np.array([[1.0, 2.0], [3.0, np.nan]])
+    for body in (
+        b"[[1, 2], [3, null]]",
+        b'{"instances": [[1, 2], [3, null]]}',
+        b'{"instances": [{"features": [1, 2]}, {"features": [3, null]}]}',
+    ):
+        np.testing.assert_array_equal(deserialize(body, JSON), expected)
+    np.testing.assert_array_equal(deserialize(b'{"features": [1, 2]}', JSON), expected[:1])
+    jsonlines = b'{"features": [1, 2]}\n\n{"features": [3, null]}\n'
+    np.testing.assert_array_equal(deserialize(jsonlines, JSONLINES), expected)
+
+
+@pytest.mark.parametrize(
+    "body", [b'{"rows": [[1, 2]]}', b"[[1, 2], [3]]", b'[["a", "b"]]', b'"text"']
+)
+def test_malformed_json_rows(body):
+    with pytest.raises(ValueError):
+        deserialize(body, JSON)
+
+
+def test_npy_is_read_without_copy():
+    X = np.arange(12, dtype=np.float32).reshape(3, 4)
+    decoded = deserialize(serialize(X, NPY), NPY)
+    np.testing.assert_array_equal(decoded, X)
+    assert not decoded.flags.writeable  # a view on the request body
+
+
+def test_npy_object_arrays_are_refused():
+    body = serialize(np.array([[1, 2]], dtype=np.float64), NPY)
+    body = body.replace(b"'<f8'", b"'|O' ")
+    with pytest.raises(ValueError):
+        deserialize(body, NPY)
+
+
+def test_unsupported_content_type():
+    with pytest.raises(UnsupportedContentType):
+        serialize(np.zeros(1), "text/html")
+    with pytest.raises(UnsupportedContentType):
+        deserialize(b"", "text/html")
+    assert set(DESERIALIZERS) == set(SERIALIZERS)
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        (None, CSV),
+        ("application/json", JSON),
+        ("text/html, application/jsonlines;q=0.5", JSONLINES),
+        ("application/json;q=0.2, text/csv", CSV),
+        ("*/*", CSV),
+        ("application/*", JSON),
+        ("application/json;q=0", None),
+        ("text/html", None),
+    ],
+)
+def test_negotiate(accept, expected):
+    supported = {CSV: None, JSON: None, JSONLINES: None}
+    assert negotiate(accept, supported, default=CSV) == expected
+
+
+def test_custom_attributes_round_trip():
+    attributes = {"trace-id": "abc", "content-encoding": "gzip"}
+    header = format_custom_attributes(attributes)
+    assert header == "trace-id=abc;content-encoding=gzip"
+    assert parse_custom_attributes(header) == attributes
+    assert parse_custom_attributes(" Probabilities=true, x=1 ") == {
+        "probabilities": "true",
+        "x": "1",
+    }
+    assert parse_custom_attributes(None) == {}
@@ -0,0 +1,81 @@
+import io
+
+import numpy as np
+import pytest
+
+from csv_parser import CsvParseError, CsvParser
+
+
+def payload(rows) -> bytes:
+    return "".join(",".join(row) + "\n" for row in rows).encode()
+
+
+@pytest.mark.parametrize("large", [False, True])
+def test_parse(large):
+    body = b"1,2.5,-3\n4e2,,6\n,,\n"
+    values = CsvParser(3).parse(body, large=large)
+    assert values.dtype == np.float32
+    np.testing.assert_array_equal(
+        values, [[1, 2.5, -3], [400, np.nan, 6], [np.nan, np.nan, np.nan]]
+    )
+
+
+def test_crlf_and_missing_final_newline():
+    np.testing.assert_array_equal(CsvParser(2).parse(b"1,2\r\n3,4"), [[1, 2], [3, 4]])
+
+
+def test_numpy_and_pandas_paths_agree():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(300, 5)).astype(np.float32)
+    body = payload(X.astype(str))
+    parser = CsvParser(5)
+    np.testing.assert_array_equal(parser.parse(body, large=False), parser.parse(body, large=True))
+    np.testing.assert_array_equal(parser.parse(body), X)
+
+
+def test_empty_payload():
+    with pytest.raises(CsvParseError, match="empty payload"):
+        CsvParser(3).parse(b"\n")
+
+
+@pytest.mark.parametrize("large", [False, True])
+def test_wrong_column_count(large):
+    with pytest.raises(CsvParseError, match=r"^row 2: expected 3 columns, got 2$") as e:
+        CsvParser(3).parse(b"1,2,3\n4,5\n7,8,9\n", large=large)
+    assert (e.value.row, e.value.column) == (2, None)
+
+
+def test_several_malformed_rows():
+    with pytest.raises(
+        CsvParseError, match=r"row 1: expected 2 columns, got 3 \(2 malformed rows\)"
+    ):
+        CsvParser(2).parse(b"1,2,3\n4,5\n6\n")
+
+
+@pytest.mark.parametrize("large", [False, True])
+def test_not_a_number(large):
+    with pytest.raises(CsvParseError, match=r"row 2, column 3: not a number: b'abc'") as e:
+        CsvParser(3).parse(b"1,2,3\n4,5,abc\n", large=large)
+    assert (e.value.row, e.value.column) == (2, 3)
+
+
+def test_parse_error_is_a_value_error():
+    # The server answers ValueErrors with a 400
+    assert issubclass(CsvParseError, ValueError)
+
+
+def test_parse_stream_matches_parse():
+    rng = np.random.default_rng(1)
+    body = payload(rng.normal(size=(1000, 4)).astype(np.float32).astype(str))
+    parser = CsvParser(4)
+    blocks = list(parser.parse_stream(io.BytesIO(body), block_rows=300, chunk_bytes=1000))
+    assert [len(block) for block in blocks] == [300, 300, 300, 100]
+    np.testing.assert_array_equal(np.concatenate(blocks), parser.parse(body))
+
+
+def test_parse_stream_locates_errors_in_the_payload():
+    rows = [["1", "2"]] * 500
+    rows[420] = ["1"]
+    stream = io.BytesIO(payload(rows))
+    with pytest.raises(CsvParseError, match=r"^row 421: expected 2 columns, got 1$"):
+        list(CsvParser(2).parse_stream(stream, block_rows=128, chunk_bytes=64))
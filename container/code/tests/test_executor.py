@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+import metrics
+from executor import InferenceExecutor
+
+
+def test_run_calls_fn_on_an_inference_thread():
+    executor = InferenceExecutor(2)
+    total, thread = executor.run(lambda a, b: (a + b, threading.current_thread().name), 1, 2)
+    assert total == 3
+    assert thread.startswith("inference")
+    assert executor.in_flight == 0
+
+
+def test_run_raises_the_errors_of_fn():
+    def fail():
+        raise RuntimeError("model failed")
+
+    executor = InferenceExecutor(1)
+    with pytest.raises(RuntimeError, match="model failed"):
+        executor.run(fail)
+    assert executor.in_flight == 0
+
+
+def test_concurrent_callers_share_the_pool():
+    executor = InferenceExecutor(2)
+    running, most_running = 0, 0
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def score(i):
+        nonlocal running, most_running
+        with lock:
+            running += 1
+            most_running = max(most_running, running)
+        release.wait(timeout=10)
+        with lock:
+            running -= 1
+        return i * i
+
+    results = {}
+    threads = [
+        threading.Thread(target=lambda i=i: results.setdefault(i, executor.run(score, i)))
+        for i in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    while executor.in_flight < len(threads):
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert results == {i: i * i for i in range(6)}
+    assert most_running == 2  # no more than the pool's threads at once
+    assert executor.in_flight == 0
+
+
+def test_stages_timed_on_the_pool_go_to_the_caller():
+    executor = InferenceExecutor(1)
+    trace = metrics.Trace("test")
+    with metrics.traced(trace):
+        executor.run(metrics.observe, "predict", 0.5)
+    assert trace.spans == {"predict": 0.5}
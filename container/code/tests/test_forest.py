@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from forest import TreeEnsemble
+
+lightgbm = pytest.importorskip("lightgbm")
+
+
+def make_data(n_classes, n_rows=2000, n_features=12, seed=0):
+    """Features with missing values and many exact zeros, and labels that depend on both."""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features))
+    X[rng.random(X.shape) < 0.1] = 0.0
+    X[rng.random(X.shape) < 0.1] = np.nan
+    signal = np.nan_to_num(X[:, 0]) + 0.5 * np.isnan(X[:, 1]) - (X[:, 2] == 0)
+    cuts = np.quantile(signal, np.linspace(0, 1, n_classes + 1)[1:-1])
+    y = np.digitize(signal, cuts)
+    return X, y
+
+
+def fit(X, y, labels, **params):
+    estimator = lightgbm.LGBMClassifier(n_estimators=40, num_leaves=15, verbose=-1, **params)
+    estimator.fit(X, labels[y])
+    return estimator, TreeEnsemble.from_booster(estimator.booster_, estimator.classes_)
+
+
+def assert_parity(estimator, forest, X):
+    np.testing.assert_array_equal(forest.predict_proba(X), estimator.predict_proba(X))
+    np.testing.assert_array_equal(forest.predict(X), estimator.predict(X))
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+@pytest.mark.parametrize("zero_as_missing", [False, True])
+def test_matches_lightgbm(n_classes, zero_as_missing):
+    X, y = make_data(n_classes)
+    labels = np.array(["low", "mid", "high"][:n_classes])
+    estimator, forest = fit(X, y, labels, zero_as_missing=zero_as_missing)
+    assert forest.n_outputs == (1 if n_classes == 2 else n_classes)
+    assert forest.has_zero_missing == zero_as_missing
+    X_test, _ = make_data(n_classes, n_rows=500, seed=1)
+    assert_parity(estimator, forest, X_test)
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_rows_of_missing_values_and_zeros(n_classes):
+    X, y = make_data(n_classes)
+    estimator, forest = fit(X, y, np.arange(n_classes))
+    X_test = np.array([np.full(X.shape[1], np.nan), np.zeros(X.shape[1]), [-0.0] * X.shape[1]])
+    assert_parity(estimator, forest, X_test)
+
+
+def test_batches_over_several_blocks(monkeypatch):
+    X, y = make_data(3)
+    estimator, forest = fit(X, y, np.arange(3))
+    monkeypatch.setattr(TreeEnsemble, "block_rows", 64)
+    assert_parity(estimator, forest, X[:1000])
+    assert_parity(estimator, forest, X[:1])
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_exact_parity_on_test_data(test_data, binary):
+    features, target = test_data
+    X = features.to_numpy(dtype=np.float64)
+    y = (target > 0).astype(int) if binary else target
+    estimator, forest = fit(X, y, np.unique(y))
+    X_test = X.copy()
+    X_test[::7, ::3] = np.nan  # rows with missing values, besides the two of the data
+    assert_parity(estimator, forest, X_test)
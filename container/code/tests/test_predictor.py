@@ -0,0 +1,260 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def client(predictor):
+    return predictor.app.test_client()
+
+
+def warm_up(predictor, monkeypatch):
+    """Warm up in the test's thread, as start_warm_up does in its own."""
+    monkeypatch.setattr(predictor.ScoringService, "warm_up_pid", os.getpid())
+    predictor.ScoringService.warm_up()
+
+
+def forget_width(monkeypatch):
+    """Load the slim models as a backend that can't tell their width."""
+    from backends import SlimBackend
+
+    load = SlimBackend.load
+
+    def load_without_width(self, model_dir):
+        load(self, model_dir)
+        self.n_inputs = None
+
+    monkeypatch.setattr(SlimBackend, "load", load_without_width)
+
+
+def test_warm_up_with_sample(predictor, client, monkeypatch):
+    warm_up(predictor, monkeypatch)
+    assert predictor.ScoringService.warm_up_state == "ready"
+    assert client.get("/ping").status_code == 200
+    assert client.get("/live").status_code == 200
+
+
+def test_warm_up_without_schema_or_sample(predictor, client, bare_model, monkeypatch):
+    monkeypatch.setattr(predictor.ServeConfig, "MODEL_DIR", bare_model)
+    warm_up(predictor, monkeypatch)
+    assert predictor.ScoringService.warm_up_state == "ready"
+    assert client.get("/ping").status_code == 200
+    assert client.get("/live").status_code == 200
+
+
+def test_warm_up_of_unknown_width(predictor, client, bare_model, monkeypatch):
+    monkeypatch.setattr(predictor.ServeConfig, "MODEL_DIR", bare_model)
+    forget_width(monkeypatch)
+    warm_up(predictor, monkeypatch)
+    assert predictor.ScoringService.warm_up_state == "ready"
+    assert client.get("/ping").status_code == 200
+
+
+def test_execution_parameters(predictor, client, monkeypatch):
+    monkeypatch.setattr(predictor.ServeConfig, "TRANSFORM_CONCURRENCY", 4)
+    response = client.get("/execution-parameters")
+    assert response.status_code == 200
+    parameters = response.get_json()
+    assert parameters["MaxConcurrentTransforms"] == 4
+    assert parameters["BatchStrategy"] == "MULTI_RECORD"
+    assert 1 <= parameters["MaxPayloadInMB"] <= 5  # within the body size nginx accepts
+
+
+def test_execution_parameters_of_unknown_width(predictor, client, bare_model, monkeypatch):
+    monkeypatch.setattr(predictor.ServeConfig, "MODEL_DIR", bare_model)
+    monkeypatch.setattr(predictor.ServeConfig, "TRANSFORM_CONCURRENCY", 4)
+    forget_width(monkeypatch)
+    parameters = client.get("/execution-parameters").get_json()
+    assert parameters["MaxConcurrentTransforms"] == 4
+    assert parameters["MaxPayloadInMB"] == predictor.DEFAULT_PAYLOAD_MB
+
+
+@pytest.mark.parametrize("known_width", [True, False])
+def test_reload_to_model_without_schema_or_sample(predictor, bare_model, monkeypatch, known_width):
+    previous = predictor.ScoringService.get_model()
+    monkeypatch.setattr(predictor.ServeConfig, "MODEL_DIR", bare_model)
+    if not known_width:
+        forget_width(monkeypatch)
+    assert predictor.ScoringService.reload()
+    assert predictor.ScoringService.model is not previous
+
+
+def test_model_selected_by_custom_attribute(predictor, client, slim_model, test_data):
+    features, _ = test_data
+    body = features.head(5).to_csv(header=False, index=False)
+    for name, status in [(slim_model.name, 200), ("missing", 404)]:
+        response = client.post(
+            "/invocations",
+            data=body,
+            content_type="text/csv",
+            headers={"X-Amzn-SageMaker-Custom-Attributes": f"model={name}"},
+        )
+        assert response.status_code == status
+    assert predictor.ScoringService.model is None  # only the named model was loaded
+    assert [model["name"] for model in predictor.ScoringService.models.stats()["models"]] == [
+        slim_model.name
+    ]
+
+
+def test_named_models_need_another_backend_than_pycaret(slim_model):
+    from backends import load_backend
+
+    with pytest.raises(ValueError, match="forest, slim or onnx"):
+        load_backend("pycaret", slim_model, named=True)
+
+
+def test_challenger_scores_the_features_of_the_primary(
+    predictor, slim_model, test_data, monkeypatch, tmp_path
+):
+    from fused import FusedPreprocessor
+
+    monkeypatch.setattr(predictor.ServeConfig, "CHALLENGER", slim_model.name)
+    monkeypatch.setattr(predictor.ServeConfig, "CHALLENGER_DIR", tmp_path)
+    transform = FusedPreprocessor.transform
+    calls = []
+
+    def counted_transform(self, X):
+        calls.append(len(X))
+        return transform(self, X)
+
+    monkeypatch.setattr(FusedPreprocessor, "transform", counted_transform)
+    features, _ = test_data
+    rows = features.to_numpy(dtype=np.float32)
+    labels = predictor.ScoringService.predict(rows)
+    challenger = predictor.ScoringService.challenger
+    deadline = time.monotonic() + 10
+    while challenger.stats()["batches"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = challenger.stats()
+    assert stats["rows"] == len(rows) and stats["agreement"] == 1.0
+    assert calls == [len(rows)]  # the challenger scored the transform of the primary
+    assert len(labels) == len(rows)
+
+
+def invoke(client, body, content_type="text/csv", accept="text/csv", attributes=None):
+    headers = {"Accept": accept}
+    if attributes:
+        headers["X-Amzn-SageMaker-Custom-Attributes"] = attributes
+    response = client.post("/invocations", data=body, content_type=content_type, headers=headers)
+    response.get_data()  # a streamed response is scored as it's read
+    response.close()  # and finished, as by the server once sent
+    return response
+
+
+@pytest.fixture
+def body(test_data):
+    features, _ = test_data
+    return features.to_csv(header=False, index=False)
+
+
+def test_ping_without_warm_up(predictor, client, monkeypatch):
+    monkeypatch.setattr(predictor.ServeConfig, "WARMUP", False)
+    assert client.get("/ping").status_code == 200
+
+
+def test_ping_while_warming_up(predictor, client, monkeypatch):
+    monkeypatch.setattr(predictor.ScoringService, "warm_up_pid", os.getpid())
+    monkeypatch.setattr(predictor.ScoringService, "warm_up_state", "warming")
+    assert client.get("/ping").status_code == 503
+    assert client.get("/live").status_code == 200
+    monkeypatch.setattr(predictor.ScoringService, "warm_up_state", "failed")
+    assert client.get("/ping").status_code == 503
+    assert client.get("/live").status_code == 500
+
+
+def test_invocations(predictor, client, body, test_data):
+    features, _ = test_data
+    response = invoke(client, body)
+    assert response.status_code == 200
+    labels = response.get_data(as_text=True).splitlines()
+    expected = predictor.ScoringService.get_model().predict(features.to_numpy(dtype=np.float32))
+    assert labels == [str(label) for label in expected]
+    assert response.headers["X-Model-Version"] == predictor.ScoringService.model.version
+    assert response.headers["X-Trace-Id"]
+
+
+def test_invocations_with_probabilities(predictor, client, body):
+    response = invoke(client, body, accept="application/json", attributes="probabilities=true")
+    assert response.status_code == 200
+    predictions = response.get_json()
+    assert len(predictions["predictions"]) == body.count("\n")
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        "1,2,3\n",  # too few columns
+        "a" + ",1" * 150 + "\n",  # not a number
+    ],
+)
+def test_malformed_payloads_get_400(client, payload):
+    response = invoke(client, payload)
+    assert response.status_code == 400
+    assert response.headers["X-Trace-Id"]
+
+
+def test_unsupported_content_type_gets_415(client, body):
+    assert invoke(client, body, content_type="application/x-unknown").status_code == 415
+
+
+def test_model_errors_get_500(predictor, client, body, monkeypatch):
+    def fail(X):
+        raise RuntimeError("model failed")
+
+    monkeypatch.setattr(predictor.ScoringService.get_model(), "predict", fail)
+    response = invoke(client, body)
+    assert response.status_code == 500
+
+
+@pytest.mark.parametrize("accept", ["text/csv", "application/jsonlines"])
+@pytest.mark.parametrize("probabilities", ["false", "true"])
+def test_streaming_matches_buffered(predictor, client, body, monkeypatch, accept, probabilities):
+    attributes = f"probabilities={probabilities}"
+    buffered = invoke(client, body, accept=accept, attributes=attributes)
+    monkeypatch.setattr(predictor.ServeConfig, "STREAMING", True)
+    monkeypatch.setattr(predictor.ServeConfig, "STREAM_BLOCK_ROWS", 100)
+    blocks = []
+    stream_predictions = predictor.stream_predictions
+
+    def counted_stream_predictions(blocks_, *args):
+        for block in blocks_:
+            blocks.append(len(block))
+            yield from stream_predictions([block], *args)
+
+    monkeypatch.setattr(predictor, "stream_predictions", counted_stream_predictions)
+    streamed = invoke(client, body, accept=accept, attributes=attributes)
+    assert streamed.status_code == buffered.status_code == 200
+    assert sum(blocks) == body.count("\n") and len(blocks) > 1  # blocks of 128 rows at least
+    assert streamed.get_data() == buffered.get_data()
+
+
+def test_streaming_malformed_first_block_gets_400(predictor, client, monkeypatch):
+    monkeypatch.setattr(predictor.ServeConfig, "STREAMING", True)
+    assert invoke(client, "1,2,3\n").status_code == 400
+
+
+@pytest.mark.parametrize("cache", ["local", "shared"])
+def test_prediction_cache(predictor, client, body, monkeypatch, cache):
+    expected = invoke(client, body).get_data()
+    monkeypatch.setattr(predictor.ServeConfig, "CACHE", cache)
+    assert invoke(client, body).get_data() == expected
+    assert invoke(client, body).get_data() == expected
+    stats = predictor.ScoringService.cache.stats()
+    n_rows = body.count("\n")
+    assert stats["hits"] + stats["duplicates"] + stats["misses"] == 2 * n_rows
+    if cache == "local":
+        assert stats["hits"] == n_rows
+    else:  # rows sharing a slot of the direct-mapped table evict each other
+        assert stats["hits"] > 0.9 * n_rows
+
+
+@pytest.mark.parametrize("mode, batching", [("threaded", False), ("sync", True)])
+def test_threaded_mode_and_micro_batching(predictor, client, body, monkeypatch, mode, batching):
+    expected = invoke(client, body).get_data()
+    monkeypatch.setattr(predictor.ServeConfig, "MODE", mode)
+    monkeypatch.setattr(predictor.ServeConfig, "BATCHING", batching)
+    monkeypatch.setattr(predictor.ServeConfig, "INFERENCE_THREADS", 2)
+    assert invoke(client, body).get_data() == expected
+    assert invoke(client, "1,2,3\n").status_code == 400
@@ -0,0 +1,56 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+
+from cache import PredictionCache
+from shared import group_directory, share_array, shared_arrays, unlink_unmapped
+
+if not os.path.isdir("/proc/self"):
+    pytest.skip("unlink_unmapped needs /proc", allow_module_level=True)
+
+
+def test_share_array_maps_one_file_per_content(tmp_path):
+    a = share_array(np.arange(10.0), tmp_path)
+    b = share_array(np.arange(10.0), tmp_path)
+    np.testing.assert_array_equal(a, np.arange(10.0))
+    assert not a.flags.writeable
+    assert len(shared_arrays(tmp_path)) == 1
+    assert a.base.filename == b.base.filename
+
+
+def test_unlink_unmapped_keeps_the_arrays_in_use(tmp_path):
+    kept = share_array(np.arange(10.0), tmp_path)
+    released = share_array(np.arange(5.0), tmp_path)
+    (tmp_path / "reload-1.npy").touch()  # not an array of share_array
+    del released
+    gc.collect()
+    assert unlink_unmapped(shared_arrays(tmp_path)) == shared_arrays(tmp_path)
+    assert len(shared_arrays(tmp_path)) == 1
+    assert (tmp_path / "reload-1.npy").exists()
+    np.testing.assert_array_equal(kept, np.arange(10.0))
+
+
+def test_share_array_writes_an_unlinked_array_again(tmp_path):
+    share_array(np.arange(5.0), tmp_path)
+    gc.collect()
+    unlink_unmapped(shared_arrays(tmp_path))
+    np.testing.assert_array_equal(share_array(np.arange(5.0), tmp_path), np.arange(5.0))
+
+
+def test_group_directory_of_this_process_group():
+    assert group_directory().name == f"model-server-{os.getpgrp()}"
+
+
+def test_shared_cache_of_a_previous_version_is_unlinked_once_unmapped(tmp_path):
+    def create(version):
+        return PredictionCache.create("shared", version, [0, 1], 64, 60, tmp_path)
+
+    old = create("v1")
+    create("v2")
+    assert (tmp_path / "prediction-cache-v1.npy").exists()  # still mapped by old
+    del old
+    gc.collect()
+    create("v2")
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["prediction-cache-v2.npy"]
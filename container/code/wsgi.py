@@ -5,3 +5,7 @@ import predictor as myapp
 # new file.
 
 app = myapp.app
+
+if myapp.ServeConfig.PRELOAD:
+    # gunicorn --preload imports this module in the master: load the model before forking
+    myapp.ScoringService.preload()